@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from pathlib import Path
+from langchain_core.embeddings import Embeddings
+import hashlib
+import json
+import platform
+import sqlite3
+import tempfile
+import threading
+import time
+
+DEFAULT_CACHE_DIR = Path("/tmp" if platform.system() == "Darwin" else tempfile.gettempdir()) / "codebase-rag-cache"
+DEFAULT_MAX_MEMORY_ENTRIES = 2048
+DEFAULT_TTLS = {
+    "embedding": 7 * 24 * 60 * 60,  # Query embeddings only depend on the embedding model
+    "retrieval": 24 * 60 * 60,  # Retrieved doc ids for a query on a given index
+    "answer": 24 * 60 * 60  # Final LLM answers
+}
+
+_MISSING = object()
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes the whitespace of a query so trivially different spellings share a cache entry.
+    Casing is kept: embeddings and identifier lookups are case sensitive, so Config and config may retrieve different blocks.
+    """
+    return " ".join(query.split())
+
+
+class QueryCache:
+    """
+    Multi level cache for RAG queries. An in-process LRU sits in front of an on-disk SQLite store that survives restarts and is shared by every conversation in the process.
+
+    Entries are grouped into levels ("embedding", "retrieval", "answer"), each with its own TTL and hit/miss counters.
+    Keys are built from the normalized query and every parameter that changes the result (retrieval parameters, model, repo commit SHA and index fingerprint), so a re-indexed repo never hits entries of the old index.
+
+    Values have to be JSON serializable.
+    """
+    def __init__(self, cache_dir: Path = DEFAULT_CACHE_DIR, max_memory_entries: int = DEFAULT_MAX_MEMORY_ENTRIES, ttls: Optional[Dict[str, float]] = None):
+        self.max_memory_entries = max_memory_entries
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+
+        self._memory: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()  # Streamlit runs each session in its own thread
+        self._stats = {level: {"memory_hits": 0, "disk_hits": 0, "misses": 0} for level in self.ttls}
+
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self._disk = sqlite3.connect(cache_dir / "query_cache.sqlite3", check_same_thread=False)
+        self._disk.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, level TEXT, expires_at REAL, value TEXT)")
+        self._disk.commit()
+
+    @staticmethod
+    def make_key(level: str, query: str, **params: Any) -> str:
+        """
+        Builds a cache key from the level, normalized query and the parameters the result depends on.
+        """
+        key_data = json.dumps({"level": level, "query": normalize_query(query), "params": params}, sort_keys=True, default=str)
+        return f"{level}:{hashlib.sha256(key_data.encode()).hexdigest()}"
+
+    def get(self, level: str, key: str) -> Any:
+        """
+        Returns the cached value, or None on a miss or expired entry.
+        """
+        now = time.time()
+        value = _MISSING
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    self._stats[level]["memory_hits"] += 1
+                    return entry[1]
+                del self._memory[key]
+
+            row = self._disk.execute("SELECT expires_at, value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                if row[0] > now:
+                    value = json.loads(row[1])
+                    self._remember(key, row[0], value)
+                    self._stats[level]["disk_hits"] += 1
+                else:
+                    self._disk.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self._disk.commit()
+
+            if value is _MISSING:
+                self._stats[level]["misses"] += 1
+                return None
+        return value
+
+    def set(self, level: str, key: str, value: Any) -> None:
+        """
+        Stores a value in both the in-memory LRU and the on-disk store with the TTL of its level.
+        """
+        expires_at = time.time() + self.ttls[level]
+        with self._lock:
+            self._remember(key, expires_at, value)
+            self._disk.execute("INSERT OR REPLACE INTO cache (key, level, expires_at, value) VALUES (?, ?, ?, ?)",
+                               (key, level, expires_at, json.dumps(value)))
+            self._disk.commit()
+
+    def purge_expired(self) -> int:
+        """
+        Removes expired entries from the on-disk store. Returns the number of entries removed.
+        """
+        with self._lock:
+            removed = self._disk.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),)).rowcount
+            self._disk.commit()
+        return removed
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns hit/miss counters and hit rate for every level.
+        """
+        with self._lock:
+            stats = {}
+            for level, counters in self._stats.items():
+                hits = counters["memory_hits"] + counters["disk_hits"]
+                total = hits + counters["misses"]
+                stats[level] = {**counters, "hit_rate": hits / total if total else 0.0}
+        return stats
+
+    def _remember(self, key: str, expires_at: float, value: Any) -> None:
+        """
+        Adds an entry to the in-memory LRU, evicting the least recently used entry if full. Caller must hold the lock.
+        """
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Wraps an embedding model so that query embeddings are served from a QueryCache.
+    Document embeddings are passed straight through since they are only computed while indexing.
+    """
+    def __init__(self, embeddings: Embeddings, cache: QueryCache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = getattr(embeddings, "model_name", type(embeddings).__name__)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        # Embedding models are sensitive to casing, so key on the exact text rather than the normalized query
+        key = self.cache.make_key("embedding", "", text=text, model=self.model_name)
+        vector = self.cache.get("embedding", key)
+        if vector is None:
+            vector = list(self.embeddings.embed_query(text))
+            self.cache.set("embedding", key, vector)
+        return vector
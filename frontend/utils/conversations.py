@@ -1,6 +1,7 @@
 import streamlit as st
 from ui import ui
 from utils import rag
+from utils.index_registry import CLONE_REGISTRY, INDEX_REGISTRY
 from utils.llm import (
     DEFAULT_N_PAST_MESSAGES
 )
@@ -21,7 +22,9 @@ blank_convo = {"repo": None,
                "sidebar_details": False,  # Show sidebar details?
                "messages": [],  # Messages are for display
                "active_messages": [],  # Active Messages is passed as context to LLM 
-               "repo_database": None  # RAG database for querying
+               "repo_database": None,  # RAG database for querying, shared with other conversations on the same repo and commit
+               "repo_index_key": None,  # Key of repo_database in the index registry, released when the conversation is deleted
+               "repo_clone": None  # Cloned repo directory held in the clone registry, deleted with the last conversation using it
                }
 
 def get_active_convo() -> int:
@@ -85,6 +88,54 @@ def setup_repo_convo():
             st.session_state.animation["process_repo"] = True
         
 
+def acquire_repo_database(convo: int, repo_path):
+    """
+    Attaches the shared RAG database of a repo to a conversation, indexing the repo unless another conversation already has.
+    """
+    key, rag_db = INDEX_REGISTRY.acquire(repo_path)
+    st.session_state.global_messages[convo]["repo_database"] = rag_db
+    st.session_state.global_messages[convo]["repo_index_key"] = key
+    return rag_db
+
+def refresh_repo_database(convo: int, repo_path):
+    """
+    Attaches the shared RAG database of the commit a repo is at now (e.g after pulling) to a conversation, in place of the one it held.
+    """
+    key, rag_db = INDEX_REGISTRY.refresh(st.session_state.global_messages[convo]["repo_index_key"], repo_path)
+    st.session_state.global_messages[convo]["repo_database"] = rag_db
+    st.session_state.global_messages[convo]["repo_index_key"] = key
+    return rag_db
+
+def release_repo_database(convo: int):
+    """
+    Detaches a conversation from its shared RAG database, which the registry may then evict.
+    """
+    key = st.session_state.global_messages[convo].get("repo_index_key")
+    if key is not None:
+        INDEX_REGISTRY.release(key)
+    st.session_state.global_messages[convo]["repo_database"] = None
+    st.session_state.global_messages[convo]["repo_index_key"] = None
+
+def hold_repo_clone(convo: int, clone_path):
+    """
+    Records that a conversation uses a cloned repo, so that deleting another conversation on the same repo keeps the clone.
+    """
+    clone_path = str(clone_path)
+    if st.session_state.global_messages[convo].get("repo_clone") == clone_path:
+        return
+    CLONE_REGISTRY.acquire(clone_path)
+    release_repo_clone(convo)
+    st.session_state.global_messages[convo]["repo_clone"] = clone_path
+
+def release_repo_clone(convo: int):
+    """
+    Detaches a conversation from its cloned repo, deleting the clone if no other conversation uses it.
+    """
+    clone_path = st.session_state.global_messages[convo].get("repo_clone")
+    if clone_path is not None and CLONE_REGISTRY.release(clone_path):
+        git_helper.delete_downloaded_repo(clone_path)
+    st.session_state.global_messages[convo]["repo_clone"] = None
+
 def process_local_repository():
     """
     Process the local repository by indexing it.
@@ -98,9 +149,10 @@ def process_local_repository():
 
         with st.spinner(text="Indexing local repository..."):
             if rag_db is None:
-                st.session_state.global_messages[get_active_convo()]["repo_database"] = rag.RAG_Database(repo_path)
-            rag_db = st.session_state.global_messages[get_active_convo()].get("repo_database")
-            indexed = rag_db.index_repo()
+                acquire_repo_database(get_active_convo(), repo_path)
+            else:
+                refresh_repo_database(get_active_convo(), repo_path)  # Picks up commits and local changes made since it was indexed
+            indexed = True
             st.toast(f"Repository {repo_name} at {repo_path} indexed.")
 
         if indexed: 
@@ -129,13 +181,15 @@ def process_remote_repository():
             if cloned:
                 st.toast(f"Repository {repo_name} at {repo_url} cloned.")
                 st.session_state.global_messages[get_active_convo()]["repo_path"] = cloned
+                hold_repo_clone(get_active_convo(), cloned)
 
         with st.spinner(text="Indexing repository..."):
             repo_path = st.session_state.global_messages[get_active_convo()].get("repo_path")
             if rag_db is None:
-                st.session_state.global_messages[get_active_convo()]["repo_database"] = rag.RAG_Database(repo_path)
-            rag_db = st.session_state.global_messages[get_active_convo()].get("repo_database")
-            indexed = rag_db.index_repo()
+                acquire_repo_database(get_active_convo(), repo_path)
+            else:
+                refresh_repo_database(get_active_convo(), repo_path)
+            indexed = True
             st.toast(f"Repository {repo_name} indexed.")
 
         if cloned and indexed: 
@@ -192,7 +246,7 @@ def continue_code_convo():
 def delete_convo(idx, is_remote):
     """
     Deletes a conversation from the history - also removes it from the sidebar as a result.
-    It also deletes any cloned repos at the path if it does exist if its a remote repo.
+    It also deletes the cloned repo if its a remote repo and no other conversation uses the same clone.
     Does not delete repos is its a local repo!
     """
     curr_convo = get_active_convo()
@@ -204,10 +258,11 @@ def delete_convo(idx, is_remote):
         else:
             # Create new convo if same idx
             start_new_convo()
-    repo_path = st.session_state.global_messages[curr_convo].get("repo_path")
+    repo_path = st.session_state.global_messages[idx].get("repo_path")
     if repo_path:
-        if is_remote:  # If remote, delete repo. 
-            git_helper.delete_downloaded_repo(repo_path)
+        if is_remote:  # If remote, delete repo unless another conversation still uses it
+            release_repo_clone(idx)
         else:  # Else if local, do not nuke the repo
             print(f"Local repo, will not delete {repo_path}.")
+    release_repo_database(idx)
     st.session_state.global_messages.pop(idx)
@@ -0,0 +1,18 @@
+from contextlib import contextmanager
+from pathlib import Path
+import sys
+
+ENGINE_DIR = str(Path(__file__).resolve().parents[2] / "rag-codebase" / "retriever_testing_indepth_reranker")
+
+
+@contextmanager
+def engine_imports():
+    """
+    Puts the retrieval engine first on the import path, for the imports in the with block only.
+    Engine modules import each other by plain name and some of those names also exist in ast_tokenizer (e.g python_ast), so keeping the engine on the path would make later imports depend on path order.
+    """
+    sys.path.insert(0, ENGINE_DIR)
+    try:
+        yield
+    finally:
+        sys.path.remove(ENGINE_DIR)
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+import json
+import os
+import threading
+
+from utils import git_helper
+from utils import rag
+
+DEFAULT_MEMORY_BUDGET = 4 * 1024 ** 3  # Bytes of index data kept in memory across all repos
+
+
+class _RegistryEntry:
+    def __init__(self, database: rag.RAG_Database):
+        self.database = database
+        self.refs = 0
+        self.size = 0
+        self.indexed = False
+        self.index_lock = threading.Lock()  # Only the first conversation of a repo indexes it, the others wait for it
+
+
+class IndexRegistry:
+    """
+    Process-wide registry of indexed repos, shared by every conversation (and Streamlit session) in the process.
+
+    Databases are keyed by (repo path, commit SHA, index config), so conversations about the same repo at the same commit share one index instead of each parsing and embedding it.
+    Conversations acquire() a database when they start and release() it when they are deleted. Databases nobody holds stay cached, and the least recently used of them are evicted once the total size of all indexes exceeds the memory budget.
+    Databases in use are never evicted, so memory is bounded by the distinct repos in use rather than by the number of open conversations.
+    """
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET, database_factory: Callable[[str], rag.RAG_Database] = rag.RAG_Database):
+        self.memory_budget = memory_budget
+        self.database_factory = database_factory
+        self._entries: "OrderedDict[str, _RegistryEntry]" = OrderedDict()  # Least recently used first
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(repo_path: str, commit_sha: Optional[str] = None, config: Optional[Dict] = None) -> str:
+        """
+        Key of a repo index. The commit SHA is looked up from the repo if not given.
+        """
+        if commit_sha is None:
+            commit_sha = git_helper.get_latest_commit_sha_local(repo_path)
+        if config is None:
+            config = rag.RAG_Database.index_config()
+        return json.dumps({"repo": os.path.realpath(repo_path), "commit": commit_sha, "config": config}, sort_keys=True)
+
+    def acquire(self, repo_path: str) -> Tuple[str, rag.RAG_Database]:
+        """
+        Returns the key and indexed database of a repo, indexing it if no conversation has yet. Call release() with the key once done.
+        """
+        return self.__acquire(IndexRegistry.make_key(repo_path), repo_path)
+
+    def refresh(self, key: str, repo_path: str) -> Tuple[str, rag.RAG_Database]:
+        """
+        Moves a reference taken by acquire() to the commit the repo is at now (e.g after pulling), returning the new key and database.
+        A database is never re-indexed in place for another commit, as other conversations may still hold it under its key. The database of the new commit is acquired instead, which only embeds the files that changed since the saved index.
+        At the same commit, the database is updated in place with uncommitted changes, which every conversation holding it sees anyway as they share the working tree.
+        """
+        new_key = IndexRegistry.make_key(repo_path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if new_key != key or entry is None:
+            acquired = self.__acquire(new_key, repo_path)
+            self.release(key)
+            return acquired
+
+        with entry.index_lock:
+            entry.database.index_repo()
+            entry.size = entry.database.memory_usage()
+        with self._lock:
+            self._entries.move_to_end(key)
+            self.__evict()
+        return key, entry.database
+
+    def __acquire(self, key: str, repo_path: str) -> Tuple[str, rag.RAG_Database]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _RegistryEntry(self.database_factory(repo_path))
+            entry.refs += 1
+            self._entries.move_to_end(key)
+
+        # Index outside the registry lock so that other repos can be acquired meanwhile
+        try:
+            with entry.index_lock:
+                if not entry.indexed:
+                    entry.database.index_repo()
+                    entry.size = entry.database.memory_usage()
+                    entry.indexed = True
+        except Exception:
+            self.release(key)
+            raise
+
+        with self._lock:
+            self.__evict()
+        return key, entry.database
+
+    def release(self, key: str) -> None:
+        """
+        Drops a reference taken by acquire(). The database stays cached until it is evicted.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs = max(entry.refs - 1, 0)
+            if entry.refs == 0 and not entry.indexed:
+                del self._entries[key]  # Indexing failed, nothing worth caching
+            self.__evict()
+
+    def memory_usage(self) -> int:
+        with self._lock:
+            return sum(entry.size for entry in self._entries.values())
+
+    def stats(self) -> Dict[str, Dict]:
+        """
+        Returns references and size of every cached database, least recently used first.
+        """
+        with self._lock:
+            return {key: {"refs": entry.refs, "size": entry.size, "indexed": entry.indexed} for key, entry in self._entries.items()}
+
+    def __evict(self) -> None:
+        """
+        Evicts idle databases, least recently used first, until the budget is met. Caller must hold the lock.
+        """
+        total = sum(entry.size for entry in self._entries.values())
+        for key in list(self._entries):
+            if total <= self.memory_budget:
+                break
+            entry = self._entries[key]
+            if entry.refs == 0:
+                total -= entry.size
+                del self._entries[key]
+
+
+class CloneRegistry:
+    """
+    Counts the conversations using each cloned repo. Remote repos are cloned to a directory named after their owner and name, so conversations about the same repo share one clone, which may only be deleted with the last of them.
+    """
+    def __init__(self):
+        self._refs: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, clone_path: str) -> None:
+        with self._lock:
+            path = os.path.realpath(clone_path)
+            self._refs[path] = self._refs.get(path, 0) + 1
+
+    def release(self, clone_path: str) -> bool:
+        """
+        Drops a reference taken by acquire(). Returns True if it was the last one, i.e the clone can be deleted.
+        """
+        with self._lock:
+            path = os.path.realpath(clone_path)
+            refs = self._refs.get(path, 0) - 1
+            if refs > 0:
+                self._refs[path] = refs
+                return False
+            self._refs.pop(path, None)
+            return True
+
+    def refs(self, clone_path: str) -> int:
+        with self._lock:
+            return self._refs.get(os.path.realpath(clone_path), 0)
+
+
+INDEX_REGISTRY = IndexRegistry()  # Shared by every Streamlit session in the process
+CLONE_REGISTRY = CloneRegistry()
@@ -1,20 +1,160 @@
-from langchain_community.document_loaders import DirectoryLoader
 # from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaLLM
 from langchain_core.prompts import PromptTemplate
-from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
+from langchain_core.documents import Document
+from collections.abc import Mapping
+from pathlib import Path
 
+import fcntl
+import hashlib
+import json
+import numpy as np
+import shutil
 import sys
 import os
+import tempfile
+import time
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(os.path.abspath('')), './ast_tokenizer/languages')))
 from python_ast import PythonASTDocumentLoader
 from javascript_ast import JavascriptASTDocumentLoader
+from utils.engine import engine_imports
+with engine_imports():
+    from code_tokenizer import CodeTokenizer
+    from dense_index import DenseIndex, MappedDenseIndex
+    from index_files import BundleDirectory, IndexBundle, MappedTexts, load_array, load_manifest, save_array, save_manifest, save_texts, write_bundle
+    from lexical_index import BM25Index
+    from rank_fusion import weighted_reciprocal_rank
+    from symbol_index import SymbolIndex
+from utils import git_helper
+from utils.cache import QueryCache, CachedQueryEmbeddings
+from utils.snapshot import SnapshotHolder
 
 
 
+class MappedDocuments(Mapping):
+    """
+    Read-only block id -> Document map over memory mapped contents and metadata, saved with IndexSnapshot.save().
+    Documents are decoded on access, so only the retrieved ones are ever read.
+    """
+    def __init__(self, directory):
+        self.block_ids = load_array(directory, "document_ids")
+        self.contents = MappedTexts(directory, "contents")
+        self.metadata = MappedTexts(directory, "metadata")
+
+    def __len__(self):
+        return len(self.block_ids)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.block_ids, self.contents.data, self.contents.offsets, self.metadata.data, self.metadata.offsets))
+
+    def __iter__(self):
+        return iter(self.block_ids.tolist())
+
+    def __getitem__(self, block_id):
+        i = int(np.searchsorted(self.block_ids, block_id))
+        if i == len(self.block_ids) or self.block_ids[i] != block_id:
+            raise KeyError(block_id)
+        return Document(page_content=self.contents[i], metadata=json.loads(self.metadata[i]))
+
+
+class IndexSnapshot:
+    """
+    One immutable version of a repo index: the dense index, its documents by block id, their BM25 index, the symbols they define and what was indexed (file hashes and commit).
+    Never modified once published, the next version is built from a copy.
+    """
+    def __init__(self, dense=None, documents=None, file_digests=None, repo_commit_sha=None, symbols=None, tokenizer=None, bm25=None):
+        self.dense = dense
+        self.documents = documents or {}  # Block id -> Document, block ids are stable across re-indexing
+        if symbols is None:
+            symbols = SymbolIndex(self.documents.keys(), (document.metadata for document in self.documents.values()))
+        self.symbols = symbols
+        # BM25 positions are positions in the sorted block ids, the order documents are saved in
+        if isinstance(self.documents, MappedDocuments):
+            self.block_ids = self.documents.block_ids
+        else:
+            self.block_ids = np.asarray(sorted(self.documents), dtype=np.int64)
+        if bm25 is None:
+            tokenizer = CodeTokenizer()
+            bm25 = BM25Index(tokenizer.encode_corpus(self.documents[block_id].page_content for block_id in self.block_ids.tolist()))
+        self.tokenizer = tokenizer
+        self.bm25 = bm25
+        self.file_digests = file_digests or {}  # File path -> hash of its contents when it was indexed
+        self.repo_commit_sha = repo_commit_sha
+        self.index_fingerprint = self.__fingerprint_files()
+
+    def memory_usage(self):
+        """
+        Rough size in bytes of the vectors, postings and documents held by this snapshot.
+        Memory mapped data is counted at the size of its files. It lives in the page cache shared by every process, but searches touch all of its vectors so it has to fit in memory all the same.
+        """
+        size = 0
+        if isinstance(self.dense, DenseIndex):
+            size += self.dense.ntotal * self.dense.dim * 4 + self.dense.slot_ids.nbytes
+        elif isinstance(self.dense, MappedDenseIndex):
+            size += self.dense.matrix.nbytes + self.dense.slot_ids.nbytes + self.dense.added.ntotal * self.dense.dim * 4
+        if isinstance(self.documents, MappedDocuments):
+            size += self.documents.nbytes
+        elif isinstance(self.documents, dict):
+            for document in self.documents.values():
+                size += sys.getsizeof(document.page_content) + sum(sys.getsizeof(value) for value in document.metadata.values())
+        size += self.bm25.doc_len.nbytes + self.bm25.num_postings * 3 * 8  # Positions, frequencies and impacts
+        return size
+
+    def lexical_search(self, query, k):
+        """
+        Returns the ids of the k best BM25 matches of the query, best first.
+        """
+        _, positions = self.bm25.top_k(self.tokenizer.encode_query(query), k)
+        return self.block_ids[positions].tolist()
+
+    def save(self, directory):
+        """
+        Saves the snapshot as flat files that load() memory maps.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        if self.dense is not None:
+            self.dense.save(directory / "dense")
+        self.symbols.save(directory / "symbols")
+        self.tokenizer.save(directory / "tokenizer")
+        self.bm25.save(directory / "bm25")
+        block_ids = sorted(self.documents)
+        save_array(directory, "document_ids", np.asarray(block_ids, dtype=np.int64))
+        save_texts(directory, "contents", (self.documents[block_id].page_content for block_id in block_ids))
+        save_texts(directory, "metadata", (json.dumps(self.documents[block_id].metadata, default=str) for block_id in block_ids))
+        save_manifest(directory, "snapshot", has_dense=self.dense is not None, has_symbols=True, has_bm25=True,
+                      file_digests=self.file_digests, repo_commit_sha=self.repo_commit_sha)
+
+    @staticmethod
+    def load(directory):
+        """
+        Loads a snapshot saved with save() without reading its vectors, postings or documents, they are paged in from the mapped files as searches touch them.
+        directory can also be a directory inside an IndexBundle.
+        """
+        if not isinstance(directory, BundleDirectory):
+            directory = Path(directory)
+        manifest = load_manifest(directory, "snapshot")
+        dense = MappedDenseIndex(directory / "dense") if manifest["has_dense"] else None
+        # Both are rebuilt from the documents for older snapshots
+        symbols = SymbolIndex.load(directory / "symbols") if manifest.get("has_symbols") else None
+        tokenizer, bm25 = None, None
+        if manifest.get("has_bm25"):
+            tokenizer, bm25 = CodeTokenizer.load(directory / "tokenizer"), BM25Index.load(directory / "bm25")
+        return IndexSnapshot(dense, MappedDocuments(directory), manifest["file_digests"], manifest["repo_commit_sha"], symbols, tokenizer, bm25)
+
+    def __fingerprint_files(self):
+        """
+        Hash of the contents of every indexed file, catching uncommitted changes that the commit SHA alone would miss.
+        """
+        digest = hashlib.sha256()
+        for path, file_digest in sorted(self.file_digests.items()):
+            digest.update(f"{path},{file_digest}\n".encode())
+        return digest.hexdigest()
+
+
 class RAG_Database:
     DEFAULT_EMBEDDING = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2", model_kwargs={'device': "cuda"})
     RAG_TEMPLATE = """Use the following context to answer the user's question. 
@@ -24,25 +164,226 @@ class RAG_Database:
     OLLAMA_LLM_MODEL = OllamaLLM(model="llama3.1:8b", num_predict=-1, temperature=0.1)
     RAG_SYSTEM_PROMPT = "You are a programmer working on this codebase. You are to help the user understand the code base as much as possible"
     RAG_CONTEXT_PROMPT = "For the user query, here are some relevant information about the code that will help you."
-    def __init__(self, repo_path, embeddings = DEFAULT_EMBEDDING):
+    QUERY_CACHE = QueryCache()  # Shared by every conversation in the process
+    TOP_K = 5
+    LOADERS = {"*.py": PythonASTDocumentLoader, "*.js": JavascriptASTDocumentLoader}
+    INDEX_ROOT = Path(tempfile.gettempdir()) / "codebase-rag-index"
+    LEXICAL_WEIGHTS = (0.4, 0.6)  # BM25 and dense weights of the fusion, as in EnsembleSearch
+    def __init__(self, repo_path, embeddings = DEFAULT_EMBEDDING, query_cache = QUERY_CACHE, index_dir = None, symbols = False, lexical = False):
         self.repo_path = repo_path
-        py_loader = DirectoryLoader(repo_path, glob="*.py", loader_cls=PythonASTDocumentLoader, recursive=True)
-        js_loader = DirectoryLoader(repo_path, glob="*.js", loader_cls=JavascriptASTDocumentLoader, recursive=True)
-        self.documents = py_loader.load() + js_loader.load()
-        self.embeddings = embeddings
-        
-    def index_repo(self):
-        self.db = FAISS.from_documents(self.documents, self.embeddings)
-        retriever = self.db.as_retriever(search_kwargs={'k': 5})
+        self.symbols = symbols  # Put the blocks defining symbols named in a question before the dense results
+        self.lexical = lexical  # Fuse BM25 results with the dense ones by weighted reciprocal rank
+        self.config = RAG_Database.index_config(embeddings)
+        # Saved index shared by every process working on the repo, new processes map it instead of re-embedding the repo
+        if index_dir is None:
+            key = json.dumps({"repo": os.path.realpath(repo_path), "config": self.config}, sort_keys=True)
+            index_dir = RAG_Database.INDEX_ROOT / hashlib.sha256(key.encode()).hexdigest()[:16]
+        self.index_dir = Path(index_dir)
+        self.index_version = None  # Version of index_dir the current snapshot was loaded from or saved as
+        self.query_cache = query_cache
+        self.embeddings = CachedQueryEmbeddings(embeddings, query_cache)
         prompt = PromptTemplate(
             template=RAG_Database.RAG_TEMPLATE,
             input_variables=['context', 'input'])
-        combine_docs_chain = create_stuff_documents_chain(RAG_Database.OLLAMA_LLM_MODEL, prompt)
-        self.qa_llm = create_retrieval_chain(retriever, combine_docs_chain)
+        self.combine_docs_chain = create_stuff_documents_chain(RAG_Database.OLLAMA_LLM_MODEL, prompt)
+        # Queries read whichever snapshot is current, while index_repo builds and swaps in the next one
+        self.snapshots = SnapshotHolder(IndexSnapshot())
+        
+    @staticmethod
+    def index_config(embeddings = DEFAULT_EMBEDDING):
+        """
+        Settings that change what gets indexed, two databases with the same repo, commit and config hold the same index.
+        """
+        return {"embedding": getattr(embeddings, "model_name", type(embeddings).__name__),
+                "loaders": {pattern: loader_cls.__name__ for pattern, loader_cls in RAG_Database.LOADERS.items()}}
+
+    def index_repo(self):
+        """
+        Indexes the repo. Calling it again (e.g after pulling) only re-embeds files that were added or changed since, and drops deleted ones.
+        Queries running meanwhile keep using the previous snapshot until the new one is published.
+        Every call starts from the index last saved in index_dir if another process saved a newer one, and every changed index is saved back there and served memory mapped.
+        """
+        self.snapshots.update(self.__build_snapshot)
+        return True
+
+    def memory_usage(self):
+        return self.snapshots.current().memory_usage()
+
+    def export_bundle(self, path):
+        """
+        Writes the current index (documents, metadata, embeddings and BM25 index) with its provenance to a single file, e.g to index a repo once and ship it to serving machines.
+        """
+        snapshot = self.snapshots.current()
+        provenance = {"config": self.config,
+                      "repo_path": os.path.realpath(self.repo_path),
+                      "repo_commit_sha": snapshot.repo_commit_sha,
+                      "index_fingerprint": snapshot.index_fingerprint,
+                      "created": time.time()}
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot.save(directory)
+            write_bundle(path, directory, provenance)
+
+    def import_bundle(self, path, verify=True):
+        """
+        Serves the index of a bundle written by export_bundle(), after checking its checksums and that it was built with the same embedding model and loaders.
+        Files are keyed by their path when indexed, so later index_repo() calls only update it incrementally if the repo is checked out at the same path.
+        """
+        bundle = IndexBundle(path, verify)
+        if bundle.provenance.get("config") != self.config:
+            raise ValueError(f"{path} was built with {bundle.provenance.get('config')}, expected {self.config}")
+        return self.snapshots.update(lambda _: self.__serve_bundle(bundle))
 
     def query_rag(self, query):
-        output = self.qa_llm.invoke({"input": query})
-        return output["answer"]
+        snapshot = self.snapshots.current()  # The whole query runs against one snapshot
+        answer_key = self.query_cache.make_key("answer", query, **self.__cache_params(snapshot),
+                                               llm=RAG_Database.OLLAMA_LLM_MODEL.model, template=RAG_Database.RAG_TEMPLATE)
+        answer = self.query_cache.get("answer", answer_key)
+        if answer is None:
+            answer = self.combine_docs_chain.invoke({"input": query, "context": self.retrieve(query, snapshot)})
+            self.query_cache.set("answer", answer_key, answer)
+        return answer
+
+    def retrieve(self, query, snapshot=None):
+        """
+        Returns the top documents for the query, reusing cached block ids for repeated queries on the same index.
+        With symbols, the blocks defining the symbols a question names (e.g `get_scores` or TaggedJSONSerializer) come first and the dense results fill the rest.
+        With lexical, the dense results are fused with the BM25 ones, both taken from the snapshot's mapped indexes.
+        """
+        snapshot = snapshot or self.snapshots.current()
+        retrieval_key = self.query_cache.make_key("retrieval", query, **self.__cache_params(snapshot))
+        block_ids = self.query_cache.get("retrieval", retrieval_key)
+        if block_ids is None:
+            if snapshot.dense is None:  # Nothing indexed yet
+                return []
+            block_ids = snapshot.symbols.find(query, RAG_Database.TOP_K) if self.symbols else []
+            if len(block_ids) < RAG_Database.TOP_K:
+                query_vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+                k = 2 * RAG_Database.TOP_K if self.lexical else RAG_Database.TOP_K
+                _, found = snapshot.dense.search(query_vector, k)
+                dense_ids = [int(block_id) for block_id in found[0] if block_id != -1]
+                if self.lexical:
+                    dense_ids = weighted_reciprocal_rank([snapshot.lexical_search(query, k), dense_ids], RAG_Database.LEXICAL_WEIGHTS)
+                block_ids = list(dict.fromkeys(block_ids + dense_ids))[:RAG_Database.TOP_K]
+            self.query_cache.set("retrieval", retrieval_key, block_ids)
+        return [snapshot.documents[block_id] for block_id in block_ids if block_id in snapshot.documents]
+
+    def __serve_bundle(self, bundle):
+        self.index_version = None  # Not from index_dir, so index_repo() keeps updating it rather than the saved index
+        return IndexSnapshot.load(bundle.root)
+
+    def __build_snapshot(self, previous):
+        """
+        Builds the next snapshot from a copy of the previous one, embedding only added or changed files.
+        """
+        if self.index_version is not None or (previous.dense is None and not previous.file_digests):
+            previous = self.__load_saved() or previous
+        files = self.__scan_files()
+        deleted = set(previous.file_digests) - set(files)
+        changed = {}
+        for path, loader_cls in files.items():
+            digest = hashlib.sha256(Path(path).read_bytes()).hexdigest()
+            if previous.file_digests.get(path) != digest:
+                changed[path] = (digest, loader_cls(path).load())
+
+        repo_commit_sha = git_helper.get_latest_commit_sha_local(self.repo_path)
+        if not deleted and not changed:  # Keeps a mapped index mapped instead of copying it into memory
+            return IndexSnapshot(previous.dense, previous.documents, previous.file_digests, repo_commit_sha, previous.symbols,
+                                 previous.tokenizer, previous.bm25)
+
+        dense = previous.dense.copy() if previous.dense is not None else None
+        documents = dict(previous.documents)
+        file_digests = dict(previous.file_digests)
+        for path in deleted:
+            if dense is not None:
+                for block_id in dense.remove_file(path):
+                    documents.pop(block_id, None)
+            del file_digests[path]
+
+        # One embedding call for every changed file, which batches far better than a call per file
+        texts = [document.page_content for _, file_documents in changed.values() for document in file_documents]
+        vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32) if texts else None
+        if dense is None and vectors is not None:
+            dense = DenseIndex(vectors.shape[1])
+
+        offset = 0
+        for path, (digest, file_documents) in changed.items():
+            if file_documents:
+                removed, block_ids = dense.upsert_file(path, vectors[offset:offset + len(file_documents)])
+                documents.update(zip(block_ids.tolist(), file_documents))
+                offset += len(file_documents)
+            else:
+                removed = dense.remove_file(path) if dense is not None else []
+            for block_id in removed:
+                documents.pop(block_id, None)
+            file_digests[path] = digest
+
+        # Cache keys are tied to the indexed commit and files, so results of an older index are never served
+        return self.__save(IndexSnapshot(dense, documents, file_digests, repo_commit_sha))
+
+    def __load_saved(self):
+        """
+        Maps the snapshot last saved in index_dir, None if it is the one already served, there is none or it is unreadable.
+        """
+        try:
+            version = (self.index_dir / "CURRENT").read_text().strip()
+            if version == self.index_version:
+                return None
+            snapshot = IndexSnapshot.load(self.index_dir / version)
+        except (OSError, ValueError, KeyError):
+            return None
+        self.index_version = version
+        return snapshot
+
+    def __save(self, snapshot):
+        """
+        Saves the snapshot as the next version in index_dir, then atomically points CURRENT to it so other processes never map a half written index.
+        Writers of every process take a file lock, so versions are numbered in the order they are published.
+        Only versions older than the one replaced are deleted, as another process may have just read CURRENT and be about to map the replaced one. Processes still mapping a deleted version keep its pages until they unmap them.
+        Returns the saved snapshot memory mapped, so the published version shares its pages with every other process serving it.
+        """
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.index_dir / "LOCK", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # Released when the file is closed
+            try:
+                replaced = RAG_Database.version_number((self.index_dir / "CURRENT").read_text().strip())
+            except OSError:
+                replaced = -1
+            version = f"{replaced + 1:012d}"
+            shutil.rmtree(self.index_dir / version, ignore_errors=True)  # Left over by a writer that crashed before publishing it
+            snapshot.save(self.index_dir / version)
+            pointer = self.index_dir / f"CURRENT.{version}"
+            pointer.write_text(version)
+            os.replace(pointer, self.index_dir / "CURRENT")
+            for path in self.index_dir.iterdir():
+                if path.is_dir() and RAG_Database.version_number(path.name) < replaced:
+                    shutil.rmtree(path, ignore_errors=True)
+        self.index_version = version
+        return IndexSnapshot.load(self.index_dir / version)
+
+    @staticmethod
+    def version_number(version):
+        # Versions saved before they were numbered sort first
+        return int(version) if version.isdigit() else -1
+
+    def __scan_files(self):
+        """
+        Returns every file to index with its loader, skipping hidden files and directories like DirectoryLoader.
+        """
+        files = {}
+        root = Path(self.repo_path)
+        for pattern, loader_cls in RAG_Database.LOADERS.items():
+            for path in root.rglob(pattern):
+                if path.is_file() and not any(part.startswith(".") for part in path.relative_to(root).parts):
+                    files[str(path)] = loader_cls
+        return files
+
+    def __cache_params(self, snapshot):
+        return {"k": RAG_Database.TOP_K,
+                "symbols": self.symbols,
+                "lexical": self.lexical,
+                "embedding": self.embeddings.model_name,
+                "repo_commit_sha": snapshot.repo_commit_sha,
+                "index": snapshot.index_fingerprint}
 
 
 # import streamlit as st
@@ -0,0 +1,32 @@
+from typing import Callable, Generic, Optional, TypeVar
+import threading
+
+T = TypeVar("T")
+
+
+class SnapshotHolder(Generic[T]):
+    """
+    Holds the current version of an immutable object (e.g a repo index) shared by many readers.
+
+    Readers call current() and keep using the snapshot they got for the rest of their work, without taking any lock. Assigning a Python reference is atomic, so a reader sees either the old or the new version, never a half updated one.
+    Writers call update() with a function building the next version from the current one. It must not modify the current version, which readers may still be using. Writers are serialized with a lock that readers never touch.
+
+    Once a new version is published the old one is freed by reference counting as soon as its last reader is done with it.
+    """
+    def __init__(self, initial: Optional[T] = None):
+        self._current = initial
+        self._write_lock = threading.Lock()
+        self.version = 0
+
+    def current(self) -> Optional[T]:
+        return self._current
+
+    def update(self, build: Callable[[Optional[T]], T]) -> T:
+        """
+        Builds the next version with build(current) and publishes it. Returns the published version.
+        """
+        with self._write_lock:
+            next_snapshot = build(self._current)
+            self._current = next_snapshot
+            self.version += 1
+        return next_snapshot
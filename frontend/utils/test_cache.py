@@ -0,0 +1,57 @@
+from langchain_core.embeddings import Embeddings
+
+from utils.cache import CachedQueryEmbeddings, QueryCache
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text):
+        self.calls += 1
+        return [float(len(text)), float(text[0].isupper())]
+
+
+def test_keys_normalize_whitespace_but_keep_case():
+    assert QueryCache.make_key("answer", "where is  the\tconfig ", k=5) == QueryCache.make_key("answer", "where is the config", k=5)
+    assert QueryCache.make_key("answer", "Config", k=5) != QueryCache.make_key("answer", "config", k=5)
+    assert QueryCache.make_key("answer", "config", k=5) != QueryCache.make_key("answer", "config", k=6)
+
+
+def test_values_survive_a_restart(tmp_path):
+    cache = QueryCache(tmp_path)
+    key = QueryCache.make_key("retrieval", "load config", sha="abc")
+    assert cache.get("retrieval", key) is None
+    cache.set("retrieval", key, [1, 2, 3])
+    assert cache.get("retrieval", key) == [1, 2, 3]
+
+    reopened = QueryCache(tmp_path)
+    assert reopened.get("retrieval", key) == [1, 2, 3]
+    assert reopened.stats()["retrieval"]["disk_hits"] == 1
+
+
+def test_expired_entries_are_misses(tmp_path):
+    cache = QueryCache(tmp_path, ttls={"answer": -1})
+    key = QueryCache.make_key("answer", "q")
+    cache.set("answer", key, "stale")
+    assert cache.get("answer", key) is None
+    assert cache.purge_expired() == 0  # The expired row was already dropped on read
+
+
+def test_memory_lru_is_bounded(tmp_path):
+    cache = QueryCache(tmp_path, max_memory_entries=2)
+    for i in range(3):
+        cache.set("answer", f"answer:{i}", i)
+    assert list(cache._memory) == ["answer:1", "answer:2"]
+    assert cache.get("answer", "answer:0") == 0  # Still on disk
+
+
+def test_query_embeddings_are_cached_per_exact_text(tmp_path):
+    model = CountingEmbeddings()
+    embeddings = CachedQueryEmbeddings(model, QueryCache(tmp_path))
+    assert embeddings.embed_query("Config") == embeddings.embed_query("Config")
+    assert embeddings.embed_query("config") != embeddings.embed_query("Config")
+    assert model.calls == 2
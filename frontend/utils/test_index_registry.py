@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from utils import index_registry
+from utils.index_registry import CloneRegistry, IndexRegistry
+from utils.rag import DenseIndex, IndexSnapshot
+
+
+class FakeDatabase:
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.indexed = 0
+
+    def index_repo(self):
+        self.indexed += 1
+        return True
+
+    def memory_usage(self):
+        return 100
+
+
+@pytest.fixture
+def commit(monkeypatch):
+    commit = {"sha": "a" * 40}
+    monkeypatch.setattr(index_registry.git_helper, "get_latest_commit_sha_local", lambda repo_path: commit["sha"])
+    return commit
+
+
+def test_conversations_on_one_commit_share_a_database(commit):
+    registry = IndexRegistry(database_factory=FakeDatabase)
+    key, database = registry.acquire("/repo")
+    assert registry.acquire("/repo") == (key, database)
+    assert database.indexed == 1
+    assert registry.stats()[key]["refs"] == 2
+
+
+def test_refresh_moves_to_the_database_of_the_new_commit(commit):
+    registry = IndexRegistry(database_factory=FakeDatabase)
+    old_key, old_database = registry.acquire("/repo")
+    registry.acquire("/repo")  # Another conversation stays on the old commit
+
+    commit["sha"] = "b" * 40
+    new_key, new_database = registry.refresh(old_key, "/repo")
+    assert new_key != old_key and new_database is not old_database
+    assert old_database.indexed == 1 and new_database.indexed == 1
+    stats = registry.stats()
+    assert stats[old_key]["refs"] == 1 and stats[new_key]["refs"] == 1
+
+
+def test_refresh_at_the_same_commit_updates_in_place(commit):
+    registry = IndexRegistry(database_factory=FakeDatabase)
+    key, database = registry.acquire("/repo")
+    assert registry.refresh(key, "/repo") == (key, database)
+    assert database.indexed == 2 and registry.stats()[key]["refs"] == 1
+
+
+def test_idle_databases_are_evicted_over_budget(commit):
+    registry = IndexRegistry(memory_budget=150, database_factory=FakeDatabase)
+    first, _ = registry.acquire("/repo")
+    commit["sha"] = "b" * 40
+    second, _ = registry.acquire("/repo")
+    assert set(registry.stats()) == {first, second}  # Both in use
+    registry.release(first)
+    assert set(registry.stats()) == {second}
+
+
+def test_clones_are_deleted_with_their_last_conversation(tmp_path):
+    clones = CloneRegistry()
+    clone = str(tmp_path / "owner" / "repo")
+    clones.acquire(clone)
+    clones.acquire(clone + "/")
+    assert clones.refs(clone) == 2
+    assert clones.release(clone) is False
+    assert clones.release(clone) is True
+    assert clones.refs(clone) == 0
+
+
+def test_memory_usage_counts_mapped_snapshots(tmp_path):
+    dense = DenseIndex(4)
+    dense.add([0, 1], np.ones((2, 4), dtype=np.float32), "a.py")
+    documents = {0: Document(page_content="def a(): pass", metadata={"block_name": "a"}),
+                 1: Document(page_content="def b(): pass", metadata={"block_name": "b"})}
+    snapshot = IndexSnapshot(dense, documents, {"a.py": "digest"}, "a" * 40)
+    snapshot.save(tmp_path)
+    mapped = IndexSnapshot.load(tmp_path)
+    assert mapped.memory_usage() >= 2 * 4 * 4 + len("def a(): pass") * 2
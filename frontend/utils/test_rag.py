@@ -0,0 +1,180 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from utils import rag
+from utils.cache import QueryCache
+from utils.rag import BM25Index, IndexSnapshot, MappedDenseIndex, RAG_Database
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic bag of words vectors that count the documents embedded, so the tests need no model.
+    """
+    model_name = "hashing"
+
+    def __init__(self):
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = np.zeros(16, dtype=np.float32)
+        for word in text.lower().split():
+            vector[sum(map(ord, word)) % 16] += 1.0
+        return vector.tolist()
+
+
+class LineLoader:
+    """
+    One block per non-empty line.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        with open(self.path) as file:
+            lines = [line.strip() for line in file if line.strip()]
+        return [Document(page_content=line, metadata={"relative_path": self.path, "block_type": "function", "block_name": line.split()[0]})
+                for line in lines]
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.setattr(RAG_Database, "LOADERS", {"*.py": LineLoader})
+    monkeypatch.setattr(rag.git_helper, "get_latest_commit_sha_local", lambda repo_path: "a" * 40)
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "app.py").write_text("run the app\nstop the app\n")
+    (repo / "cli.py").write_text("parse arguments\n")
+    return repo
+
+
+def database(repo, index_dir, embeddings):
+    return RAG_Database(str(repo), embeddings=embeddings, query_cache=QueryCache(), index_dir=index_dir)
+
+
+def versions(index_dir):
+    return sorted(path.name for path in index_dir.iterdir() if path.is_dir())
+
+
+def test_saved_index_is_served_mapped_and_shared(repo, tmp_path):
+    first_embeddings, second_embeddings = HashingEmbeddings(), HashingEmbeddings()
+    first = database(repo, tmp_path / "index", first_embeddings)
+    first.index_repo()
+    assert first_embeddings.embedded == 3
+    assert isinstance(first.snapshots.current().dense, MappedDenseIndex)
+
+    second = database(repo, tmp_path / "index", second_embeddings)
+    second.index_repo()
+    assert second_embeddings.embedded == 0
+    # The BM25 index is loaded with the dense one rather than rebuilt
+    bm25 = second.snapshots.current().bm25
+    assert isinstance(bm25.doc_len, np.memmap) and len(bm25) == 3
+    assert [doc.page_content for doc in second.retrieve("parse arguments")][0] == "parse arguments"
+
+
+def test_newer_versions_of_other_processes_are_picked_up(repo, tmp_path):
+    first_embeddings, second_embeddings = HashingEmbeddings(), HashingEmbeddings()
+    first = database(repo, tmp_path / "index", first_embeddings)
+    second = database(repo, tmp_path / "index", second_embeddings)
+    first.index_repo()
+    second.index_repo()
+
+    (repo / "cli.py").write_text("parse arguments\nprint usage\n")
+    first.index_repo()
+    second.index_repo()
+    assert first_embeddings.embedded == 5 and second_embeddings.embedded == 0
+    assert second.snapshots.current().index_fingerprint == first.snapshots.current().index_fingerprint
+
+
+def test_only_versions_older_than_the_replaced_one_are_deleted(repo, tmp_path):
+    index_dir = tmp_path / "index"
+    index_dir.mkdir()
+    (index_dir / "0123abcd").mkdir()  # Saved before versions were numbered
+    db = database(repo, index_dir, HashingEmbeddings())
+    db.index_repo()
+    for i in range(3):
+        (repo / "cli.py").write_text(f"parse arguments {i}\n")
+        db.index_repo()
+        assert (index_dir / "CURRENT").read_text() == f"{i + 1:012d}"
+        assert versions(index_dir) == [f"{i:012d}", f"{i + 1:012d}"]
+
+
+def test_updating_a_mapped_index_keeps_it_mapped(repo, tmp_path):
+    db = database(repo, tmp_path / "index", HashingEmbeddings())
+    db.index_repo()
+    mapped = db.snapshots.current()
+    (repo / "app.py").unlink()
+    (repo / "main.py").write_text("main entry point\n")
+    db.index_repo()
+
+    snapshot = db.snapshots.current()
+    assert isinstance(snapshot.dense, MappedDenseIndex) and len(snapshot.dense.added) == 0
+    assert sorted(doc.page_content for doc in snapshot.documents.values()) == ["main entry point", "parse arguments"]
+    # The snapshot being replaced was never modified
+    assert len(mapped.dense) == 3 and len(mapped.documents) == 3
+
+
+def test_snapshot_save_and_load_round_trip(tmp_path):
+    dense = rag.DenseIndex(4)
+    dense.add([0, 1], np.eye(4, dtype=np.float32)[:2], "a.py")
+    documents = {0: Document(page_content="def a(): pass", metadata={"block_type": "function", "block_name": "a", "relative_path": "a.py"}),
+                 1: Document(page_content="def b(): return value", metadata={"block_type": "function", "block_name": "b", "relative_path": "a.py"})}
+    snapshot = IndexSnapshot(dense, documents, {"a.py": "digest"}, "a" * 40)
+    snapshot.save(tmp_path)
+    loaded = IndexSnapshot.load(tmp_path)
+    assert loaded.index_fingerprint == snapshot.index_fingerprint and loaded.repo_commit_sha == "a" * 40
+    assert dict(loaded.documents) == documents
+    assert loaded.symbols.lookup("b") == [1]
+    assert loaded.lexical_search("the value", 1) == [1] and isinstance(loaded.bm25, BM25Index)
+    assert loaded.dense.search(np.eye(4, dtype=np.float32)[1], 1)[1].tolist() == [[1]]
+
+
+def test_bundles_round_trip_between_databases(repo, tmp_path):
+    source = database(repo, tmp_path / "source", HashingEmbeddings())
+    source.index_repo()
+    source.export_bundle(tmp_path / "repo.bundle")
+
+    target_embeddings = HashingEmbeddings()
+    target = database(repo, tmp_path / "target", target_embeddings)
+    snapshot = target.import_bundle(tmp_path / "repo.bundle")
+    assert snapshot.index_fingerprint == source.snapshots.current().index_fingerprint
+    assert [doc.page_content for doc in target.retrieve("parse arguments")] == [doc.page_content for doc in source.retrieve("parse arguments")]
+    # The bundle alone serves lexical search too
+    bundled = IndexSnapshot.load(rag.IndexBundle(tmp_path / "repo.bundle").root)
+    assert bundled.documents[bundled.lexical_search("parse", 1)[0]].page_content == "parse arguments"
+    # Unchanged files are not embedded again
+    target.index_repo()
+    assert target_embeddings.embedded == 0
+
+    other = database(repo, tmp_path / "other", HashingEmbeddings())
+    other.config = {**other.config, "embedding": "another-model"}
+    with pytest.raises(ValueError):
+        other.import_bundle(tmp_path / "repo.bundle")
+
+
+def test_symbol_hits_come_before_the_dense_results_when_enabled(repo, tmp_path):
+    plain = database(repo, tmp_path / "index", HashingEmbeddings())
+    plain.index_repo()
+    query = "how does `stop` parse arguments"
+    assert plain.retrieve(query)[0].page_content == "parse arguments"
+
+    symbols = RAG_Database(str(repo), embeddings=HashingEmbeddings(), query_cache=plain.query_cache, index_dir=tmp_path / "index", symbols=True)
+    symbols.index_repo()
+    contents = [doc.page_content for doc in symbols.retrieve(query)]
+    assert contents[0] == "stop the app" and sorted(contents) == ["parse arguments", "run the app", "stop the app"]
+
+
+def test_lexical_results_are_fused_with_the_dense_ones_when_enabled(repo, tmp_path):
+    plain = database(repo, tmp_path / "index", HashingEmbeddings())
+    plain.index_repo()
+    query = "parse args, then stop."  # Only BM25 splits words on punctuation, the hashed vectors only match "parse"
+    assert [doc.page_content for doc in plain.retrieve(query)][:2] == ["parse arguments", "run the app"]
+
+    lexical = RAG_Database(str(repo), embeddings=HashingEmbeddings(), query_cache=plain.query_cache, index_dir=tmp_path / "index", lexical=True)
+    lexical.index_repo()
+    assert [doc.page_content for doc in lexical.retrieve(query)] == ["parse arguments", "stop the app", "run the app"]
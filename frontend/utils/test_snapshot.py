@@ -0,0 +1,48 @@
+import threading
+
+import pytest
+
+from utils.snapshot import SnapshotHolder
+
+
+def test_update_publishes_the_next_version():
+    holder = SnapshotHolder((1,))
+    held = holder.current()
+    assert holder.update(lambda current: current + (2,)) == (1, 2)
+    assert holder.current() == (1, 2) and holder.version == 1
+    # A reader keeps the snapshot it took
+    assert held == (1,)
+
+
+def test_failed_build_publishes_nothing():
+    holder = SnapshotHolder("v0")
+
+    def build(current):
+        raise RuntimeError("embedding failed")
+
+    with pytest.raises(RuntimeError):
+        holder.update(build)
+    assert holder.current() == "v0" and holder.version == 0
+
+
+def test_writers_are_serialized_and_readers_never_block():
+    holder = SnapshotHolder(0)
+    building = threading.Event()
+    release = threading.Event()
+
+    def slow_build(current):
+        building.set()
+        release.wait(5)
+        return current + 1
+
+    writer = threading.Thread(target=holder.update, args=(slow_build,))
+    writer.start()
+    building.wait(5)
+    # Reading while a writer holds the lock returns the old version at once
+    assert holder.current() == 0
+    second = threading.Thread(target=holder.update, args=(lambda current: current + 10,))
+    second.start()
+    release.set()
+    writer.join()
+    second.join()
+    assert holder.current() == 11 and holder.version == 2
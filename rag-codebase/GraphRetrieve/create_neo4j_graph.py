@@ -1,12 +1,38 @@
 from neo4j import GraphDatabase
 import argparse
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from langchain_community.document_loaders import DirectoryLoader
+from pathlib import Path
 from tqdm import tqdm
+from typing import Dict, Iterable, List, Optional
 import argparse
 from python_ast import PythonASTDocumentLoader
+from graph_state import bump_ingestion_version
+import csv
 import re
 import os
+import zlib
+
+DEFAULT_BATCH_SIZE = 5000  # Rows per transaction in batched mode
+DEFAULT_FILES_PER_TRANSACTION = 50  # Files deleted and re-imported per transaction when syncing changed files
+
+# Created before importing so that every MERGE below is an index lookup instead of a label scan.
+# Only File and Calls are unique, the same method name can appear in several classes of a file
+SCHEMA_QUERIES = [
+    "CREATE CONSTRAINT file_path IF NOT EXISTS FOR (n:File) REQUIRE n.path IS UNIQUE",
+    "CREATE CONSTRAINT calls_name IF NOT EXISTS FOR (n:Calls) REQUIRE n.name IS UNIQUE",
+    "CREATE INDEX function_name_path IF NOT EXISTS FOR (n:Function) ON (n.name, n.relative_path)",
+    "CREATE INDEX method_name_path IF NOT EXISTS FOR (n:Method) ON (n.name, n.relative_path)",
+    "CREATE INDEX class_name_path IF NOT EXISTS FOR (n:Class) ON (n.name, n.relative_path)",
+    "CREATE INDEX others_name_path IF NOT EXISTS FOR (n:Others) ON (n.name, n.relative_path)",
+    # Used to find every block of a changed file
+    "CREATE INDEX function_path IF NOT EXISTS FOR (n:Function) ON (n.relative_path)",
+    "CREATE INDEX method_path IF NOT EXISTS FOR (n:Method) ON (n.relative_path)",
+    "CREATE INDEX class_path IF NOT EXISTS FOR (n:Class) ON (n.relative_path)",
+    "CREATE INDEX others_path IF NOT EXISTS FOR (n:Others) ON (n.relative_path)",
+]
 
 # Functions include both class methods and functions
 FUNCTION_QUERY = """
@@ -100,6 +126,127 @@ OTHERS_QUERY = """
     """
 
 
+# Batched versions of the queries above, one row per document: same nodes and relationships, thousands of documents per transaction
+FUNCTION_BATCH_QUERY = """
+    UNWIND $rows AS row
+    MERGE (file:File {path: row.relative_path})
+    MERGE (function:Function {name: row.block_name, relative_path: row.relative_path})
+        ON CREATE SET function.start_offset = row.start_offset, function.end_offset = row.end_offset, function.comments = row.comments, function.docstrings = row.docstrings, function.functions_called = row.functions_called
+    MERGE (function)-[:IN]->(file)
+
+    WITH function, row
+    UNWIND row.functions_called AS called_function
+    MERGE (called_func:Calls {name: called_function})
+    MERGE (function)-[:CALLS]->(called_func)
+    """
+
+METHOD_BATCH_QUERY = """
+    UNWIND $rows AS row
+    MERGE (file:File {path: row.relative_path})
+    MERGE (function:Method {name: row.block_name, relative_path: row.relative_path})
+        ON CREATE SET function.start_offset = row.start_offset, function.end_offset = row.end_offset, function.comments = row.comments, function.docstrings = row.docstrings, function.functions_called = row.functions_called
+    MERGE (class:Class {name: row.parent_name, relative_path: row.relative_path})
+    MERGE (class)-[:DEFINES]->(function)
+    MERGE (function)-[:IN]->(file)
+
+    WITH function, row
+    UNWIND row.functions_called AS called_function
+    MERGE (called_func:Calls {name: called_function})
+    MERGE (function)-[:CALLS]->(called_func)
+    """
+
+CLASS_BATCH_QUERY = """
+    UNWIND $rows AS row
+    MERGE (file:File {path: row.relative_path})
+    MERGE (class:Class {name: row.block_name, relative_path: row.relative_path})
+        ON CREATE SET class.start_offset = row.start_offset, class.end_offset = row.end_offset, class.comments = row.comments, class.docstrings = row.docstrings
+    MERGE (class)-[:IN]->(file)
+
+    WITH class, row
+    UNWIND row.methods AS method_data
+    MERGE (method:Method {name: method_data.block_name, parent_class: row.block_name, relative_path: row.relative_path})
+        ON CREATE SET method.start_offset = method_data.start_offset, method.end_offset = method_data.end_offset, method.comments = method_data.comments, method.docstrings = method_data.docstrings, method.functions_called = method_data.functions_called
+    MERGE (class)-[:DEFINES]->(method)
+    """
+
+OTHERS_BATCH_QUERY = """
+    UNWIND $rows AS row
+    MERGE (file:File {path: row.relative_path})
+    MERGE (others:Others {name: row.block_name, relative_path: row.relative_path})
+        ON CREATE SET others.start_offset = row.start_offset, others.end_offset = row.end_offset, others.comments = row.comments, others.docstrings = row.docstrings, others.functions_called = row.functions_called
+    MERGE (others)-[:IN]->(file)
+
+    WITH others, row
+    UNWIND row.functions_called AS called_function
+    MERGE (called_func:Calls {name: called_function})
+    MERGE (others)-[:CALLS]->(called_func)
+    """
+
+# neo4j-admin database import CSV layout. Every node file uses the global id space, ids are prefixed by label
+ARRAY_DELIMITER = "\x1f"  # Unit separator, unlike the default ";" it never appears in code or docstrings
+BLOCK_HEADER = ["id:ID", "name", "relative_path", "start_offset:int", "end_offset:int", "comments:string[]", "docstrings:string[]"]
+NODE_HEADERS = {
+    "File": ["id:ID", "path"],
+    "Function": BLOCK_HEADER + ["functions_called:string[]"],
+    "Method": BLOCK_HEADER + ["functions_called:string[]", "parent_class"],
+    "Class": BLOCK_HEADER,
+    "Others": BLOCK_HEADER + ["functions_called:string[]"],
+    "Calls": ["id:ID", "name"],
+}
+RELATIONSHIP_TYPES = ("IN", "DEFINES", "CALLS")
+
+# Deletes the subgraph of files: their File node, every block node with their relative_path, and Calls nodes no longer called by anything
+DELETE_FILES_QUERY = """
+    UNWIND $paths AS path
+    CALL {
+        WITH path
+        MATCH (block:Function {relative_path: path}) RETURN block
+        UNION
+        WITH path
+        MATCH (block:Method {relative_path: path}) RETURN block
+        UNION
+        WITH path
+        MATCH (block:Class {relative_path: path}) RETURN block
+        UNION
+        WITH path
+        MATCH (block:Others {relative_path: path}) RETURN block
+    }
+    OPTIONAL MATCH (block)-[:CALLS]->(called:Calls)
+    WITH collect(DISTINCT block) AS blocks, collect(DISTINCT called) AS called
+    FOREACH (block IN blocks | DETACH DELETE block)
+
+    WITH called
+    OPTIONAL MATCH (file:File) WHERE file.path IN $paths
+    DETACH DELETE file
+
+    WITH DISTINCT called
+    UNWIND called AS calls
+    WITH calls WHERE NOT EXISTS { (calls)<-[:CALLS]-() }
+    DELETE calls
+    """
+
+BLOCK_QUERIES = {"function": FUNCTION_QUERY, "method": METHOD_QUERY, "class": CLASS_QUERY, "others": OTHERS_QUERY}
+BATCH_QUERIES = {"function": FUNCTION_BATCH_QUERY, "method": METHOD_BATCH_QUERY, "class": CLASS_BATCH_QUERY, "others": OTHERS_BATCH_QUERY}
+
+
+def block_kind(metadata) -> Optional[str]:
+    """
+    Returns which node a document becomes: "function", "method", "class" or "others", None if unknown.
+    """
+    if metadata["block_type"] == "function":
+        if metadata["parent_type"] == "root":
+            return "function"
+        elif metadata["parent_type"] == "class":
+            return "method"
+        else:
+            print("Unknown parent for function block type")
+            return None
+    elif metadata["block_type"] in ("class", "others"):
+        return metadata["block_type"]
+    print("Unknown block type")
+    return None
+
+
 # Function to import a JSON object into Neo4j
 def import_metadata(tx, metadata):
     """
@@ -161,23 +308,209 @@ def import_metadata(tx, metadata):
 
 
     """
-    if metadata["block_type"] == "function":
-        if metadata["parent_type"] == "root":
-            query = FUNCTION_QUERY
-        elif metadata["parent_type"] == "class":
-            query = METHOD_QUERY 
-        else:
-            print("Unknown parent for function block type")
-            return
-    elif metadata["block_type"] == "class": 
-        query = CLASS_QUERY
-    elif metadata["block_type"] == "others":
-        query = OTHERS_QUERY
-    else:
-        print("Unknown block type")
+    kind = block_kind(metadata)
+    if kind is None:
         return
 
-    tx.run(query, **metadata)
+    tx.run(BLOCK_QUERIES[kind], **metadata)
+
+
+def create_schema(session):
+    """
+    Creates the constraints and indexes the import queries look nodes up with. Safe to run on an existing graph.
+    """
+    for query in SCHEMA_QUERIES:
+        session.run(query).consume()
+
+
+def group_by_kind(metadatas: Iterable[Dict]) -> Dict[str, List[Dict]]:
+    """
+    Groups document metadata into rows per node kind, so that each batch runs a single query.
+    """
+    rows = defaultdict(list)
+    for metadata in metadatas:
+        kind = block_kind(metadata)
+        if kind is not None:
+            rows[kind].append(metadata)
+    return rows
+
+
+def import_batch(tx, kind, rows):
+    """
+    tx represents a Neo4j transaction. Imports rows of document metadata of one node kind (see block_kind) with a single UNWIND query.
+    """
+    tx.run(BATCH_QUERIES[kind], rows=rows).consume()
+
+
+def import_batched(driver, database, metadatas: List[Dict], batch_size: int = DEFAULT_BATCH_SIZE, workers: int = 1):
+    """
+    Imports document metadata in batches of batch_size rows per transaction, after creating the schema.
+
+    With several workers, files are split between writer sessions running in parallel (a file always goes to one worker, so workers never merge the same File, Class or block nodes).
+    Workers may still merge the same Calls node concurrently, the resulting lock conflicts are transient errors that execute_write retries.
+    driver is anything with a session(database=...) context manager providing run() and execute_write(), e.g neo4j.GraphDatabase.driver().
+    """
+    with driver.session(database=database) as session:
+        create_schema(session)
+
+    partitions = [[] for _ in range(max(workers, 1))]
+    for metadata in metadatas:
+        partitions[zlib.crc32(str(metadata["relative_path"]).encode()) % len(partitions)].append(metadata)
+
+    batches = [[(kind, rows[start:start + batch_size]) for kind, rows in group_by_kind(partition).items()
+                for start in range(0, len(rows), batch_size)] for partition in partitions]
+    progress = tqdm(total=sum(len(worker_batches) for worker_batches in batches), desc="Graphing Batches...")
+
+    def write(worker_batches):
+        with driver.session(database=database) as session:
+            for kind, rows in worker_batches:
+                session.execute_write(import_batch, kind, rows)
+                progress.update(1)
+
+    with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+        list(executor.map(write, batches))  # Re-raises the first error of any worker
+    progress.close()
+
+
+def sync_batch(tx, paths, metadatas):
+    """
+    tx represents a Neo4j transaction. Replaces the subgraph of the given files with the given document metadata (none for deleted files).
+    """
+    tx.run(DELETE_FILES_QUERY, paths=paths).consume()
+    for kind, rows in group_by_kind(metadatas).items():
+        import_batch(tx, kind, rows)
+
+
+def sync_files(driver, database, paths: List[str], files_per_transaction: int = DEFAULT_FILES_PER_TRANSACTION):
+    """
+    Incrementally updates the graph after code changes: the subgraph of every given file is deleted and the file re-imported if it still exists, in one transaction per batch of files.
+    Unlike re-running the import (which only MERGEs), changed blocks get their new offsets and comments, and deleted blocks, files and Calls nodes disappear.
+    Paths must be spelled like the relative_path of the graph, i.e the import directory joined with the path within the repo.
+    """
+    with driver.session(database=database) as session:
+        create_schema(session)
+        for start in tqdm(range(0, len(paths), files_per_transaction), desc="Syncing Files..."):
+            batch = paths[start:start + files_per_transaction]
+            # Parse outside the transaction function, which the driver may retry
+            metadatas = [document.metadata for path in batch if os.path.isfile(path) for document in PythonASTDocumentLoader(path).load()]
+            session.execute_write(sync_batch, batch, metadatas)
+
+
+class BulkImportWriter:
+    """
+    Streams document metadata into the node and relationship CSV files of neo4j-admin database import, to build the graph of a very large repo offline in one bulk import instead of running Cypher.
+
+    The graph has the same nodes and relationships as the import queries, deduplicated on the keys they MERGE on (the first document of a node sets its properties, like ON CREATE SET).
+    Unlike the queries, a method is a single Method node keyed by its class, whether it was seen through its class or on its own.
+    Rows are written as documents arrive. Every node but Calls belongs to one file, so only the keys of the current file are kept in memory, which requires the documents of a file to arrive together (as loaders yield them).
+    Calls nodes are shared between files and written once per file, the import command skips the duplicates.
+    """
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.files = {}
+        self.writers = {}
+        for name in list(NODE_HEADERS) + list(RELATIONSHIP_TYPES):
+            self.files[name] = open(self.directory / f"{name}.csv", "w", newline="", encoding="utf-8")
+            self.writers[name] = csv.writer(self.files[name])
+            self.writers[name].writerow(NODE_HEADERS.get(name, [":START_ID", ":END_ID"]))
+        self.path = None  # File of the keys below
+        self.nodes = set()
+        self.relationships = set()
+        self.bare_classes = {}  # Classes only referenced by methods so far, written once their file is done if never loaded
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, metadata):
+        """
+        Adds the nodes and relationships of one document.
+        """
+        kind = block_kind(metadata)
+        if kind is None:
+            return
+        path = str(metadata["relative_path"])
+        if path != self.path:
+            self.__finish_file()
+            self.path = path
+        file_id = self.__node("File", f"File|{path}", [path])
+
+        if kind == "class":
+            block_id = self.__block("Class", metadata, f"Class|{path}|{metadata['block_name']}")
+            self.bare_classes.pop(block_id, None)
+            for method in metadata.get("methods", []):
+                self.__relationship("DEFINES", block_id, self.__method(method, metadata["block_name"], path))
+        elif kind == "method":
+            block_id = self.__method(metadata, metadata["parent_name"], path)
+            class_id = f"Class|{path}|{metadata['parent_name']}"
+            if class_id not in self.nodes:
+                self.bare_classes[class_id] = [class_id, metadata["parent_name"], path, "", "", "", ""]
+            self.__relationship("DEFINES", class_id, block_id)
+        else:
+            label = "Function" if kind == "function" else "Others"
+            block_id = self.__block(label, metadata, f"{label}|{path}|{metadata['block_name']}", [self.__array(metadata.get("functions_called", []))])
+        self.__relationship("IN", block_id, file_id)
+
+        if kind != "class":
+            for called in metadata.get("functions_called", []):
+                self.__relationship("CALLS", block_id, self.__node("Calls", f"Calls|{called}", [called]))
+
+    def close(self):
+        self.__finish_file()
+        for file in self.files.values():
+            file.close()
+
+    def import_command(self, database):
+        """
+        Returns the neo4j-admin command importing the written files into a new database.
+        """
+        nodes = " ".join(f"--nodes={label}={self.directory / label}.csv" for label in NODE_HEADERS)
+        relationships = " ".join(f"--relationships={rel_type}={self.directory / rel_type}.csv" for rel_type in RELATIONSHIP_TYPES)
+        return (f"neo4j-admin database import full --overwrite-destination --multiline-fields=true --array-delimiter=U+001F --skip-duplicate-nodes=true "
+                f"{nodes} {relationships} {database}")
+
+    def __finish_file(self):
+        for row in self.bare_classes.values():
+            self.__node("Class", row[0], row[1:])
+        self.bare_classes.clear()
+        self.nodes.clear()
+        self.relationships.clear()
+
+    def __node(self, label, node_id, properties):
+        if node_id not in self.nodes:
+            self.nodes.add(node_id)
+            self.writers[label].writerow([node_id] + properties)
+        return node_id
+
+    def __block(self, label, metadata, node_id, extra=()):
+        return self.__node(label, node_id, [metadata["block_name"], str(metadata["relative_path"]), metadata["start_offset"], metadata["end_offset"],
+                                            self.__array(metadata.get("comments", [])), self.__array(metadata.get("docstrings", []))] + list(extra))
+
+    def __method(self, metadata, class_name, path):
+        return self.__block("Method", metadata, f"Method|{path}|{class_name}|{metadata['block_name']}",
+                            [self.__array(metadata.get("functions_called", [])), class_name])
+
+    def __relationship(self, rel_type, start_id, end_id):
+        if (rel_type, start_id, end_id) not in self.relationships:
+            self.relationships.add((rel_type, start_id, end_id))
+            self.writers[rel_type].writerow([start_id, end_id])
+
+    @staticmethod
+    def __array(values):
+        return ARRAY_DELIMITER.join(str(value).replace(ARRAY_DELIMITER, " ") for value in values)
+
+
+def export_bulk_import(documents, directory, database):
+    """
+    Writes the import files of the documents (any iterable, e.g a lazy loader) to directory and returns the neo4j-admin command to run.
+    """
+    with BulkImportWriter(directory) as writer:
+        for document in tqdm(documents, desc="Writing import files..."):
+            writer.add(document.metadata)
+    return writer.import_command(database)
 
 
 def parse_args():
@@ -186,6 +519,13 @@ def parse_args():
     parser.add_argument("username", type=str, help="Neo4J database username", default="neo4j")
     parser.add_argument("password", type=str, help="Neo4J database password", default="neo4j")
     parser.add_argument("database", type=str, help="Neo4J database", default="testing")
+    parser.add_argument("--uri", type=str, default="bolt://localhost:7687", help="Neo4J connection URI")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Documents per transaction")
+    parser.add_argument("--workers", type=int, default=1, help="Writer sessions importing in parallel")
+    parser.add_argument("--per-document", action="store_true", help="Import one document per transaction without creating the schema (slow, previous behavior)")
+    parser.add_argument("--offline", type=str, default=None, help="Write neo4j-admin import CSV files to this directory instead of connecting to Neo4J")
+    parser.add_argument("--mark-imported", action="store_true", help="Only record that the files written by --offline were imported, so graph retrievers refresh their schema")
+    parser.add_argument("--changed", type=str, nargs="+", default=None, help="Only re-import these files (paths within the directory, deleted files included) instead of the whole directory")
     
     args = parser.parse_args()
 
@@ -194,10 +534,39 @@ def parse_args():
         raise ValueError(f"The provided repository path '{args.directory}' does not exist.")
     return args
 
+def mark_changed(driver, database) -> str:
+    """
+    Bumps the ingestion version stored in the graph (see graph_state.py), so graph retrievers on every machine refresh their schema snapshot.
+    """
+    with driver.session(database=database) as session:
+        return bump_ingestion_version(lambda query: session.run(query).data())
+
+
 def main():
     args = parse_args()
+    if args.mark_imported:
+        driver = GraphDatabase.driver(args.uri, auth=(args.username, args.password))
+        mark_changed(driver, args.database)
+        driver.close()
+        return
+    if args.changed:
+        driver = GraphDatabase.driver(args.uri, auth=(args.username, args.password))
+        # DirectoryLoader names files by joining the directory with their path in it, so the graph does too
+        sync_files(driver, args.database, [str(Path(args.directory) / path) for path in args.changed if path.endswith(".py")])
+        mark_changed(driver, args.database)
+        driver.close()
+        return
+
     loader = DirectoryLoader(args.directory, glob="*.py", loader_cls=PythonASTDocumentLoader, recursive=True)
 
+    if args.offline:
+        # Streams documents straight into the files, the repo is never held in memory
+        command = export_bulk_import(loader.lazy_load(), args.offline, args.database)
+        # The graph only changes once the command ran, --mark-imported bumps the ingestion version then
+        print(f"Import files written to {args.offline}, stop the database and run:\n{command}\n"
+              f"Once imported, run this script again with --mark-imported so graph retrievers refresh their schema.")
+        return
+
     try:
         documents = loader.load()
         print(f"Loaded {len(documents)} documents from {args.directory})")
@@ -206,12 +575,17 @@ def main():
         raise e
 
     # Initialize Neo4j driver
-    uri = "bolt://localhost:7687"
-    driver = GraphDatabase.driver(uri, auth=(args.username, args.password))
+    driver = GraphDatabase.driver(args.uri, auth=(args.username, args.password))
 
-    with driver.session(database=args.database) as session:
-        for document in tqdm(documents, desc="Graphing Documents..."):
-            session.execute_write(import_metadata, document.metadata)
+    if args.per_document:
+        with driver.session(database=args.database) as session:
+            for document in tqdm(documents, desc="Graphing Documents..."):
+                session.execute_write(import_metadata, document.metadata)
+    else:
+        import_batched(driver, args.database, [document.metadata for document in documents], args.batch_size, args.workers)
+    # Graph retrievers reuse their saved schema snapshot until this changes
+    mark_changed(driver, args.database)
+    driver.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
+from langchain_core.example_selectors import BaseExampleSelector
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from typing import Dict, List, Optional, Sequence
+import hashlib
+import threading
+import numpy as np
+
+DEFAULT_MAX_CACHED_QUERIES = 1024
+DEFAULT_NUM_EXAMPLES = 3
+
+
+def normalize_question(question: str) -> str:
+    """
+    Normalizes a question so trivially different phrasings (casing, extra whitespace, trailing punctuation) share a cache entry.
+    """
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+
+def schema_version(schema: str) -> str:
+    """
+    Short hash of a schema description, so generated Cypher is never reused once the graph schema changes.
+    """
+    return hashlib.sha256(schema.encode()).hexdigest()[:16]
+
+
+class CypherCache:
+    """
+    In-process LRU cache of the Cypher generated per (schema version, normalized question).
+    A hit skips the example selection and the LLM call of the Cypher generation step entirely.
+    """
+    def __init__(self, max_entries: int = DEFAULT_MAX_CACHED_QUERIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(question: str, version: str) -> str:
+        return f"{version}:{normalize_question(question)}"
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            cypher = self._entries.get(key)
+            if cypher is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return cypher
+
+    def put(self, key: str, cypher: str):
+        with self._lock:
+            self._entries[key] = cypher
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def wrap(self, generation_chain: Runnable) -> Runnable:
+        """
+        Wraps the Cypher generation chain of a GraphCypherQAChain (inputs question and schema, output the generated Cypher) so that it only runs on a cache miss.
+        The schema the chain is invoked with is part of the key.
+        """
+        def generate(inputs: Dict, config: RunnableConfig) -> str:
+            key = self.make_key(inputs["question"], schema_version(inputs.get("schema", "")))
+            cypher = self.get(key)
+            if cypher is None:
+                cypher = generation_chain.invoke(inputs, config)
+                self.put(key, cypher)
+            return cypher
+        return RunnableLambda(generate)
+
+
+class VectorExampleSelector(BaseExampleSelector):
+    """
+    Picks the k few-shot examples whose questions are most similar to the input question.
+
+    The example questions are embedded once when the selector is created and kept as one normalized matrix, so selecting costs a single query embedding and a matrix-vector product.
+    Unlike SemanticSimilarityExampleSelector it needs no vector store.
+    """
+    def __init__(self, examples: Sequence[Dict[str, str]], embeddings: Embeddings, k: int = DEFAULT_NUM_EXAMPLES, input_key: str = "question"):
+        self.embeddings = embeddings
+        self.k = k
+        self.input_key = input_key
+        self.examples: List[Dict[str, str]] = list(examples)
+        self.vectors = self.__normalize(self.embeddings.embed_documents([example[input_key] for example in self.examples]))
+
+    def add_example(self, example: Dict[str, str]):
+        self.examples.append(example)
+        vector = self.__normalize([self.embeddings.embed_query(example[self.input_key])])
+        self.vectors = np.vstack((self.vectors, vector)) if len(self.vectors) else vector
+
+    def select_examples(self, input_variables: Dict[str, str]) -> List[Dict[str, str]]:
+        """
+        Returns the k most similar examples, most similar first.
+        """
+        k = min(self.k, len(self.examples))
+        if k == 0:
+            return []
+        scores = self.vectors @ self.__normalize([self.embeddings.embed_query(input_variables[self.input_key])])[0]
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [self.examples[i] for i in top[np.argsort(-scores[top])].tolist()]
+
+    @staticmethod
+    def __normalize(vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2:  # No examples
+            return vectors.reshape(0, 0)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
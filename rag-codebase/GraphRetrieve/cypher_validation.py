@@ -0,0 +1,209 @@
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+from typing import Any, Dict, Iterable, List, Optional, Set
+import re
+
+DEFAULT_MAX_ROWS = 100  # Rows returned to the QA prompt, more would not fit in its context anyway
+DEFAULT_MAX_ESTIMATED_ROWS = 1_000_000  # Largest row estimate of any operator in the EXPLAIN plan
+
+CODE_BLOCK_PATTERN = re.compile(r"```(?:cypher)?(.*?)```", re.DOTALL | re.IGNORECASE)
+MASK_PATTERN = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|//[^\n]*|/\*.*?\*/", re.DOTALL)
+NODE_PATTERN = re.compile(r"\(\s*(?P<variable>[A-Za-z_]\w*)?\s*(?P<names>:[^(){}\[\]]*?)?\s*(?P<properties>\{[^{}]*\})?\s*\)")
+RELATIONSHIP_PATTERN = re.compile(r"\[\s*(?P<variable>[A-Za-z_]\w*)?\s*(?P<names>:[^\[\]{}*]*?)?\s*(?:\*[\d.\s]*)?\s*(?P<properties>\{[^{}]*\})?\s*\]")
+MAP_KEY_PATTERN = re.compile(r"([A-Za-z_]\w*|`[^`]+`)\s*:")
+PROPERTY_ACCESS_PATTERN = re.compile(r"\b([A-Za-z_]\w*)\.([A-Za-z_]\w*|`[^`]+`)(?!\s*\()")
+PATTERN_CLAUSE_PATTERN = re.compile(r"\b(?:OPTIONAL\s+MATCH|MATCH|MERGE|CREATE)\b", re.IGNORECASE)
+CLAUSE_KEYWORD_PATTERN = re.compile(r"\b(?:WHERE|WITH|RETURN|UNWIND|SET|ON|DELETE|DETACH|REMOVE|FOREACH|CALL|UNION|ORDER|SKIP|LIMIT|OPTIONAL|MATCH|MERGE|CREATE|YIELD|USING)\b",
+                                    re.IGNORECASE)
+RETURN_PATTERN = re.compile(r"\bRETURN\b", re.IGNORECASE)
+LIMIT_PATTERN = re.compile(r"\bLIMIT\s+(\d+|\$\w+)", re.IGNORECASE)
+UNION_PATTERN = re.compile(r"\bUNION(?:\s+ALL)?\b", re.IGNORECASE)
+
+
+class CypherValidationError(ValueError):
+    """
+    Raised for generated Cypher that is rejected before it is sent to the database.
+    """
+
+
+def extract_cypher(text: str) -> str:
+    """
+    Returns the query of an LLM answer, the content of its first code block if it has one.
+    """
+    match = CODE_BLOCK_PATTERN.search(text)
+    return (match.group(1) if match else text).strip().rstrip(";").strip()
+
+
+def mask_literals(cypher: str) -> str:
+    """
+    Blanks out string literals and comments without moving anything, so patterns found in the result are at the same positions in the query.
+    """
+    return MASK_PATTERN.sub(lambda match: match.group(0)[0] + " " * (len(match.group(0)) - 2) + match.group(0)[-1]
+                            if match.group(0)[0] in "'\"" else " " * len(match.group(0)), cypher)
+
+
+def pattern_clauses(masked: str) -> List[str]:
+    """
+    Returns the patterns of the MATCH, OPTIONAL MATCH, MERGE and CREATE clauses of a query (with its literals masked), each up to its next clause or the end of its subquery.
+    Parentheses elsewhere, such as WHERE (n:Function OR n:Method) or collect({file: f.path}), are expressions rather than node patterns.
+    """
+    clauses = []
+    for clause in PATTERN_CLAUSE_PATTERN.finditer(masked):
+        depth, end = 0, clause.end()
+        while end < len(masked):
+            if masked[end] in "([{":
+                depth += 1
+            elif masked[end] in ")]}":
+                if depth == 0:
+                    break
+                depth -= 1
+            elif depth == 0 and CLAUSE_KEYWORD_PATTERN.match(masked, end):
+                break
+            end += 1
+        clauses.append(masked[clause.end():end])
+    return clauses
+
+
+def top_level(pattern: re.Pattern, masked: str) -> List[re.Match]:
+    """
+    Matches of a pattern outside of any parentheses, brackets or braces, i.e not in a subquery.
+    """
+    depth, depths = 0, []
+    for char in masked:
+        depths.append(depth)
+        depth += (char in "([{") - (char in ")]}")
+    return [match for match in pattern.finditer(masked) if depths[match.start()] == 0]
+
+
+def _names(expression: Optional[str]) -> Set[str]:
+    """
+    Labels or relationship types of a label expression such as ":Function", ":IN|CALLS" or ":`My Label`".
+    """
+    if not expression:
+        return set()
+    return {name.strip().strip("`") for name in re.split(r"[:|&!()%]", expression) if name.strip()}
+
+
+class CypherValidator:
+    """
+    Checks generated Cypher against a Neo4jGraph structured_schema locally, before it reaches the database:
+    - every label, relationship type and property in the node and relationship patterns of MATCH, OPTIONAL MATCH, MERGE and CREATE clauses must exist in the schema
+    - properties read from a pattern variable (f.name) must exist on its labels (or types), or on any of them for a variable without one
+    - the rows returned are capped by adding a LIMIT to (or lowering the LIMIT of) the final RETURN of every top level UNION part
+    - with a driver, EXPLAIN plans the query without running it, rejecting queries the planner expects to produce more than max_estimated_rows rows at any step
+
+    Variables introduced by WITH ... AS or UNWIND are not tracked, properties read from them are not checked.
+    Neither are label predicates in WHERE (n:Function) and patterns outside of those clauses (EXISTS { (n)-[:CALLS]->() }).
+    A LIMIT given as a parameter is kept, generated Cypher is run without parameters.
+    """
+    def __init__(self, structured_schema: Dict[str, Any], max_rows: Optional[int] = DEFAULT_MAX_ROWS, driver=None, database: Optional[str] = None,
+                 max_estimated_rows: float = DEFAULT_MAX_ESTIMATED_ROWS):
+        self.max_rows = max_rows
+        self.driver = driver
+        self.database = database
+        self.max_estimated_rows = max_estimated_rows
+
+        self.label_properties: Dict[str, Set[str]] = {label: {prop["property"] for prop in props}
+                                                      for label, props in structured_schema.get("node_props", {}).items()}
+        self.type_properties: Dict[str, Set[str]] = {rel_type: {prop["property"] for prop in props}
+                                                     for rel_type, props in structured_schema.get("rel_props", {}).items()}
+        for relationship in structured_schema.get("relationships", []):
+            self.label_properties.setdefault(relationship["start"], set())
+            self.label_properties.setdefault(relationship["end"], set())
+            self.type_properties.setdefault(relationship["type"], set())
+        self.node_properties = set().union(*self.label_properties.values())
+        self.relationship_properties = set().union(*self.type_properties.values())
+
+    def check(self, cypher: str):
+        """
+        Raises CypherValidationError for unknown labels, relationship types and properties.
+        """
+        masked = mask_literals(cypher)
+        variables: Dict[str, Set[str]] = {}  # Pattern variable -> properties it can have
+        labeled: Set[str] = set()  # Variables seen with a label or type, bare ones (e.g count(f)) may be anything
+        clauses = pattern_clauses(masked)
+        for pattern, known, kind in ((NODE_PATTERN, self.label_properties, "label"), (RELATIONSHIP_PATTERN, self.type_properties, "relationship type")):
+            for match in (match for clause in clauses for match in pattern.finditer(clause)):
+                names = _names(match.group("names"))
+                unknown = sorted(names - known.keys())
+                if unknown:
+                    raise CypherValidationError(f"Unknown {kind} {', '.join(unknown)}, expected one of {', '.join(sorted(known))}")
+                properties = set().union(*(known[name] for name in names)) if names else set().union(*known.values())
+                self.__check_properties((key.strip("`") for key in MAP_KEY_PATTERN.findall(match.group("properties") or "")), properties, names or {kind})
+
+                variable = match.group("variable")
+                if variable and names:
+                    variables[variable] = variables[variable] | properties if variable in labeled else properties
+                    labeled.add(variable)
+                elif variable:
+                    variables.setdefault(variable, self.node_properties | self.relationship_properties)
+
+        for variable, prop in PROPERTY_ACCESS_PATTERN.findall(masked):
+            if variable in variables:
+                self.__check_properties([prop.strip("`")], variables[variable], {variable})
+
+    def limit(self, cypher: str) -> str:
+        """
+        Returns the query with the rows of its final RETURN (of every UNION part) capped at max_rows.
+        """
+        if self.max_rows is None:
+            return cypher
+        masked = mask_literals(cypher)
+        parts, start = [], 0
+        for match in top_level(UNION_PATTERN, masked) + [None]:
+            end = match.start() if match else len(cypher)
+            parts.append(self.__limit_part(cypher[start:end], masked[start:end]))
+            if match:
+                parts.append(cypher[match.start():match.end()])
+                start = match.end()
+        return "".join(parts)
+
+    def estimated_rows(self, cypher: str) -> float:
+        """
+        Returns the largest number of rows the planner expects any operator of the query to produce, without running it.
+        """
+        with self.driver.session(database=self.database) as session:
+            plan = session.run(f"EXPLAIN {cypher}").consume().plan
+
+        def largest(operator) -> float:
+            return max([float(operator.get("args", {}).get("EstimatedRows", 0))] + [largest(child) for child in operator.get("children", [])])
+        return largest(plan) if plan else 0.0
+
+    def validate(self, cypher: str) -> str:
+        """
+        Returns the query with its rows limited, raising CypherValidationError if it is rejected.
+        """
+        cypher = extract_cypher(cypher)
+        self.check(cypher)
+        cypher = self.limit(cypher)
+        if self.driver is not None:
+            estimate = self.estimated_rows(cypher)
+            if estimate > self.max_estimated_rows:
+                raise CypherValidationError(f"Query is estimated to produce {estimate:.0f} rows, more than the budget of {self.max_estimated_rows:.0f}")
+        return cypher
+
+    def wrap(self, generation_chain: Runnable) -> Runnable:
+        """
+        Wraps the Cypher generation chain of a GraphCypherQAChain so that it returns validated Cypher (see validate()), or raises before the query is run.
+        """
+        def generate(inputs: Dict, config: RunnableConfig) -> str:
+            return self.validate(generation_chain.invoke(inputs, config))
+        return RunnableLambda(generate)
+
+    def __check_properties(self, names: Iterable[str], properties: Set[str], owners: Set[str]):
+        for name in names:
+            if name not in properties:
+                raise CypherValidationError(f"Unknown property {name} of {', '.join(sorted(owners))}, expected one of {', '.join(sorted(properties))}")
+
+    def __limit_part(self, cypher: str, masked: str) -> str:
+        returns = top_level(RETURN_PATTERN, masked)
+        if not returns:
+            return cypher
+        tail = masked[returns[-1].end():]
+        limit = LIMIT_PATTERN.search(tail)
+        if limit is None:
+            stripped = cypher.rstrip()
+            return f"{stripped} LIMIT {self.max_rows}{cypher[len(stripped):]}"
+        if limit.group(1).startswith("$") or int(limit.group(1)) <= self.max_rows:
+            return cypher
+        offset = returns[-1].end()
+        return cypher[:offset + limit.start(1)] + str(self.max_rows) + cypher[offset + limit.end(1):]
@@ -0,0 +1,65 @@
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+import hashlib
+import json
+import os
+import platform
+import tempfile
+
+# Local cache of graph schemas, per machine. Whether a cached schema is still valid is decided by the version stored in the graph
+DEFAULT_STATE_DIR = Path("/tmp" if platform.system() == "Darwin" else tempfile.gettempdir()) / "codebase-rag-graph"
+
+# The version lives on a single IngestionState node of the graph, so an import from any machine invalidates the snapshots of every retriever.
+# It is a random id rather than a counter, so that a database wiped and imported again (e.g by neo4j-admin) never repeats an old version
+INGESTION_VERSION_QUERY = "OPTIONAL MATCH (state:IngestionState {name: 'graph'}) RETURN state.version AS version"
+BUMP_INGESTION_VERSION_QUERY = "MERGE (state:IngestionState {name: 'graph'}) SET state.version = randomUUID() RETURN state.version AS version"
+
+Query = Callable[[str], List[Dict[str, Any]]]  # Runs a Cypher query and returns its records as dicts, e.g Neo4jGraph.query
+
+
+def _state_path(uri: str, database: str, suffix: str, state_dir: Path) -> Path:
+    return Path(state_dir) / f"{hashlib.sha256(f'{uri}/{database}'.encode()).hexdigest()[:16]}.{suffix}"
+
+
+def _write_json(path: Path, data: Dict[str, Any]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = Path(f"{path}.tmp")
+    with open(temporary, "w") as file:
+        json.dump(data, file, default=str)
+    os.replace(temporary, path)  # Readers never see a partially written file
+
+
+def ingestion_version(query: Query) -> Optional[str]:
+    """
+    Returns the version of the graph stored in the database, None if it was never imported.
+    """
+    records = query(INGESTION_VERSION_QUERY)
+    return records[0]["version"] if records else None
+
+
+def bump_ingestion_version(query: Query) -> str:
+    """
+    Called by the ingestion after every change to the graph, so retrievers refresh their schema snapshot on their next start.
+    """
+    return query(BUMP_INGESTION_VERSION_QUERY)[0]["version"]
+
+
+def load_schema_snapshot(uri: str, database: str, enhanced_schema: bool, version: Optional[str],
+                         state_dir: Path = DEFAULT_STATE_DIR) -> Optional[Dict[str, Any]]:
+    """
+    Returns the saved schema (the schema string and structured_schema of a Neo4jGraph) if it was taken at the given ingestion version (see ingestion_version()), otherwise None.
+    """
+    try:
+        with open(_state_path(uri, database, "schema.json", state_dir), "r") as file:
+            snapshot = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+    if snapshot.get("version") != version or snapshot.get("enhanced_schema") != enhanced_schema:
+        return None
+    return snapshot
+
+
+def save_schema_snapshot(uri: str, database: str, enhanced_schema: bool, version: Optional[str], schema: str, structured_schema: Dict[str, Any],
+                         state_dir: Path = DEFAULT_STATE_DIR):
+    _write_json(_state_path(uri, database, "schema.json", state_dir),
+                {"version": version, "enhanced_schema": enhanced_schema, "schema": schema, "structured_schema": structured_schema})
@@ -1,59 +1,62 @@
-from langchain_community.document_loaders import DirectoryLoader
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_ollama import OllamaLLM
-from langchain_anthropic import ChatAnthropic
 from langchain_core.prompts import PromptTemplate, FewShotPromptTemplate
 from langchain_neo4j import GraphCypherQAChain, Neo4jGraph
-import numpy as np
-from langchain.chains import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_community.vectorstores import Neo4jVector
-from langchain_core.example_selectors import SemanticSimilarityExampleSelector
-import os
-from python_ast import PythonASTDocumentLoader
-import re
+from cypher_generation import DEFAULT_NUM_EXAMPLES, CypherCache, VectorExampleSelector
+from cypher_validation import CypherValidationError, CypherValidator
+from graph_state import ingestion_version, load_schema_snapshot, save_schema_snapshot
 import neo4j
 
-folderPath = os.getcwd()+"/vectorDB"
-
 
+def connect_graph(url: str, username: str, password: str, database: str = "neo4j", enhanced_schema: bool = True) -> Neo4jGraph:
+    """
+    Connects to the graph without reading its schema from the database, unless it was re-imported (from any machine) since the schema snapshot was saved.
+    The Neo4jGraph holds one pooled driver, create it once and share it between questions.
+    """
+    graph = Neo4jGraph(url=url, username=username, password=password, database=database,
+                       enhanced_schema=enhanced_schema, refresh_schema=False)
+    version = ingestion_version(graph.query)
+    snapshot = load_schema_snapshot(url, database, enhanced_schema, version)
+    if snapshot is None:
+        graph.refresh_schema()
+        save_schema_snapshot(url, database, enhanced_schema, version, graph.schema, graph.structured_schema)
+    else:
+        graph.schema, graph.structured_schema = snapshot["schema"], snapshot["structured_schema"]
+    return graph
+
+
+# Only used to embed the few-shot example questions and each new question
 embeddings = HuggingFaceEmbeddings(
     model_name="sentence-transformers/multi-qa-mpnet-base-cos-v1",
     model_kwargs={'device': "cuda"})
 
 
-loader = DirectoryLoader("../../ast_tokenizer",
-                         glob="*.py", loader_cls=PythonASTDocumentLoader, recursive=True)
-
-# interpret information in the documents
-documents = loader.load()
-
-# augment page data with some meta data
-for docs in documents:
-    newContent = f"Block Type: {docs.metadata['block_type']} \n Relative Path: {docs.metadata['relative_path'].replace('/',' ')} \n Block Name: {docs.metadata['block_name']} \n Arguments: {' '.join(docs.metadata['block_args'])} \n Code: {' '.join(re.findall('[a-zA-Z0-9]+', docs.page_content))}"
-    docs.page_content = newContent
-
-
 # load the language model - preferably one that is very good at writing code 
 llm = OllamaLLM(model="llama3.1:8b",
                 num_predict=-1,
                 temperature=0.035)
 
+# from langchain_anthropic import ChatAnthropic
 # llm = ChatAnthropic(model="claude-3-sonnet-20240229",
 #                     temperature=0,
 #                     max_tokens=1024,
 #                     timeout=None,
 #                     max_retries=2)
 
-# Connect Graph Database 
-graph = Neo4jGraph(
-    url="bolt://localhost:7687",
-    username="neo4j",
-    password="testing123",
+# Graph Database settings, shared by the QA chain and the Cypher validator
+GRAPH_URL = "bolt://localhost:7687"
+GRAPH_USERNAME = "neo4j"
+GRAPH_PASSWORD = "testing123"
+GRAPH_DATABASE = "neo4j"
+
+# Connect Graph Database, the schema comes from the snapshot saved after the last import
+graph = connect_graph(
+    url=GRAPH_URL,
+    username=GRAPH_USERNAME,
+    password=GRAPH_PASSWORD,
+    database=GRAPH_DATABASE,
     enhanced_schema=True,  # Provides more info about available values
 )
-
-graph.refresh_schema()
 # print(graph.schema)
 
 examples = [
@@ -96,36 +99,27 @@ examples = [
     {
     "question": "Which files contain both classes and methods?",
     "query": "MATCH (f:File)-[:IN]->(c:Class), (f)-[:IN]->(m:Method) RETURN DISTINCT f.path"
+    },
+    {
+    # TRANSITIVE_CALLERS_QUERY of retriever_testing_indepth_reranker/call_closure.py, which writes the reachability labels it reads
+    "question": "Which functions or methods eventually call the function 'parseData', directly or through other calls?",
+    "query": "CALL {{ MATCH (x:Function {{name: 'parseData'}}) RETURN x UNION MATCH (x:Method {{name: 'parseData'}}) RETURN x }} "
+             "UNWIND range(0, size(x.caller_intervals) - 1, 2) AS i WITH x, x.caller_intervals[i] AS low, x.caller_intervals[i + 1] AS high "
+             "CALL {{ WITH low, high MATCH (n:Function) WHERE low <= n.caller_post <= high RETURN n UNION WITH low, high MATCH (n:Method) WHERE low <= n.caller_post <= high RETURN n "
+             "UNION WITH low, high MATCH (n:Class) WHERE low <= n.caller_post <= high RETURN n }} "
+             "WITH x, n WHERE n <> x OR x.recursive RETURN DISTINCT n.name AS name, n.relative_path AS relative_path"
     }
 ]
 
 
 example_prompt = PromptTemplate.from_template("User input: {question}\nCypher query: {query}")
 
-# Smarter way to pick closest examples to the query
-# example_selector = SemanticSimilarityExampleSelector.from_examples(
-#     examples,
-#     embeddings,
-#     Neo4jVector,
-#     k=5,
-#     input_keys=["question"],
-# )
-
-# prompt = FewShotPromptTemplate(
-#     examples=examples_selector,
-#     example_prompt=example_prompt,
-#     prefix="You are a Neo4j expert. Given an input question, create a syntactically correct Cypher query to run.\n\nHere is the schema information\n{schema}.\n\nBelow are a number of examples of questions and their corresponding Cypher queries.",
-#     suffix="User input: {question}\nCypher query: ",
-#     input_variables=["question", "schema"],
-# )
-
-# print(example_selector.select_examples({"question": "How many files are there?"}))
-
-# print(example_prompt.invoke(example_selector.select_examples({"question": "How many files are there?"})[0]))
+# Picks the examples closest to the question, the example questions are embedded once here
+example_selector = VectorExampleSelector(examples, embeddings, k=DEFAULT_NUM_EXAMPLES)
 
 # TODO: Change its goal to attempt to return the files that are most relevant instead so further processing can be done
 prompt = FewShotPromptTemplate(
-    examples=examples[:],
+    example_selector=example_selector,
     example_prompt=example_prompt,
     prefix="You are a Neo4j expert. Given an input question, create a syntactically correct Cypher query to run.\n\nHere is the schema information\n{schema}.\n\nBelow are a number of examples of questions and their corresponding Cypher queries. Take note of the schema before answering, it should be one of the valid types with the valid relationships that you retrieve with.",
     suffix="User input: {question}\nCypher query: ",  # leave the query to generate open-ended for LLM to fill
@@ -143,6 +137,14 @@ graph_chain = GraphCypherQAChain.from_llm(
     validate_cypher=True,
     # use_function_response=True  # From testing so far, the LLM needs more context on what is in the graph db - This is broken as of the newest langchain
 )
+# Repeated questions reuse the Cypher generated for the same schema instead of calling the LLM again
+cypher_cache = CypherCache()
+# Generated Cypher is checked against the schema snapshot and its rows limited before it runs, EXPLAIN rejects queries expected to blow up.
+# Rejected queries are not cached
+# The validator gets its own pooled driver rather than reaching into the private one of the Neo4jGraph
+validation_driver = neo4j.GraphDatabase.driver(GRAPH_URL, auth=(GRAPH_USERNAME, GRAPH_PASSWORD))
+cypher_validator = CypherValidator(graph.structured_schema, driver=validation_driver, database=GRAPH_DATABASE)
+graph_chain.cypher_generation_chain = cypher_cache.wrap(cypher_validator.wrap(graph_chain.cypher_generation_chain))
 # print(graph_chain.invoke("How many files are in the graph?"))
 
 # prompt = PromptTemplate(template="""
@@ -170,3 +172,5 @@ while True:
         print(response)
     except neo4j.exceptions.CypherSyntaxError:
         print("Invalid Cypher was generated")
+    except CypherValidationError as e:
+        print(f"Generated Cypher was rejected: {e}")
@@ -0,0 +1,226 @@
+import csv
+import sys
+import threading
+
+import pytest
+
+import create_neo4j_graph
+from create_neo4j_graph import BATCH_QUERIES, SCHEMA_QUERIES, BulkImportWriter, block_kind, group_by_kind, import_batched
+from graph_state import BUMP_INGESTION_VERSION_QUERY
+
+
+class RecordingResult:
+    def consume(self):
+        pass
+
+    def data(self):
+        return [{"version": "recorded"}]
+
+
+class RecordingSession:
+    """
+    Records the queries run on it, directly or through execute_write, together with the worker thread.
+    """
+    def __init__(self, driver, database):
+        self.driver = driver
+        self.database = database
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def run(self, query, **parameters):
+        with self.driver.lock:
+            self.driver.queries.append((threading.get_ident(), self.database, query, parameters))
+        return RecordingResult()
+
+    def execute_write(self, work, *args):
+        return work(self, *args)
+
+
+class RecordingDriver:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = []
+
+    def session(self, database=None):
+        return RecordingSession(self, database)
+
+    def close(self):
+        pass
+
+    def batches(self):
+        return [(query, parameters["rows"]) for _, _, query, parameters in self.queries if "rows" in parameters]
+
+
+def block(name, path="repo/app.py", block_type="function", parent_type="root", parent_name="root", calls=()):
+    return {"relative_path": path, "block_type": block_type, "block_name": name, "parent_type": parent_type, "parent_name": parent_name,
+            "start_offset": 0, "end_offset": 10, "comments": [], "docstrings": [], "functions_called": list(calls), "methods": []}
+
+
+def test_block_kinds():
+    assert block_kind(block("run")) == "function"
+    assert block_kind(block("run", parent_type="class", parent_name="App")) == "method"
+    assert block_kind(block("App", block_type="class")) == "class"
+    assert block_kind(block("Global Scope", block_type="others")) == "others"
+    assert block_kind(block("run", parent_type="function")) is None
+    assert block_kind(block("x", block_type="lambda")) is None
+
+
+def test_rows_are_grouped_per_kind():
+    rows = group_by_kind([block("a"), block("App", block_type="class"), block("b"), block("x", block_type="lambda")])
+    assert {kind: [row["block_name"] for row in kind_rows] for kind, kind_rows in rows.items()} == {"function": ["a", "b"], "class": ["App"]}
+
+
+def test_schema_is_created_before_the_batches():
+    driver = RecordingDriver()
+    import_batched(driver, "graph", [block("a"), block("b")])
+    queries = [query for _, _, query, _ in driver.queries]
+    assert queries[:len(SCHEMA_QUERIES)] == SCHEMA_QUERIES
+    assert queries[len(SCHEMA_QUERIES):] == [BATCH_QUERIES["function"]]
+    assert {database for _, database, _, _ in driver.queries} == {"graph"}
+
+
+def test_every_document_is_imported_once_in_batches_of_one_kind():
+    metadatas = [block(f"f{i}", path=f"repo/m{i % 7}.py", calls=["print()"]) for i in range(23)]
+    metadatas += [block(f"m{i}", path=f"repo/m{i % 7}.py", parent_type="class", parent_name="App") for i in range(9)]
+    driver = RecordingDriver()
+    import_batched(driver, "graph", metadatas, batch_size=4)
+
+    batches = driver.batches()
+    assert all(0 < len(rows) <= 4 for _, rows in batches)
+    for query, rows in batches:
+        assert {block_kind(row) for row in rows} == {next(kind for kind, kind_query in BATCH_QUERIES.items() if kind_query == query)}
+    assert sorted(row["block_name"] for _, rows in batches for row in rows) == sorted(metadata["block_name"] for metadata in metadatas)
+
+
+def test_workers_own_whole_files():
+    metadatas = [block(f"f{i}", path=f"repo/m{i % 11}.py") for i in range(60)]
+    driver = RecordingDriver()
+    import_batched(driver, "graph", metadatas, batch_size=3, workers=4)
+
+    workers = {}
+    for thread, _, _, parameters in driver.queries:
+        for row in parameters.get("rows", []):
+            workers.setdefault(row["relative_path"], set()).add(thread)
+    assert len(workers) == 11 and all(len(threads) == 1 for threads in workers.values())
+    assert sum(len(rows) for _, rows in driver.batches()) == 60
+
+
+def test_worker_errors_are_raised():
+    class FailingDriver(RecordingDriver):
+        def session(self, database=None):
+            session = super().session(database)
+            if self.queries:  # After the schema
+                session.execute_write = lambda work, *args: (_ for _ in ()).throw(RuntimeError("write failed"))
+            return session
+
+    with pytest.raises(RuntimeError, match="write failed"):
+        import_batched(FailingDriver(), "graph", [block("a")], workers=2)
+
+
+def test_per_document_import_runs_the_query_of_the_kind():
+    session = RecordingSession(RecordingDriver(), "graph")
+    create_neo4j_graph.import_metadata(session, block("run", parent_type="class", parent_name="App"))
+    create_neo4j_graph.import_metadata(session, block("x", block_type="lambda"))
+    assert [(query, parameters["block_name"]) for _, _, query, parameters in session.driver.queries] == [(create_neo4j_graph.METHOD_QUERY, "run")]
+
+
+def read_import_files(directory):
+    files = {}
+    for name in list(create_neo4j_graph.NODE_HEADERS) + list(create_neo4j_graph.RELATIONSHIP_TYPES):
+        with open(directory / f"{name}.csv", newline="", encoding="utf-8") as file:
+            files[name] = list(csv.reader(file))[1:]
+    return files
+
+
+def test_bulk_import_files_deduplicate_nodes_and_relationships(tmp_path):
+    app_class = block("App", block_type="class")
+    app_class["methods"] = [block("run", parent_type="class", parent_name="App", calls=["print()"])]
+    with BulkImportWriter(tmp_path) as writer:
+        writer.add(app_class)
+        writer.add(block("run", parent_type="class", parent_name="App", calls=["print()"]))
+        writer.add(block("stop", parent_type="class", parent_name="Server", calls=["print()"]))
+        writer.add(block("main", calls=["print()", "main()"]))
+        writer.add(block("main", path="repo/cli.py", calls=["print()"]))
+    files = read_import_files(tmp_path)
+
+    assert [row[0] for row in files["File"]] == ["File|repo/app.py", "File|repo/cli.py"]
+    assert sorted(row[0] for row in files["Method"]) == ["Method|repo/app.py|App|run", "Method|repo/app.py|Server|stop"]
+    # A class only seen through its methods still gets a node
+    assert sorted(row[0] for row in files["Class"]) == ["Class|repo/app.py|App", "Class|repo/app.py|Server"]
+    assert sorted(map(tuple, files["DEFINES"])) == [("Class|repo/app.py|App", "Method|repo/app.py|App|run"),
+                                                    ("Class|repo/app.py|Server", "Method|repo/app.py|Server|stop")]
+    assert len(files["CALLS"]) == 5 and len(set(map(tuple, files["CALLS"]))) == 5
+    # Calls nodes are written once per file, neo4j-admin skips the duplicates
+    assert sorted(row[0] for row in files["Calls"]) == ["Calls|main()", "Calls|print()", "Calls|print()"]
+    assert "--skip-duplicate-nodes=true" in writer.import_command("graph")
+
+
+def test_bulk_import_writer_only_keeps_the_keys_of_one_file(tmp_path):
+    with BulkImportWriter(tmp_path) as writer:
+        for i in range(20):
+            writer.add(block("main", path=f"repo/m{i}.py", calls=["print()"]))
+            assert len(writer.nodes) == 3 and len(writer.relationships) == 2
+    assert len(read_import_files(tmp_path)["Function"]) == 20
+
+
+def test_arrays_use_the_unit_separator(tmp_path):
+    metadata = block("main", calls=["a(x; y)", "b()"])
+    metadata["comments"] = ["# a; b", "# c\x1f"]
+    with BulkImportWriter(tmp_path) as writer:
+        writer.add(metadata)
+    row = read_import_files(tmp_path)["Function"][0]
+    assert row[5].split("\x1f") == ["# a; b", "# c "] and row[7].split("\x1f") == ["a(x; y)", "b()"]
+
+
+def test_offline_import_only_bumps_the_version_once_marked_imported(tmp_path, monkeypatch):
+    (tmp_path / "repo").mkdir()
+    (tmp_path / "repo" / "app.py").write_text("def main():\n    print('hi')\n")
+    bumps = []
+    monkeypatch.setattr(create_neo4j_graph.GraphDatabase, "driver", lambda uri, auth: RecordingDriver())
+    monkeypatch.setattr(create_neo4j_graph, "mark_changed", lambda driver, database: bumps.append(database))
+
+    arguments = ["create_neo4j_graph.py", str(tmp_path / "repo"), "neo4j", "password", "graph"]
+    monkeypatch.setattr(sys, "argv", arguments + ["--offline", str(tmp_path / "import")])
+    create_neo4j_graph.main()
+    assert bumps == [] and read_import_files(tmp_path / "import")["Function"][0][1] == "main"
+
+    monkeypatch.setattr(sys, "argv", arguments + ["--mark-imported"])
+    create_neo4j_graph.main()
+    assert bumps == ["graph"]
+
+
+def test_sync_replaces_the_subgraph_of_changed_files(tmp_path):
+    (tmp_path / "app.py").write_text("def main():\n    print('hi')\n\n\nclass App:\n    def run(self):\n        main()\n")
+    paths = [str(tmp_path / "app.py"), str(tmp_path / "deleted.py"), str(tmp_path / "other.py")]
+    driver = RecordingDriver()
+    create_neo4j_graph.sync_files(driver, "graph", paths, files_per_transaction=2)
+
+    queries = [(query, parameters) for _, _, query, parameters in driver.queries][len(SCHEMA_QUERIES):]
+    deletes = [parameters["paths"] for query, parameters in queries if query == create_neo4j_graph.DELETE_FILES_QUERY]
+    assert deletes == [paths[:2], paths[2:]]
+    # Each transaction deletes its files before importing what is left of them
+    assert queries[0][0] == create_neo4j_graph.DELETE_FILES_QUERY and queries[-1][0] == create_neo4j_graph.DELETE_FILES_QUERY
+    imported = {row["block_name"]: (query, row["relative_path"]) for query, parameters in queries for row in parameters.get("rows", [])}
+    assert imported["main"] == (BATCH_QUERIES["function"], paths[0])
+    assert imported["App"] == (BATCH_QUERIES["class"], paths[0])
+    assert imported["run"] == (BATCH_QUERIES["method"], paths[0])
+
+
+def test_changes_bump_the_version_stored_in_the_graph():
+    driver = RecordingDriver()
+    assert create_neo4j_graph.mark_changed(driver, "graph") == "recorded"
+    assert [(database, query) for _, database, query, _ in driver.queries] == [("graph", BUMP_INGESTION_VERSION_QUERY)]
+
+
+def test_changed_files_are_synced_with_their_graph_path(tmp_path, monkeypatch):
+    synced, bumps = [], []
+    monkeypatch.setattr(create_neo4j_graph.GraphDatabase, "driver", lambda uri, auth: RecordingDriver())
+    monkeypatch.setattr(create_neo4j_graph, "sync_files", lambda driver, database, paths: synced.append((database, paths)))
+    monkeypatch.setattr(create_neo4j_graph, "mark_changed", lambda driver, database: bumps.append(database))
+    monkeypatch.setattr(sys, "argv", ["create_neo4j_graph.py", str(tmp_path), "neo4j", "password", "graph", "--changed", "pkg/app.py", "README.md"])
+    create_neo4j_graph.main()
+    assert synced == [("graph", [str(tmp_path / "pkg" / "app.py")])] and bumps == ["graph"]
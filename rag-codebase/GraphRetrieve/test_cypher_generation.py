@@ -0,0 +1,69 @@
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableLambda
+
+from cypher_generation import CypherCache, VectorExampleSelector, normalize_question, schema_version
+
+
+class KeywordEmbeddings(Embeddings):
+    """
+    One dimension per keyword, counting the calls so the tests can check what gets embedded.
+    """
+    KEYWORDS = ["call", "class", "file", "method"]
+
+    def __init__(self):
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        self.embedded += 1
+        return [float(text.lower().count(keyword)) for keyword in self.KEYWORDS]
+
+
+EXAMPLES = [{"question": "Which file defines the class App?", "query": "MATCH (c:Class)-[:IN]->(f:File) RETURN f"},
+            {"question": "What does run call?", "query": "MATCH (:Function)-[:CALLS]->(c) RETURN c"},
+            {"question": "Which methods does the class App have?", "query": "MATCH (:Class)-[:DEFINES]->(m) RETURN m"}]
+
+
+def test_questions_are_normalized():
+    assert normalize_question("  What calls   RUN?? ") == normalize_question("what calls run") == "what calls run"
+    assert schema_version("Node properties: File") != schema_version("Node properties: Class")
+
+
+def test_cache_evicts_the_least_recently_used_entry():
+    cache = CypherCache(max_entries=2)
+    cache.put("a", "MATCH (a) RETURN a")
+    cache.put("b", "MATCH (b) RETURN b")
+    assert cache.get("a") == "MATCH (a) RETURN a"
+    cache.put("c", "MATCH (c) RETURN c")
+    assert cache.get("b") is None and cache.get("a") and cache.get("c")
+    assert len(cache) == 2 and (cache.hits, cache.misses) == (3, 1)
+
+
+def test_wrapped_chain_only_runs_on_misses_of_the_same_schema():
+    generated = []
+    chain = CypherCache().wrap(RunnableLambda(lambda inputs: generated.append(inputs["question"]) or f"// {len(generated)}"))
+    assert chain.invoke({"question": "What calls run?", "schema": "v1"}) == "// 1"
+    assert chain.invoke({"question": "what calls run", "schema": "v1"}) == "// 1"
+    assert chain.invoke({"question": "What calls run?", "schema": "v2"}) == "// 2"
+    assert generated == ["What calls run?", "What calls run?"]
+
+
+def test_examples_are_embedded_once_and_ranked_by_similarity():
+    embeddings = KeywordEmbeddings()
+    selector = VectorExampleSelector(EXAMPLES, embeddings, k=2)
+    assert embeddings.embedded == 3
+
+    selected = selector.select_examples({"question": "Which methods are in the class Server?"})
+    assert selected == [EXAMPLES[2], EXAMPLES[0]] and embeddings.embedded == 4
+    assert selector.select_examples({"question": "Who calls stop?"})[0] == EXAMPLES[1]
+
+
+def test_examples_can_be_added_to_an_empty_selector():
+    selector = VectorExampleSelector([], KeywordEmbeddings())
+    assert selector.select_examples({"question": "What calls run?"}) == []
+    selector.add_example(EXAMPLES[1])
+    assert selector.vectors.shape == (1, 4) and np.isclose(np.linalg.norm(selector.vectors[0]), 1)
+    assert selector.select_examples({"question": "What calls run?"}) == [EXAMPLES[1]]
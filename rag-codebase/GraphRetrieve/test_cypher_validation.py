@@ -0,0 +1,103 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from cypher_validation import CypherValidationError, CypherValidator, extract_cypher, mask_literals, pattern_clauses
+
+# Queries of the retrieval engine run against the same graph. Appended so its modules never shadow the ones of this directory
+sys.path.append(str(Path(__file__).resolve().parent.parent / "retriever_testing_indepth_reranker"))
+from call_closure import TRANSITIVE_CALLERS_QUERY  # noqa: E402
+from retrieval_orchestrator import Neo4jGraphSearch  # noqa: E402
+
+
+def properties(*names):
+    return [{"property": name, "type": "STRING"} for name in names]
+
+
+BLOCK_PROPERTIES = ("name", "relative_path", "start_offset", "end_offset", "comments", "docstrings", "call_scc", "recursive",
+                    "caller_post", "caller_intervals", "callee_post", "callee_intervals")
+SCHEMA = {
+    "node_props": {"File": properties("path"), "Function": properties(*BLOCK_PROPERTIES, "functions_called"),
+                   "Method": properties(*BLOCK_PROPERTIES, "functions_called", "parent_class"), "Class": properties(*BLOCK_PROPERTIES),
+                   "Others": properties(*BLOCK_PROPERTIES, "functions_called"), "Calls": properties("name")},
+    "rel_props": {},
+    "relationships": [{"start": "Function", "type": "IN", "end": "File"}, {"start": "Method", "type": "IN", "end": "File"},
+                      {"start": "Class", "type": "DEFINES", "end": "Method"}, {"start": "Function", "type": "CALLS", "end": "Calls"}],
+}
+
+
+def test_literals_are_masked_in_place():
+    cypher = "MATCH (f:File {path: 'a (b:C)'}) // (x:Y)\nRETURN f"
+    masked = mask_literals(cypher)
+    assert len(masked) == len(cypher) and "(b:C)" not in masked and "(x:Y)" not in masked
+    assert extract_cypher("Here you go:\n```cypher\nMATCH (n) RETURN n;\n```") == "MATCH (n) RETURN n"
+
+
+def test_only_clause_patterns_are_parsed():
+    clauses = pattern_clauses("MATCH (n)-[:IN]->(f:File) WHERE (n:Function OR n:Method) "
+                              "OPTIONAL MATCH (n)-[:CALLS]->(c) RETURN collect({file: f.path})")
+    assert [clause.strip() for clause in clauses] == ["(n)-[:IN]->(f:File)", "(n)-[:CALLS]->(c)"]
+    assert [clause.strip() for clause in pattern_clauses("CALL { MATCH (n:Class) RETURN n } RETURN n")] == ["(n:Class)"]
+
+
+def test_unknown_names_are_rejected():
+    validator = CypherValidator(SCHEMA)
+    with pytest.raises(CypherValidationError, match="label Module"):
+        validator.check("MATCH (m:Module) RETURN m")
+    with pytest.raises(CypherValidationError, match="relationship type CONTAINS"):
+        validator.check("MATCH (f:File)-[:CONTAINS]->(n) RETURN n")
+    with pytest.raises(CypherValidationError, match="property filename"):
+        validator.check("MATCH (f:File {filename: 'a.py'}) RETURN f")
+    with pytest.raises(CypherValidationError, match="property path of f"):
+        validator.check("MATCH (f:Function) RETURN f.path")
+
+
+def test_expressions_are_not_mistaken_for_patterns():
+    validator = CypherValidator(SCHEMA)
+    validator.check("MATCH (n)-[:IN]->(f:File) WHERE (n:Function OR n:Method) AND n.name = 'run' "
+                    "RETURN n.name, collect({file: f.path, start: n.start_offset}) AS files")
+    validator.check("MATCH (n:Function) WITH n, [x IN n.comments WHERE size(x) > 2] AS long RETURN (n.name), long")
+
+
+@pytest.mark.parametrize("query", [TRANSITIVE_CALLERS_QUERY, Neo4jGraphSearch.GRAPH_QUERY])
+def test_engine_queries_validate_unchanged(query):
+    validator = CypherValidator(SCHEMA, max_rows=None)
+    assert validator.validate(query) == query.strip()
+
+
+def test_rows_are_limited_per_top_level_union_part():
+    validator = CypherValidator(SCHEMA, max_rows=10)
+    assert validator.limit("MATCH (f:File) RETURN f") == "MATCH (f:File) RETURN f LIMIT 10"
+    assert validator.limit("MATCH (f:File) RETURN f LIMIT 500") == "MATCH (f:File) RETURN f LIMIT 10"
+    assert validator.limit("MATCH (f:File) RETURN f LIMIT 5") == "MATCH (f:File) RETURN f LIMIT 5"
+    assert validator.limit("MATCH (f:File) RETURN f.path AS p UNION MATCH (c:Class) RETURN c.name AS p") == \
+        "MATCH (f:File) RETURN f.path AS p LIMIT 10 UNION MATCH (c:Class) RETURN c.name AS p LIMIT 10"
+    # Subqueries and parameter limits are left alone
+    subquery = "CALL { MATCH (f:Function) RETURN f AS n UNION MATCH (m:Method) RETURN m AS n } RETURN n.name"
+    assert validator.limit(subquery) == subquery + " LIMIT 10"
+    engine_query = Neo4jGraphSearch.GRAPH_QUERY.strip()
+    assert validator.limit(engine_query) == engine_query
+
+
+def test_plans_over_the_row_budget_are_rejected():
+    plans = []
+
+    class Session:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+        def run(self, cypher):
+            plans.append(cypher)
+            return SimpleNamespace(consume=lambda: SimpleNamespace(plan={"args": {"EstimatedRows": 10.0},
+                                                                         "children": [{"args": {"EstimatedRows": 5e6}}]}))
+
+    driver = SimpleNamespace(session=lambda database: Session())
+    with pytest.raises(CypherValidationError, match="5000000 rows"):
+        CypherValidator(SCHEMA, driver=driver, database="graph").validate("MATCH (a:Function), (b:Function) RETURN a, b")
+    assert plans == ["EXPLAIN MATCH (a:Function), (b:Function) RETURN a, b LIMIT 100"]
+    assert CypherValidator(SCHEMA, driver=driver, max_estimated_rows=1e7).validate("MATCH (f:File) RETURN f")
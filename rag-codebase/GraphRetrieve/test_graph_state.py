@@ -0,0 +1,56 @@
+import uuid
+
+from graph_state import (BUMP_INGESTION_VERSION_QUERY, INGESTION_VERSION_QUERY, bump_ingestion_version, ingestion_version, load_schema_snapshot,
+                         save_schema_snapshot)
+
+URI = "bolt://localhost:7687"
+
+
+class FakeGraph:
+    """
+    Runs the two version queries against one in-memory IngestionState node, like a database shared by every machine.
+    """
+    def __init__(self):
+        self.version = None
+
+    def query(self, cypher):
+        if cypher == BUMP_INGESTION_VERSION_QUERY:
+            self.version = str(uuid.uuid4())
+        else:
+            assert cypher == INGESTION_VERSION_QUERY
+        return [{"version": self.version}]
+
+
+def test_versions_are_read_from_the_graph():
+    graph = FakeGraph()
+    assert ingestion_version(graph.query) is None
+    first = bump_ingestion_version(graph.query)
+    assert ingestion_version(graph.query) == first
+    assert bump_ingestion_version(graph.query) != first
+    assert ingestion_version(FakeGraph().query) is None
+    assert ingestion_version(lambda cypher: []) is None
+
+
+def test_schema_snapshots_expire_with_the_next_import(tmp_path):
+    graph = FakeGraph()
+    structured_schema = {"node_props": {"File": [{"property": "path", "type": "STRING"}]}, "rel_props": {}, "relationships": []}
+    version = bump_ingestion_version(graph.query)
+    assert load_schema_snapshot(URI, "graph", True, version, tmp_path) is None
+    save_schema_snapshot(URI, "graph", True, version, "Node properties: File", structured_schema, tmp_path)
+
+    snapshot = load_schema_snapshot(URI, "graph", True, ingestion_version(graph.query), tmp_path)
+    assert snapshot["schema"] == "Node properties: File" and snapshot["structured_schema"] == structured_schema
+    assert load_schema_snapshot(URI, "graph", False, version, tmp_path) is None  # Taken without the enhanced schema
+    assert load_schema_snapshot(URI, "other", True, version, tmp_path) is None
+
+    # An import from another machine only changes the version in the graph
+    bump_ingestion_version(graph.query)
+    assert load_schema_snapshot(URI, "graph", True, ingestion_version(graph.query), tmp_path) is None
+
+
+def test_unreadable_snapshots_are_ignored(tmp_path):
+    save_schema_snapshot(URI, "graph", True, "v1", "Node properties: File", {}, tmp_path)
+    (snapshot_file,) = tmp_path.glob("*.schema.json")
+    snapshot_file.write_text("{not json")
+    assert load_schema_snapshot(URI, "graph", True, "v1", tmp_path) is None
+    assert not list(tmp_path.glob("*.tmp"))
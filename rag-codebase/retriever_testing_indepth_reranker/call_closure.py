@@ -0,0 +1,317 @@
+import argparse
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_community.document_loaders import DirectoryLoader
+from langchain_core.documents import Document
+from langchain_neo4j import Neo4jGraph
+
+from call_graph import CallGraph, csr
+from document_store import DocumentStore
+from python_ast import PythonASTDocumentLoader
+from symbol_index import SymbolIndex
+
+DEFAULT_WRITE_BATCH_SIZE = 5000
+
+
+# Post numbers are looked up by range, names by equality (the import only indexes names together with relative_path)
+CLOSURE_SCHEMA_QUERIES = [f"CREATE INDEX {label.lower()}_{prop} IF NOT EXISTS FOR (n:{label}) ON (n.{prop})"
+                          for label in ("Function", "Method", "Class") for prop in ("callee_post", "caller_post", "name")]
+
+CLOSURE_WRITE_QUERY = """
+    UNWIND $rows AS row
+    MATCH (n:{label} {{name: row.name, relative_path: row.relative_path}})
+    WHERE n.start_offset = row.start_offset
+    SET n.call_scc = row.scc, n.recursive = row.recursive, n.callee_post = row.callee_post, n.callee_intervals = row.callee_intervals,
+        n.caller_post = row.caller_post, n.caller_intervals = row.caller_intervals
+    """
+
+# Everything that eventually calls $name: the nodes whose caller_post falls in one of its caller intervals, range lookups instead of a traversal.
+# One MATCH per label so every lookup uses the indexes of CLOSURE_SCHEMA_QUERIES. Swap caller for callee to get everything it eventually calls
+TRANSITIVE_CALLERS_QUERY = """
+    CALL {
+        MATCH (x:Function {name: $name}) RETURN x
+        UNION
+        MATCH (x:Method {name: $name}) RETURN x
+    }
+    UNWIND range(0, size(x.caller_intervals) - 1, 2) AS i
+    WITH x, x.caller_intervals[i] AS low, x.caller_intervals[i + 1] AS high
+    CALL {
+        WITH low, high
+        MATCH (n:Function) WHERE low <= n.caller_post <= high RETURN n
+        UNION
+        WITH low, high
+        MATCH (n:Method) WHERE low <= n.caller_post <= high RETURN n
+        UNION
+        WITH low, high
+        MATCH (n:Class) WHERE low <= n.caller_post <= high RETURN n
+    }
+    WITH x, n WHERE n <> x OR x.recursive
+    RETURN DISTINCT n.name AS name, n.relative_path AS relative_path
+    """
+
+
+def graph_label(metadata: Dict) -> Optional[str]:
+    """
+    Label of the node GraphRetrieve/create_neo4j_graph.py creates for a block, None for blocks without one (e.g nested functions).
+    """
+    if metadata.get("block_type") == "class":
+        return "Class"
+    if metadata.get("block_type") == "function":
+        return {"root": "Function", "class": "Method"}.get(metadata.get("parent_type"))
+    return None
+
+
+def strongly_connected_components(offsets: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """
+    Returns the component of every node of a CSR graph (iterative Tarjan).
+    Components are numbered in reverse topological order: a component only has edges to components with smaller numbers.
+    """
+    num_nodes = len(offsets) - 1
+    offsets, targets = offsets.tolist(), targets.tolist()
+    index = [-1] * num_nodes
+    lowlink = [0] * num_nodes
+    on_stack = [False] * num_nodes
+    component = np.full(num_nodes, -1, dtype=np.int64)
+    stack, counter, num_components = [], 0, 0
+    for root in range(num_nodes):
+        if index[root] != -1:
+            continue
+        work = [(root, offsets[root])]
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        while work:
+            node, edge = work[-1]
+            if edge < offsets[node + 1]:
+                work[-1] = (node, edge + 1)
+                target = targets[edge]
+                if index[target] == -1:
+                    index[target] = lowlink[target] = counter
+                    counter += 1
+                    stack.append(target)
+                    on_stack[target] = True
+                    work.append((target, offsets[target]))
+                elif on_stack[target]:
+                    lowlink[node] = min(lowlink[node], index[target])
+                continue
+            work.pop()
+            if work:
+                lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+            if lowlink[node] == index[node]:
+                while True:
+                    member = stack.pop()
+                    on_stack[member] = False
+                    component[member] = num_components
+                    if member == node:
+                        break
+                num_components += 1
+    return component
+
+
+class IntervalLabels:
+    """
+    Reachability labels of a DAG in CSR layout (interval labeling over a DFS spanning forest).
+
+    Nodes are numbered in DFS post order, so the spanning tree below a node is the range [low, post] of its own numbers.
+    The label of a node is that range merged with the labels of its children: sorted disjoint intervals of post numbers that cover exactly the nodes it reaches.
+    Reachability is a binary search in the label, and every reachable node is a slice of the post order per interval.
+    Call graphs are mostly tree shaped, so labels stay a few intervals long.
+    """
+    def __init__(self, offsets: np.ndarray, targets: np.ndarray):
+        num_nodes = len(offsets) - 1
+        children = [targets[offsets[node]:offsets[node + 1]].tolist() for node in range(num_nodes)]
+        self.post = np.full(num_nodes, -1, dtype=np.int64)
+        low = np.zeros(num_nodes, dtype=np.int64)
+        counter = 0
+        for root in range(num_nodes):
+            if self.post[root] != -1:
+                continue
+            low[root] = counter
+            self.post[root] = -2  # Visited, not finished
+            work = [(root, 0)]
+            while work:
+                node, edge = work[-1]
+                if edge < len(children[node]):
+                    work[-1] = (node, edge + 1)
+                    child = children[node][edge]
+                    if self.post[child] == -1:
+                        low[child] = counter
+                        self.post[child] = -2
+                        work.append((child, 0))
+                    continue
+                work.pop()
+                self.post[node] = counter
+                counter += 1
+        self.order = np.argsort(self.post)  # Post number -> node
+
+        # In a DAG every node a node reaches is finished before it, so labels are built in post order from finished labels
+        labels: List[List[Tuple[int, int]]] = [[] for _ in range(num_nodes)]
+        for node in self.order.tolist():
+            intervals = sorted([(int(low[node]), int(self.post[node]))] + [interval for child in children[node] for interval in labels[child]])
+            merged = [intervals[0]]
+            for start, end in intervals[1:]:
+                if start <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else:
+                    merged.append((start, end))
+            labels[node] = merged
+
+        self.offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum([len(label) for label in labels], out=self.offsets[1:])
+        flat = np.asarray([interval for label in labels for interval in label], dtype=np.int64).reshape(-1, 2)
+        self.starts, self.ends = flat[:, 0].copy(), flat[:, 1].copy()
+
+    def intervals(self, node: int) -> np.ndarray:
+        """
+        Returns the (start, end) post number intervals of the nodes a node reaches, itself included.
+        """
+        return np.stack((self.starts[self.offsets[node]:self.offsets[node + 1]], self.ends[self.offsets[node]:self.offsets[node + 1]]), axis=1)
+
+    def reaches(self, source: int, target: int) -> bool:
+        starts = self.starts[self.offsets[source]:self.offsets[source + 1]]
+        i = int(np.searchsorted(starts, self.post[target], side="right")) - 1
+        return i >= 0 and self.ends[self.offsets[source] + i] >= self.post[target]
+
+    def reachable(self, node: int) -> np.ndarray:
+        """
+        Returns every node a node reaches, itself included.
+        """
+        return np.concatenate([self.order[start:end + 1] for start, end in self.intervals(node).tolist()])
+
+
+class CallClosure:
+    """
+    Transitive closure of the resolved call graph (see CallGraph) of a DocumentStore, so "what eventually calls X" and "what does Y depend on" are lookups instead of traversals.
+
+    Recursive functions make the call graph cyclic, so its strongly connected components are condensed first: blocks of a component all reach each other.
+    A component is cyclic if it has several blocks or its block calls itself, only the blocks of cyclic components reach themselves.
+    The condensed graph is a DAG, labeled with intervals (see IntervalLabels) once along the callee edges and once along the caller edges.
+    write_properties() stores both labels on the nodes of the Neo4J graph, for Cypher reachability queries like TRANSITIVE_CALLERS_QUERY.
+    """
+    def __init__(self, store: DocumentStore, call_graph: CallGraph = None):
+        self.store = store
+        call_graph = call_graph or store.derived("call_graph", CallGraph)
+        self.component = strongly_connected_components(call_graph.callee_offsets, call_graph.callee_ids)
+        num_components = int(self.component.max()) + 1 if len(self.component) else 0
+
+        # Members of component c are member_ids[member_offsets[c]:member_offsets[c + 1]]
+        self.member_offsets, self.member_ids = csr(self.component, np.arange(len(store), dtype=np.int64), num_components)
+        self.cyclic = np.diff(self.member_offsets) > 1
+        self.cyclic[self.component[call_graph.calls_itself]] = True  # Call graph edges never loop on one block
+
+        sources = np.repeat(np.arange(len(store), dtype=np.int64), np.diff(call_graph.callee_offsets))
+        edges = np.unique(np.stack((self.component[sources], self.component[call_graph.callee_ids]), axis=1).reshape(-1, 2), axis=0)
+        edges = edges[edges[:, 0] != edges[:, 1]]
+        self.num_component_edges = len(edges)
+        self.callee_labels = IntervalLabels(*csr(edges[:, 0], edges[:, 1], num_components))
+        self.caller_labels = IntervalLabels(*csr(edges[:, 1], edges[:, 0], num_components))
+
+    def members(self, component: int) -> np.ndarray:
+        return self.member_ids[self.member_offsets[component]:self.member_offsets[component + 1]]
+
+    def calls_eventually(self, caller: int, callee: int) -> bool:
+        """
+        Returns whether a block calls another one directly or through any chain of calls.
+        """
+        source, target = self.component[caller], self.component[callee]
+        if source == target:
+            return bool(self.cyclic[source])
+        return self.callee_labels.reaches(source, target)
+
+    def transitive_callees(self, doc_id: int) -> np.ndarray:
+        """
+        Returns the sorted ids of every block a block calls directly or indirectly.
+        """
+        return self.__blocks(self.callee_labels.reachable(self.component[doc_id]), doc_id)
+
+    def transitive_callers(self, doc_id: int) -> np.ndarray:
+        """
+        Returns the sorted ids of every block that calls a block directly or indirectly.
+        """
+        return self.__blocks(self.caller_labels.reachable(self.component[doc_id]), doc_id)
+
+    def properties(self, doc_id: int) -> Dict:
+        """
+        Graph properties of a block, its intervals flattened to [start, end, start, end, ...].
+        """
+        component = int(self.component[doc_id])
+        return {"scc": component, "recursive": bool(self.cyclic[component]),
+                "callee_post": int(self.callee_labels.post[component]), "callee_intervals": self.callee_labels.intervals(component).ravel().tolist(),
+                "caller_post": int(self.caller_labels.post[component]), "caller_intervals": self.caller_labels.intervals(component).ravel().tolist()}
+
+    def write_properties(self, graph, batch_size: int = DEFAULT_WRITE_BATCH_SIZE) -> int:
+        """
+        Sets the closure properties (call_scc, recursive, callee_post, callee_intervals, caller_post, caller_intervals) on the Function, Method and Class nodes of the blocks.
+        graph is anything with a query(cypher, params) method, e.g langchain_neo4j.Neo4jGraph. Returns the number of blocks written.
+        """
+        for query in CLOSURE_SCHEMA_QUERIES:
+            graph.query(query)
+        rows = defaultdict(list)
+        for doc_id in self.store.ids:
+            metadata = self.store.metadata(doc_id)
+            label = graph_label(metadata)
+            if label is not None:
+                rows[label].append(dict(self.properties(doc_id), name=metadata.get("block_name"), relative_path=str(metadata.get("relative_path")),
+                                        start_offset=metadata.get("start_offset")))
+        for label, label_rows in rows.items():
+            for start in range(0, len(label_rows), batch_size):
+                graph.query(CLOSURE_WRITE_QUERY.format(label=label), {"rows": label_rows[start:start + batch_size]})
+        return sum(len(label_rows) for label_rows in rows.values())
+
+    def __blocks(self, components: np.ndarray, doc_id: int) -> np.ndarray:
+        blocks = np.concatenate([self.members(component) for component in components.tolist()])
+        if not self.cyclic[self.component[doc_id]]:
+            blocks = blocks[blocks != doc_id]
+        return np.sort(blocks)
+
+
+class TransitiveCallerSearch:
+    """
+    Retrieval backend for "what eventually calls X" questions: the blocks calling the symbols named in the query (see SymbolIndex.find()) directly or through any chain of calls, answered from the CallClosure without a graph database.
+    Direct callers come first, then the indirect ones in block order. The closure is built once per store and shared.
+    Takes (query, k) like the other backends of EnsembleSearch, which adds it with search(..., callers=True).
+    """
+    def __init__(self, store: DocumentStore, view: str = "header"):
+        self.store = store
+        self.view = view
+
+    def __call__(self, query: str, k: int) -> List[Document]:
+        return DocumentStore.detach([self.store.document(doc_id, self.view) for doc_id in self.caller_ids(query)[:k].tolist()])
+
+    def caller_ids(self, query: str) -> np.ndarray:
+        """
+        Returns the ids of every block eventually calling the symbols named in the query, in result order. The symbols' own blocks are left out.
+        """
+        targets = self.store.derived("symbol_index", SymbolIndex.from_store).find(query)
+        if not targets:
+            return np.empty(0, dtype=np.int64)
+        closure = self.store.derived("call_closure", CallClosure)
+        call_graph = self.store.derived("call_graph", CallGraph)
+        direct = [call_graph.callers(target) for target in targets]
+        indirect = [closure.transitive_callers(target) for target in targets]
+        callers = dict.fromkeys(np.concatenate(direct + indirect).tolist())
+        return np.asarray([doc_id for doc_id in callers if doc_id not in targets], dtype=np.int64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute the transitive call closure of a repository and write it to its Neo4J graph")
+    parser.add_argument("directory", type=str, help="The directory the graph was built from with GraphRetrieve/create_neo4j_graph.py")
+    parser.add_argument("username", type=str, help="Neo4J database username")
+    parser.add_argument("password", type=str, help="Neo4J database password")
+    parser.add_argument("database", type=str, help="Neo4J database")
+    parser.add_argument("--uri", type=str, default="bolt://localhost:7687", help="Neo4J connection URI")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_WRITE_BATCH_SIZE, help="Blocks per write query")
+    args = parser.parse_args()
+
+    store = DocumentStore(DirectoryLoader(args.directory, glob="*.py", loader_cls=PythonASTDocumentLoader, recursive=True).load())
+    closure = CallClosure(store)
+    print(f"{len(store)} blocks, {len(closure.member_offsets) - 1} call components, {int(closure.cyclic.sum())} of them recursive")
+    graph = Neo4jGraph(url=args.uri, username=args.username, password=args.password, database=args.database, refresh_schema=False)
+    print(f"Wrote the closure of {closure.write_properties(graph, args.batch_size)} blocks")
+
+
+if __name__ == "__main__":
+    main()
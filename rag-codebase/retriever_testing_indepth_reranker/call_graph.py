@@ -0,0 +1,133 @@
+from collections import defaultdict
+from langchain_core.documents import Document
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from document_store import DocumentStore, block_key
+
+CHARS_PER_TOKEN = 4  # Rough token estimate for code, good enough for budgeting context
+DEFAULT_TOKEN_BUDGET = 1000
+MAX_GLOBAL_CANDIDATES = 3  # Calls to a name defined more often than this elsewhere in the repo (e.g get) are too ambiguous to link
+
+
+def csr(sources: np.ndarray, targets: np.ndarray, num_nodes: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Compressed sparse row layout of the edges (sources[i], targets[i]): the targets of node n are targets[offsets[n]:offsets[n + 1]], in edge order.
+    """
+    order = np.argsort(sources, kind="stable")
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=num_nodes), out=offsets[1:])
+    return offsets, targets[order]
+
+
+def callee_name(call: str) -> Tuple[Optional[str], str]:
+    """
+    Splits a call expression from functions_called, e.g "self.app.run(debug=True)", into (qualifier, name): ("app", "run").
+    """
+    parts = call.split("(", 1)[0].strip().split(".")
+    return (parts[-2].strip() if len(parts) > 1 else None), parts[-1].strip()
+
+
+class CallGraph:
+    """
+    In-process call graph over the blocks of a DocumentStore, built from the functions_called, parent_type and parent_name metadata of the AST loader.
+
+    Calls are resolved by name, most specific first:
+    - self.x()/cls.x(): method x of the caller's class
+    - C.x(): method x of class C
+    - x(): a function or class named x in the caller's file, otherwise anywhere in the repo if the name is not too ambiguous
+    Calling a class links to the class block.
+
+    Edges are stored in CSR layout in both directions (callees of block i are callee_ids[callee_offsets[i]:callee_offsets[i + 1]], callers likewise), so expanding a hit is a few array slices.
+    A block calling itself gets no edge, calls_itself marks it instead.
+    """
+    def __init__(self, store: DocumentStore, view: str = "header"):
+        self.store = store
+        self.view = view
+        self.key_to_id: Dict[Tuple[str, int, int], int] = {block_key(store.metadata(doc_id)): doc_id for doc_id in store.ids}
+        self.token_counts = np.asarray([len(text) // CHARS_PER_TOKEN + 1 for text in store.texts(view)], dtype=np.int64)
+
+        by_name: Dict[str, List[int]] = defaultdict(list)
+        by_file_name: Dict[Tuple[str, str], List[int]] = defaultdict(list)
+        methods: Dict[Tuple[str, str], List[int]] = defaultdict(list)  # (class, method) -> block ids
+        for doc_id in store.ids:
+            metadata = store.metadata(doc_id)
+            if metadata.get("block_type") not in ("class", "function"):
+                continue
+            name = metadata.get("block_name")
+            if metadata.get("parent_type") == "class":
+                methods[(metadata.get("parent_name"), name)].append(doc_id)
+            else:
+                by_name[name].append(doc_id)
+                by_file_name[(str(metadata.get("relative_path")), name)].append(doc_id)
+
+        edges = set()
+        self.calls_itself = np.zeros(len(store), dtype=bool)
+        for doc_id in store.ids:
+            metadata = store.metadata(doc_id)
+            own_class = metadata.get("parent_name") if metadata.get("parent_type") == "class" else None
+            for call in metadata.get("functions_called", []):
+                qualifier, name = callee_name(call)
+                if qualifier in ("self", "cls") and own_class:
+                    callees = methods.get((own_class, name), [])
+                elif qualifier is not None and (qualifier, name) in methods:
+                    callees = methods[(qualifier, name)]
+                else:
+                    callees = by_file_name.get((str(metadata.get("relative_path")), name))
+                    if not callees:
+                        callees = by_name.get(name, [])
+                        callees = callees if len(callees) <= MAX_GLOBAL_CANDIDATES else []
+                edges.update((doc_id, callee) for callee in callees if callee != doc_id)
+                self.calls_itself[doc_id] |= doc_id in callees
+
+        edges = np.asarray(sorted(edges), dtype=np.int64).reshape(-1, 2)
+        self.num_edges = len(edges)
+        self.callee_offsets, self.callee_ids = csr(edges[:, 0], edges[:, 1], len(store))
+        self.caller_offsets, self.caller_ids = csr(edges[:, 1], edges[:, 0], len(store))
+
+    def callees(self, doc_id: int) -> np.ndarray:
+        return self.callee_ids[self.callee_offsets[doc_id]:self.callee_offsets[doc_id + 1]]
+
+    def callers(self, doc_id: int) -> np.ndarray:
+        return self.caller_ids[self.caller_offsets[doc_id]:self.caller_offsets[doc_id + 1]]
+
+    def neighbors(self, doc_id: int, direction: str = "both") -> np.ndarray:
+        if direction == "callees":
+            return self.callees(doc_id)
+        if direction == "callers":
+            return self.callers(doc_id)
+        if direction == "both":
+            return np.concatenate((self.callees(doc_id), self.callers(doc_id)))
+        raise ValueError(f"Unsupported direction: {direction}. Supported: callees, callers, both")
+
+    def expand(self, seed_ids: Iterable[int], depth: int = 1, token_budget: int = DEFAULT_TOKEN_BUDGET, direction: str = "both") -> List[Tuple[int, int]]:
+        """
+        Returns (block id, distance) of the callers and/or callees of the seeds up to depth calls away, breadth first so closer blocks and neighbors of earlier seeds come first.
+        Blocks that would exceed the token budget are skipped, smaller ones further away may still fit.
+        """
+        frontier = [int(doc_id) for doc_id in seed_ids]
+        visited = set(frontier)
+        expanded, used = [], 0
+        for distance in range(1, depth + 1):
+            next_frontier = []
+            for doc_id in frontier:
+                for neighbor in self.neighbors(doc_id, direction).tolist():
+                    if neighbor not in visited:
+                        visited.add(neighbor)
+                        next_frontier.append(neighbor)
+            for neighbor in next_frontier:
+                if used + self.token_counts[neighbor] <= token_budget:
+                    used += int(self.token_counts[neighbor])
+                    expanded.append((neighbor, distance))
+            frontier = next_frontier
+        return expanded
+
+    def expand_documents(self, documents: Sequence[Document], depth: int = 1, token_budget: int = DEFAULT_TOKEN_BUDGET, direction: str = "both") -> List[Document]:
+        """
+        Returns the documents followed by their call graph neighbors (see expand()), each marked with its call_distance in metadata.
+        """
+        seeds = [doc_id for doc_id in (self.key_to_id.get(block_key(document.metadata)) for document in documents) if doc_id is not None]
+        neighbors = [Document(page_content=self.store.text(doc_id, self.view), metadata=dict(self.store.metadata(doc_id), call_distance=distance))
+                     for doc_id, distance in self.expand(seeds, depth, token_budget, direction)]
+        return list(documents) + neighbors
@@ -0,0 +1,212 @@
+from bisect import bisect_left
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+import re
+import numpy as np
+
+from index_files import MappedTexts, load_array, load_manifest, save_array, save_manifest, save_texts
+
+WORD_PATTERN = re.compile(r'[A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*')  # Dotted names (os.path.join) are one word
+IDENTIFIER_PART_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+
+
+def split_identifier(name: str) -> List[str]:
+    """
+    Splits an identifier into lowercase word tokens on snake_case, camelCase and dotted boundaries.
+    e.g "TaggedJSONSerializer.get_scores" -> ["tagged", "json", "serializer", "get", "scores"]
+    """
+    return [part.lower() for part in IDENTIFIER_PART_PATTERN.findall(name)]
+
+
+class Vocabulary:
+    """
+    Maps tokens to compact integer ids. BM25 postings are then keyed by ints instead of strings.
+    Built while indexing and only read at query time, so queries and documents always agree on ids.
+    """
+    def __init__(self):
+        self.token_to_id: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.token_to_id)
+
+    def __contains__(self, token: str) -> bool:
+        return token in self.token_to_id
+
+    def add(self, tokens: Iterable[str]) -> List[int]:
+        ids = []
+        for token in tokens:
+            token_id = self.token_to_id.get(token)
+            if token_id is None:
+                token_id = self.token_to_id[token] = len(self.token_to_id)
+            ids.append(token_id)
+        return ids
+
+    def lookup(self, tokens: Iterable[str]) -> List[int]:
+        """
+        Returns ids of known tokens, dropping unknown ones as they cannot match any document.
+        """
+        return [self.token_to_id[token] for token in tokens if token in self.token_to_id]
+
+    def save(self, directory: Union[str, Path]):
+        """
+        Saves the tokens sorted with their ids, for loading as a MappedVocabulary.
+        """
+        tokens = sorted(self.token_to_id)
+        save_texts(directory, "tokens", tokens)
+        save_array(directory, "token_ids", np.asarray([self.token_to_id[token] for token in tokens], dtype=np.int64))
+
+
+class MappedVocabulary:
+    """
+    Read-only Vocabulary over the memory mapped tokens saved with Vocabulary.save(). Tokens are found by binary search, so loading reads nothing.
+    """
+    def __init__(self, directory: Union[str, Path]):
+        self.tokens = MappedTexts(directory, "tokens")
+        self.ids = load_array(directory, "token_ids")
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def __contains__(self, token: str) -> bool:
+        return self.__find(token) is not None
+
+    def add(self, tokens: Iterable[str]) -> List[int]:
+        raise TypeError("A loaded vocabulary is read-only, encode documents with a new tokenizer")
+
+    def lookup(self, tokens: Iterable[str]) -> List[int]:
+        positions = (self.__find(token) for token in tokens)
+        return [int(self.ids[position]) for position in positions if position is not None]
+
+    def save(self, directory: Union[str, Path]):
+        save_texts(directory, "tokens", self.tokens)
+        save_array(directory, "token_ids", self.ids)
+
+    def __find(self, token: str) -> Optional[int]:
+        position = bisect_left(self.tokens, token)
+        if position < len(self.tokens) and self.tokens[position] == token:
+            return position
+        return None
+
+
+class CodeTokenizer:
+    """
+    Lexical tokenizer for code blocks and natural language questions about them.
+
+    Words are split into identifier parts on snake_case, camelCase and dotted boundaries, keeping the whole identifier (and the whole dotted name) as well so exact names still score highest:
+    "TaggedJSONSerializer" -> ["taggedjsonserializer", "tagged", "json", "serializer"]
+    "os.path.join" -> ["os.path.join", "os", "path", "join"]
+
+    Options:
+    - stem: reduce parts to their English stem ("serializer" -> "serial"), needs snowballstemmer
+    - ngram_size: also index character n-grams of every part. At query time only words missing from the vocabulary fall back to their n-grams, e.g for typos or partial names
+    - min_token_len: parts shorter than this are dropped
+
+    Documents are encoded with encode_corpus(), which builds the vocabulary, and queries with encode_query(), which only looks it up.
+    """
+    def __init__(self, stem: bool = False, ngram_size: Optional[int] = None, min_token_len: int = 2):
+        self.stemmer = None
+        if stem:
+            try:
+                import snowballstemmer
+            except ImportError:
+                raise ImportError("Could not import snowballstemmer, please install with `pip install snowballstemmer`.")
+            self.stemmer = snowballstemmer.stemmer("english")
+        self.stems: Dict[str, str] = {}  # Stemming is slow and identifiers repeat a lot
+        self.ngram_size = ngram_size
+        self.min_token_len = min_token_len
+        self.vocabulary = Vocabulary()
+
+    def save(self, directory: Union[str, Path]):
+        """
+        Saves the settings and vocabulary, so queries are encoded like the documents of an index saved alongside.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        self.vocabulary.save(directory)
+        save_manifest(directory, "tokenizer", stem=self.stemmer is not None, ngram_size=self.ngram_size, min_token_len=self.min_token_len)
+
+    @classmethod
+    def load(cls, directory: Union[str, Path]) -> "CodeTokenizer":
+        """
+        Loads a tokenizer saved with save(), for encoding queries only: its vocabulary is a read-only MappedVocabulary.
+        """
+        manifest = load_manifest(directory, "tokenizer")
+        tokenizer = cls(stem=manifest["stem"], ngram_size=manifest["ngram_size"], min_token_len=manifest["min_token_len"])
+        tokenizer.vocabulary = MappedVocabulary(directory)
+        return tokenizer
+
+    def tokenize(self, text: str) -> List[str]:
+        """
+        Splits text into word and identifier part tokens (without n-grams).
+        """
+        tokens = []
+        for word in WORD_PATTERN.findall(text):
+            names = word.split(".")
+            if len(names) > 1:
+                tokens.append(word.lower())
+            for name in names:
+                parts = split_identifier(name)
+                whole = name.lower()
+                if len(parts) > 1 and len(whole) >= self.min_token_len:
+                    tokens.append(whole)
+                tokens.extend(self.__normalize(part) for part in parts if len(part) >= self.min_token_len)
+        return tokens
+
+    def encode_corpus(self, texts: Iterable[str]) -> List[List[int]]:
+        """
+        Tokenizes documents into token ids, adding new tokens to the vocabulary.
+        """
+        encoded = []
+        for text in texts:
+            tokens = self.tokenize(text)
+            if self.ngram_size:
+                tokens.extend(gram for token in list(tokens) for gram in self.__ngrams(token))
+            encoded.append(self.vocabulary.add(tokens))
+        return encoded
+
+    def encode_query(self, text: str) -> List[int]:
+        """
+        Tokenizes a query into token ids. Unknown tokens fall back to their n-grams if enabled, otherwise they are dropped.
+        """
+        ids = []
+        for token in self.tokenize(text):
+            if token in self.vocabulary:
+                ids.extend(self.vocabulary.lookup([token]))
+            elif self.ngram_size:
+                ids.extend(self.vocabulary.lookup(self.__ngrams(token)))
+        return ids
+
+    def __normalize(self, part: str) -> str:
+        if self.stemmer is None:
+            return part
+        stem = self.stems.get(part)
+        if stem is None:
+            stem = self.stems[part] = self.stemmer.stemWord(part)
+        return stem
+
+    def __ngrams(self, token: str) -> List[str]:
+        # '#' marks n-grams so they never collide with a real word
+        return [f"#{token[i:i + self.ngram_size]}" for i in range(len(token) - self.ngram_size + 1)]
+
+
+class CharWindowTokenizer:
+    """
+    Overlapping character windows, the original BM25 preprocessing of HybridSearch/EnsembleSearch.
+    Kept for comparison in benchmarks. Unlike the original splitters, documents and queries are lowercased and split with the same stride.
+    """
+    def __init__(self, token_len: int = 2, overlap: int = 1):
+        self.token_len = token_len
+        self.overlap = overlap
+        self.vocabulary = Vocabulary()
+
+    def tokenize(self, text: str) -> List[str]:
+        text = text.lower().replace("_", " ")
+        return [text[x - self.overlap:min(x + self.token_len, len(text))]
+                for x in range(self.overlap, len(text), self.token_len - self.overlap)]
+
+    def encode_corpus(self, texts: Iterable[str]) -> List[List[int]]:
+        return [self.vocabulary.add(self.tokenize(text)) for text in texts]
+
+    def encode_query(self, text: str) -> List[int]:
+        return self.vocabulary.lookup(self.tokenize(text))
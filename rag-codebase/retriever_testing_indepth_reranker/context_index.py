@@ -0,0 +1,99 @@
+from collections import defaultdict
+from langchain_core.documents import Document
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from document_store import DocumentStore, block_key
+
+STUB_PREFIX = "# Code for"
+
+
+def skeleton(content: str, metadata: Dict, children: Sequence[Dict]) -> str:
+    """
+    Compact outline of a parent block: its header (the lines before its first child stub or body) plus a "Code for" stub per child.
+    Class blocks from the AST loader already are their header plus method stubs, so they are kept as is.
+    """
+    if metadata.get("block_type") == "class" and STUB_PREFIX in content:
+        return content.rstrip("\n")
+    header = content.split("\n", 1)[0]
+    stubs = []
+    for child in children:
+        args = ", ".join(child.get("block_args", []))
+        stubs.append(f"{STUB_PREFIX} {child.get('block_type')}: {metadata.get('block_name')}.{child.get('block_name')}({args})")
+    return "\n".join([header] + stubs)
+
+
+class ContextIndex:
+    """
+    Parent/child adjacency of the blocks of a DocumentStore, used to add the enclosing class (or function) of each retrieved block to its context.
+
+    Parents are found from the parent_type, parent_name and offsets recorded by the AST loader: the closest preceding block of the same file with that type and name.
+    Children are stored in CSR layout (children of block i are child_ids[child_offsets[i]:child_offsets[i + 1]], in file order), so parents, children and siblings are array lookups.
+    The skeleton of every parent is computed once, expansion then costs a dict lookup per retrieved block.
+    """
+    def __init__(self, store: DocumentStore):
+        self.store = store
+        self.key_to_id: Dict[Tuple[str, int, int], int] = {block_key(store.metadata(doc_id)): doc_id for doc_id in store.ids}
+
+        # (file, type, name) -> [(start offset, block id)], to resolve parent names within a file
+        named: Dict[Tuple[str, str, str], List[Tuple[int, int]]] = defaultdict(list)
+        for doc_id in store.ids:
+            metadata = store.metadata(doc_id)
+            if metadata.get("block_type") in ("class", "function"):
+                named[(str(metadata.get("relative_path")), metadata["block_type"], metadata.get("block_name"))].append((metadata.get("start_offset", 0), doc_id))
+
+        self.parent = np.full(len(store), -1, dtype=np.int64)
+        children = defaultdict(list)
+        for doc_id in store.ids:
+            metadata = store.metadata(doc_id)
+            if metadata.get("parent_type") not in ("class", "function"):
+                continue
+            candidates = named.get((str(metadata.get("relative_path")), metadata["parent_type"], metadata.get("parent_name")), [])
+            preceding = [(start, parent_id) for start, parent_id in candidates if start <= metadata.get("start_offset", 0) and parent_id != doc_id]
+            if preceding:
+                parent_id = max(preceding)[1]
+                self.parent[doc_id] = parent_id
+                children[parent_id].append((metadata.get("start_offset", 0), doc_id))
+
+        self.child_offsets = np.zeros(len(store) + 1, dtype=np.int64)
+        np.cumsum([len(children.get(doc_id, ())) for doc_id in store.ids], out=self.child_offsets[1:])
+        self.child_ids = np.asarray([doc_id for parent_id in store.ids for _, doc_id in sorted(children.get(parent_id, ()))], dtype=np.int64)
+
+        self.skeletons: Dict[int, str] = {
+            parent_id: skeleton(store.content(parent_id), store.metadata(parent_id),
+                                [store.metadata(int(child_id)) for child_id in self.children(parent_id)])
+            for parent_id in children}
+
+    def block_id(self, metadata: Dict) -> Optional[int]:
+        """
+        Returns the id of the block a retrieved document came from, None if it is not in the store.
+        """
+        return self.key_to_id.get(block_key(metadata))
+
+    def children(self, doc_id: int) -> np.ndarray:
+        return self.child_ids[self.child_offsets[doc_id]:self.child_offsets[doc_id + 1]]
+
+    def siblings(self, doc_id: int) -> np.ndarray:
+        parent_id = self.parent[doc_id]
+        if parent_id == -1:
+            return np.empty(0, dtype=np.int64)
+        children = self.children(parent_id)
+        return children[children != doc_id]
+
+    def expand(self, documents: Sequence[Document]) -> List[Document]:
+        """
+        Returns copies of the documents with the skeleton of their parent (class header and "Code for" stubs of the block and its siblings) prepended.
+        Blocks without a parent, or whose parent is itself among the documents, are returned unchanged.
+        """
+        doc_ids = [self.block_id(document.metadata) for document in documents]
+        retrieved = set(doc_ids)
+        expanded = []
+        for document, doc_id in zip(documents, doc_ids):
+            parent_id = -1 if doc_id is None else int(self.parent[doc_id])
+            if parent_id == -1 or parent_id in retrieved:
+                expanded.append(document)
+                continue
+            metadata = dict(document.metadata, context_parent=block_key(self.store.metadata(parent_id)))
+            expanded.append(Document(page_content=f"{self.skeletons[parent_id]}\n\n{document.page_content}", metadata=metadata))
+        return expanded
@@ -0,0 +1,340 @@
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+import faiss
+import numpy as np
+
+from index_files import load_array, load_manifest, save_array, save_manifest
+
+DEFAULT_COMPACT_RATIO = 0.25  # Compact once this fraction of slots is deleted
+SAVE_CHUNK_ROWS = 65536  # Mapped vectors copied at a time when saving
+
+
+class DenseIndex:
+    """
+    Exact (flat L2) vector index addressed by stable block ids instead of positions, like a FAISS IndexIDMap, that can be updated in place.
+
+    Vectors live in slots of a faiss.IndexFlatL2. Adding appends slots and removing only marks them deleted, so both take time proportional to the number of vectors changed.
+    Deleted slots are excluded from searches with an ID selector bitmap, and once more than compact_ratio of the slots are deleted the live vectors are copied into a fresh index.
+    Block ids never change, so they can be used as keys of the document store and of cached results across updates.
+
+    Blocks can optionally be grouped by file path, so that a changed file is replaced with upsert_file() and a deleted one dropped with remove_file().
+    """
+    def __init__(self, dim: int, compact_ratio: float = DEFAULT_COMPACT_RATIO):
+        self.dim = dim
+        self.compact_ratio = compact_ratio
+        self.index = faiss.IndexFlatL2(dim)
+        self.slot_ids = np.empty(0, dtype=np.int64)  # Slot -> block id, -1 if deleted
+        self.id_to_slot: Dict[int, int] = {}
+        self.file_ids: Dict[str, Set[int]] = defaultdict(set)
+        self.id_to_file: Dict[int, str] = {}
+        self.next_id = 0
+        self._num_deleted = 0
+        self._live_bitmap: Optional[np.ndarray] = None  # Packed bitmap of live slots, rebuilt on the next search after a change
+
+    def __len__(self) -> int:
+        return len(self.id_to_slot)
+
+    @property
+    def ntotal(self) -> int:
+        """
+        Number of stored vectors, including deleted slots not compacted yet.
+        """
+        return self.index.ntotal
+
+    def __contains__(self, block_id: int) -> bool:
+        return block_id in self.id_to_slot
+
+    @property
+    def ids(self) -> List[int]:
+        return list(self.id_to_slot)
+
+    def allocate_ids(self, n: int) -> np.ndarray:
+        """
+        Returns n block ids that have never been used by this index.
+        """
+        ids = np.arange(self.next_id, self.next_id + n, dtype=np.int64)
+        self.next_id += n
+        return ids
+
+    def add(self, ids: Sequence[int], vectors: np.ndarray, path: Optional[str] = None):
+        """
+        Adds vectors under new block ids, optionally grouped under a file path.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(ids), self.dim)
+        for block_id in ids.tolist():
+            if block_id in self.id_to_slot:
+                raise ValueError(f"Block id {block_id} is already in the index, remove it first or use upsert_file()")
+
+        first_slot = self.ntotal
+        self.index.add(vectors)
+        self.slot_ids = np.concatenate((self.slot_ids, ids))
+        for offset, block_id in enumerate(ids.tolist()):
+            self.id_to_slot[block_id] = first_slot + offset
+            if path is not None:
+                self.file_ids[path].add(block_id)
+                self.id_to_file[block_id] = path
+        if len(ids):
+            self.next_id = max(self.next_id, int(ids.max()) + 1)
+        self._live_bitmap = None
+
+    def remove(self, ids: Iterable[int]) -> int:
+        """
+        Marks the vectors of the given block ids deleted, returning how many were in the index.
+        """
+        removed = 0
+        for block_id in ids:
+            slot = self.id_to_slot.pop(int(block_id), None)
+            if slot is None:
+                continue
+            self.slot_ids[slot] = -1
+            path = self.id_to_file.pop(int(block_id), None)
+            if path is not None:
+                self.file_ids[path].discard(int(block_id))
+                if not self.file_ids[path]:
+                    del self.file_ids[path]
+            removed += 1
+        self._num_deleted += removed
+        if removed:
+            self._live_bitmap = None
+        if self._num_deleted > self.compact_ratio * self.ntotal:
+            self.compact()
+        return removed
+
+    def remove_file(self, path: str) -> List[int]:
+        """
+        Removes every block of a file, returning their ids.
+        """
+        ids = sorted(self.file_ids.get(path, ()))
+        self.remove(ids)
+        return ids
+
+    def upsert_file(self, path: str, vectors: np.ndarray, ids: Optional[Sequence[int]] = None) -> Tuple[List[int], np.ndarray]:
+        """
+        Replaces every block of a file with the given vectors.
+        New block ids are allocated unless given. Returns (removed ids, added ids).
+        """
+        removed = self.remove_file(path)
+        ids = self.allocate_ids(len(vectors)) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.add(ids, vectors, path)
+        return removed, ids
+
+    def compact(self):
+        """
+        Copies the live vectors into a fresh index, dropping deleted slots. Block ids are unchanged.
+        """
+        live_slots = np.flatnonzero(self.slot_ids != -1)
+        vectors = self.index.reconstruct_batch(live_slots) if len(live_slots) else np.empty((0, self.dim), dtype=np.float32)
+        self.index = faiss.IndexFlatL2(self.dim)
+        self.index.add(vectors)
+        self.slot_ids = self.slot_ids[live_slots]
+        self.id_to_slot = {block_id: slot for slot, block_id in enumerate(self.slot_ids.tolist())}
+        self._num_deleted = 0
+        self._live_bitmap = None
+
+    def copy(self) -> "DenseIndex":
+        """
+        Returns an independent copy, e.g to update the next version of an index while readers search this one.
+        """
+        clone = DenseIndex.__new__(DenseIndex)
+        clone.__dict__.update(self.__dict__)
+        clone.index = faiss.clone_index(self.index)
+        clone.slot_ids = self.slot_ids.copy()
+        clone.id_to_slot = dict(self.id_to_slot)
+        clone.file_ids = defaultdict(set, {path: set(ids) for path, ids in self.file_ids.items()})
+        clone.id_to_file = dict(self.id_to_file)
+        return clone
+
+    def save(self, directory: Union[str, Path]):
+        """
+        Saves the live vectors as one float32 matrix with the block id of every row, which MappedDenseIndex memory maps.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        live_slots = np.flatnonzero(self.slot_ids != -1)
+        vectors = self.index.reconstruct_batch(live_slots) if len(live_slots) else np.empty((0, self.dim), dtype=np.float32)
+        save_array(directory, "vectors", vectors)
+        save_array(directory, "block_ids", self.slot_ids[live_slots])
+        save_manifest(directory, "dense", dim=self.dim, next_id=self.next_id,
+                      files={path: sorted(ids) for path, ids in self.file_ids.items()})
+
+    def vectors(self, ids: Sequence[int]) -> np.ndarray:
+        """
+        Returns the stored vectors of the given block ids.
+        """
+        slots = np.asarray([self.id_to_slot[int(block_id)] for block_id in ids], dtype=np.int64)
+        return self.index.reconstruct_batch(slots)
+
+    def search(self, query_vectors: np.ndarray, k: int, ids: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (L2 distances, block ids) of the k nearest live vectors for each query, -1 ids where there are fewer than k.
+        ids restricts the search to the given block ids.
+        """
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32).reshape(-1, self.dim)
+        bitmap = None
+        if ids is not None:
+            mask = np.zeros(self.ntotal, dtype=bool)
+            mask[[self.id_to_slot[int(block_id)] for block_id in ids if int(block_id) in self.id_to_slot]] = True
+            bitmap = np.packbits(mask, bitorder="little")
+        elif self._num_deleted:
+            if self._live_bitmap is None:
+                self._live_bitmap = np.packbits(self.slot_ids != -1, bitorder="little")
+            bitmap = self._live_bitmap
+
+        params = None
+        if bitmap is not None:
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)))
+        distances, slots = self.index.search(query_vectors, k, params=params)
+        return distances, np.where(slots == -1, -1, self.slot_ids[slots])
+
+
+class MappedDenseIndex:
+    """
+    DenseIndex over a memory mapped vector matrix saved with DenseIndex.save().
+    Searches run brute force (faiss.knn) directly on the mapped pages, so every process mapping the same files shares one copy of the vectors in the page cache and loading is instant.
+
+    The mapped files are never modified. Removed blocks are masked out and added vectors kept in a small in-memory DenseIndex searched alongside, so copy() and updates never read the mapped matrix.
+    save() writes the live mapped vectors and the added ones to a new matrix.
+    """
+    def __init__(self, directory: Union[str, Path]):
+        manifest = load_manifest(directory, "dense")
+        self.dim = manifest["dim"]
+        self.next_id = manifest["next_id"]
+        self.matrix = load_array(directory, "vectors")
+        self.slot_ids = load_array(directory, "block_ids")
+        self.id_to_slot: Dict[int, int] = {block_id: slot for slot, block_id in enumerate(self.slot_ids.tolist())}
+        self.file_ids: Dict[str, Set[int]] = {path: set(ids) for path, ids in manifest["files"].items()}  # Files of the mapped vectors
+        self.live: Optional[np.ndarray] = None  # Mask of the mapped slots not removed, None while none are
+        self.added = DenseIndex(self.dim)  # Vectors added since the matrix was saved
+
+    @property
+    def ntotal(self) -> int:
+        """
+        Number of stored vectors, same as DenseIndex.ntotal.
+        """
+        return len(self.slot_ids) + self.added.ntotal
+
+    def __len__(self) -> int:
+        return len(self.id_to_slot) + len(self.added)
+
+    def __contains__(self, block_id: int) -> bool:
+        return block_id in self.id_to_slot or block_id in self.added
+
+    @property
+    def ids(self) -> List[int]:
+        return list(self.id_to_slot) + self.added.ids
+
+    def allocate_ids(self, n: int) -> np.ndarray:
+        ids = np.arange(self.next_id, self.next_id + n, dtype=np.int64)
+        self.next_id += n
+        return ids
+
+    def remove_file(self, path: str) -> List[int]:
+        """
+        Removes every block of a file, returning their ids. Mapped vectors are only masked out.
+        """
+        ids = sorted(self.file_ids.pop(path, ()))
+        if ids and self.live is None:
+            self.live = np.ones(len(self.slot_ids), dtype=bool)
+        for block_id in ids:
+            self.live[self.id_to_slot.pop(block_id)] = False
+        return ids + self.added.remove_file(path)
+
+    def upsert_file(self, path: str, vectors: np.ndarray, ids: Optional[Sequence[int]] = None) -> Tuple[List[int], np.ndarray]:
+        """
+        Same as DenseIndex.upsert_file(), the new vectors are kept in memory until save().
+        """
+        removed = self.remove_file(path)
+        ids = self.allocate_ids(len(vectors)) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.added.add(ids, vectors, path)
+        self.next_id = max(self.next_id, self.added.next_id)
+        return removed, ids
+
+    def copy(self) -> "MappedDenseIndex":
+        """
+        Returns an independent copy sharing the mapped vectors, e.g to update the next version of an index while readers search this one.
+        Only the id maps and the added vectors are copied.
+        """
+        clone = MappedDenseIndex.__new__(MappedDenseIndex)
+        clone.__dict__.update(self.__dict__)
+        clone.id_to_slot = dict(self.id_to_slot)
+        clone.file_ids = {path: set(ids) for path, ids in self.file_ids.items()}
+        clone.live = None if self.live is None else self.live.copy()
+        clone.added = self.added.copy()
+        return clone
+
+    def save(self, directory: Union[str, Path]):
+        """
+        Saves the live vectors in the same format as DenseIndex.save(). Mapped vectors are copied in chunks, so the matrix is never loaded whole.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        mapped_slots = np.arange(len(self.slot_ids)) if self.live is None else np.flatnonzero(self.live)
+        added_ids = np.asarray(self.added.ids, dtype=np.int64)
+        total = len(mapped_slots) + len(added_ids)
+        if total:
+            vectors = np.lib.format.open_memmap(directory / "vectors.npy", mode="w+", dtype=np.float32, shape=(total, self.dim))
+            for start in range(0, len(mapped_slots), SAVE_CHUNK_ROWS):
+                slots = mapped_slots[start:start + SAVE_CHUNK_ROWS]
+                vectors[start:start + len(slots)] = self.matrix[slots]
+            if len(added_ids):
+                vectors[len(mapped_slots):] = self.added.vectors(added_ids)
+            vectors.flush()
+            del vectors
+        else:
+            save_array(directory, "vectors", np.empty((0, self.dim), dtype=np.float32))
+        save_array(directory, "block_ids", np.concatenate((self.slot_ids[mapped_slots], added_ids)))
+        files = {path: set(ids) for path, ids in self.file_ids.items()}
+        for path, ids in self.added.file_ids.items():
+            files.setdefault(path, set()).update(ids)
+        save_manifest(directory, "dense", dim=self.dim, next_id=self.next_id, files={path: sorted(ids) for path, ids in files.items()})
+
+    def vectors(self, ids: Sequence[int]) -> np.ndarray:
+        ids = [int(block_id) for block_id in ids]
+        vectors = np.empty((len(ids), self.dim), dtype=np.float32)
+        mapped = [i for i, block_id in enumerate(ids) if block_id in self.id_to_slot]
+        vectors[mapped] = self.matrix[[self.id_to_slot[ids[i]] for i in mapped]]
+        added = [i for i, block_id in enumerate(ids) if block_id not in self.id_to_slot]
+        if added:
+            vectors[added] = self.added.vectors([ids[i] for i in added])
+        return vectors
+
+    def search(self, query_vectors: np.ndarray, k: int, ids: Optional[Sequence[int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as DenseIndex.search().
+        """
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32).reshape(-1, self.dim)
+        distances, result_ids = self.__search_mapped(query_vectors, k, ids)
+        added_ids = None if ids is None else [block_id for block_id in ids if int(block_id) in self.added]
+        if len(self.added) and (added_ids is None or added_ids):
+            added_distances, added_result = self.added.search(query_vectors, k, added_ids)
+            distances = np.concatenate((distances, np.where(added_result == -1, np.inf, added_distances)), axis=1)
+            result_ids = np.concatenate((result_ids, added_result), axis=1)
+            order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+            distances, result_ids = np.take_along_axis(distances, order, 1), np.take_along_axis(result_ids, order, 1)
+        return distances, result_ids
+
+    def __search_mapped(self, query_vectors: np.ndarray, k: int, ids: Optional[Sequence[int]]) -> Tuple[np.ndarray, np.ndarray]:
+        matrix, block_ids = self.matrix, self.slot_ids
+        live = None
+        if ids is not None:
+            slots = np.asarray(sorted(self.id_to_slot[int(block_id)] for block_id in ids if int(block_id) in self.id_to_slot), dtype=np.int64)
+            matrix, block_ids = self.matrix[slots], self.slot_ids[slots]
+        elif self.live is not None:
+            live = self.live
+        # Removed vectors are searched past rather than copying the live ones out of the mapped matrix
+        extra = 0 if live is None else len(live) - int(np.count_nonzero(live))
+        found = min(k + extra, len(block_ids))
+        distances = np.full((len(query_vectors), k), np.inf, dtype=np.float32)
+        result_ids = np.full((len(query_vectors), k), -1, dtype=np.int64)
+        if not found:
+            return distances, result_ids
+        found_distances, slots = faiss.knn(query_vectors, matrix, found)
+        for row in range(len(query_vectors)):
+            keep = slice(None) if live is None else live[slots[row]]
+            row_distances, row_slots = found_distances[row][keep][:k], slots[row][keep][:k]
+            distances[row, :len(row_slots)] = row_distances
+            result_ids[row, :len(row_slots)] = block_ids[row_slots]
+        return distances, result_ids
@@ -0,0 +1,165 @@
+from langchain_core.documents import Document
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple, Union
+
+import json
+import re
+
+from index_files import MappedTexts, load_manifest, save_manifest, save_texts
+
+CODE_WORD_PATTERN = re.compile('[a-zA-Z0-9]+')
+IDENTIFIER_WORD_PATTERN = re.compile(r'[A-Za-z0-9_]+(?:\.[A-Za-z0-9_]+)*')
+
+
+def block_key(metadata: Dict) -> Tuple[str, int, int]:
+    """
+    Identifies a code block across indexes and retrieval backends, which may return different text for the same block.
+    """
+    return str(metadata.get("relative_path")), metadata.get("start_offset"), metadata.get("end_offset")
+
+
+def raw_view(page_content: str, metadata: Dict) -> str:
+    """
+    Code block exactly as returned by the AST document loader.
+    """
+    return page_content
+
+
+def with_header(code_words: List[str], metadata: Dict) -> str:
+    return f"Block Type: {metadata['block_type']} \n\
+                Relative Path: {metadata['relative_path']},{metadata['start_offset']},{metadata['end_offset']} \n \
+                Block Name: {metadata['block_name']} \n\
+                Arguments: {' '.join(metadata['block_args'])} \n\
+                Code: {' '.join(code_words)}"
+
+
+def header_view(page_content: str, metadata: Dict) -> str:
+    """
+    Code block augmented with a metadata header and stripped of punctuation.
+    This is the text the embedding model is built on and retrievers return.
+    """
+    return with_header(CODE_WORD_PATTERN.findall(page_content), metadata)
+
+
+def lexical_view(page_content: str, metadata: Dict) -> str:
+    """
+    Header view keeping identifiers whole (snake_case and dotted names) for the BM25 tokenizer, which splits them into parts itself.
+    """
+    return with_header(IDENTIFIER_WORD_PATTERN.findall(page_content), metadata)
+
+
+class DocumentStore:
+    """
+    Holds the text and metadata of every code block in a corpus exactly once, so that several retrievers can be built over the same documents without each keeping its own copy.
+
+    Blocks are referred to by integer id (their position in the loader output).
+    Retrievers ask the store for a derived text view (e.g "lexical" for BM25, "header" for embeddings) which is computed lazily on first use and then cached and shared by every retriever using that view.
+
+    The store never mutates the loader's documents. Anything handed out for a caller to modify (e.g reranker output) should go through detach().
+    """
+    VIEWS: Dict[str, Callable[[str, Dict], str]] = {
+        "raw": raw_view,
+        "header": header_view,
+        "lexical": lexical_view
+    }
+
+    def __init__(self, documents: Iterable[Document], views: Dict[str, Callable[[str, Dict], str]] = None):
+        contents, metadatas = [], []
+        for document in documents:
+            contents.append(document.page_content)
+            metadatas.append(document.metadata)
+        self._contents: Tuple[str, ...] = tuple(contents)
+        self._metadatas: Tuple[Dict, ...] = tuple(metadatas)
+
+        self._view_funcs = dict(DocumentStore.VIEWS)
+        if views:
+            self._view_funcs.update(views)
+        self._texts: Dict[str, Tuple[str, ...]] = {}  # Cached text per view
+        self._documents: Dict[str, List[Document]] = {}  # Cached Document objects per view
+        self._derived: Dict[str, Any] = {}  # Cached indexes built over the whole store
+
+    @classmethod
+    def from_documents(cls, documents: Union["DocumentStore", Iterable[Document]]) -> "DocumentStore":
+        """
+        Returns the given store as is, or builds a new store from a list of documents.
+        Lets retrievers accept either so that callers can share one store between them.
+        """
+        if isinstance(documents, DocumentStore):
+            return documents
+        return cls(documents)
+
+    def save(self, directory: Union[str, Path]):
+        """
+        Saves the contents and metadata of every block, in id order, for load().
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        save_texts(directory, "contents", self._contents)
+        save_texts(directory, "metadata", (json.dumps(metadata, default=str) for metadata in self._metadatas))
+        save_manifest(directory, "documents", size=len(self._contents))
+
+    @classmethod
+    def load(cls, directory: Union[str, Path], views: Dict[str, Callable[[str, Dict], str]] = None) -> "DocumentStore":
+        """
+        Loads a store saved with save(), directory can also be a directory inside an IndexBundle.
+        Blocks keep their ids. Contents are decoded up front since views are computed from all of them.
+        """
+        load_manifest(directory, "documents")
+        contents, metadatas = MappedTexts(directory, "contents"), MappedTexts(directory, "metadata")
+        return cls((Document(page_content=content, metadata=json.loads(metadata)) for content, metadata in zip(contents, metadatas)), views)
+
+    def __len__(self) -> int:
+        return len(self._contents)
+
+    @property
+    def ids(self) -> range:
+        return range(len(self._contents))
+
+    def content(self, doc_id: int) -> str:
+        return self._contents[doc_id]
+
+    def metadata(self, doc_id: int) -> Dict:
+        return self._metadatas[doc_id]
+
+    def texts(self, view: str = "header") -> Tuple[str, ...]:
+        """
+        Returns the text of every block for the given view, computing it on first use.
+        """
+        if view not in self._texts:
+            view_func = self._view_funcs[view]
+            self._texts[view] = tuple(view_func(content, metadata) for content, metadata in zip(self._contents, self._metadatas))
+        return self._texts[view]
+
+    def text(self, doc_id: int, view: str = "header") -> str:
+        return self.texts(view)[doc_id]
+
+    def documents(self, view: str = "header") -> List[Document]:
+        """
+        Returns a Document per block for the given view, computing it on first use.
+        The Documents share their metadata dict with the store instead of copying it, so treat them as read-only.
+        """
+        if view not in self._documents:
+            # model_construct skips pydantic validation, which would otherwise copy every metadata dict
+            self._documents[view] = [Document.model_construct(page_content=text, metadata=metadata)
+                                     for text, metadata in zip(self.texts(view), self._metadatas)]
+        return self._documents[view]
+
+    def document(self, doc_id: int, view: str = "header") -> Document:
+        return self.documents(view)[doc_id]
+
+    def derived(self, name: str, factory: Callable[["DocumentStore"], Any]) -> Any:
+        """
+        Returns a structure derived from the whole store (e.g a metadata index), building it with factory(store) on first use.
+        Lets retrievers over the same store share one copy of it.
+        """
+        if name not in self._derived:
+            self._derived[name] = factory(self)
+        return self._derived[name]
+
+    @staticmethod
+    def detach(documents: Sequence[Document]) -> List[Document]:
+        """
+        Shallow copies documents so that callers (e.g rerankers writing relevance scores into metadata) cannot modify the store.
+        """
+        return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in documents]
+
@@ -0,0 +1,85 @@
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence
+
+import faiss
+import numpy as np
+
+from code_tokenizer import CodeTokenizer, split_identifier
+from document_store import CODE_WORD_PATTERN, DocumentStore
+from lexical_index import BM25Index
+from metadata_index import normalize_path
+from rank_fusion import weighted_reciprocal_rank
+
+DEFAULT_MAX_MODULE_CHARS = 2000  # Module level code kept per file summary, imports and constants come first
+
+
+def file_summary(path: str, metadatas: Sequence[Dict], contents: Sequence[str], max_module_chars: int = DEFAULT_MAX_MODULE_CHARS) -> str:
+    """
+    Text describing a file for the file level index: its path, the names and docstrings of its blocks and the start of its module level ("Global Scope") code.
+    """
+    parts = [" ".join(split_identifier(path))]
+    for metadata, content in zip(metadatas, contents):
+        if metadata.get("block_type") in ("class", "function"):
+            parts.append(metadata.get("block_name", ""))
+        elif metadata.get("parent_type", "root") == "root":
+            parts.append(" ".join(CODE_WORD_PATTERN.findall(content[:max_module_chars])))
+        parts.extend(metadata.get("docstrings", []))
+    return "\n".join(parts)
+
+
+class FileIndex:
+    """
+    Compact file level index over the blocks of a retriever, used to pick the few files worth searching before any block is scored (hierarchical retrieval).
+
+    Files are ranked by BM25 over their summaries (see file_summary()) and by distance to the centroid of their block vectors, fused by weighted reciprocal rank.
+    Centroids come from the block vectors already computed for the dense index, so building the file index needs no extra embedding calls.
+    Positions are positions in the retriever's doc_ids, like the candidates of its bm25_search/faiss_search.
+    The tokenizer gets the summary vocabulary, so do not share it with a block level index.
+    """
+    def __init__(self, store: DocumentStore, doc_ids: Sequence[int], tokenizer: Optional[CodeTokenizer] = None,
+                 vectors: Optional[np.ndarray] = None, max_module_chars: int = DEFAULT_MAX_MODULE_CHARS):
+        self.tokenizer = tokenizer or CodeTokenizer()
+        positions_by_path: Dict[str, List[int]] = defaultdict(list)
+        for pos, doc_id in enumerate(doc_ids):
+            positions_by_path[normalize_path(store.metadata(int(doc_id)).get("relative_path", ""))].append(pos)
+        self.paths = sorted(positions_by_path)
+
+        # CSR layout: the positions of file i are positions[offsets[i]:offsets[i + 1]]
+        file_positions = [positions_by_path[path] for path in self.paths]
+        self.positions = np.asarray([pos for positions in file_positions for pos in positions], dtype=np.int64)
+        self.offsets = np.zeros(len(self.paths) + 1, dtype=np.int64)
+        np.cumsum([len(positions) for positions in file_positions], out=self.offsets[1:])
+
+        summaries = [file_summary(path,
+                                  [store.metadata(int(doc_ids[pos])) for pos in positions],
+                                  [store.content(int(doc_ids[pos])) for pos in positions],
+                                  max_module_chars)
+                     for path, positions in zip(self.paths, file_positions)]
+        self.bm25 = BM25Index(self.tokenizer.encode_corpus(summaries))
+
+        self.centroids = None
+        if vectors is not None:
+            self.centroids = np.stack([vectors[positions].mean(axis=0) for positions in file_positions]).astype(np.float32)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def top_files(self, query: str, n: int, query_vector: Optional[np.ndarray] = None, weights: Sequence[float] = (0.5, 0.5)) -> List[int]:
+        """
+        Returns the numbers of the n best matching files, best first.
+        Without a query vector (or block vectors) files are ranked by BM25 alone.
+        """
+        n = min(n, len(self.paths))
+        _, lexical = self.bm25.top_k(self.tokenizer.encode_query(query), n)
+        if query_vector is None or self.centroids is None:
+            return lexical.tolist()
+        _, dense = faiss.knn(np.asarray(query_vector, dtype=np.float32).reshape(1, -1), self.centroids, n)
+        return weighted_reciprocal_rank([lexical.tolist(), dense[0].tolist()], weights)[:n]
+
+    def file_positions(self, files: Sequence[int]) -> np.ndarray:
+        """
+        Returns the sorted positions of every block of the given files.
+        """
+        if len(files) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate([self.positions[self.offsets[i]:self.offsets[i + 1]] for i in files]))
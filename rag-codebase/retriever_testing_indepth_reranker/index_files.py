@@ -0,0 +1,241 @@
+from collections.abc import Mapping, Sequence
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Union
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy as np
+
+FORMAT_VERSION = 1
+BUNDLE_MAGIC = b"CRAGBNDL"
+BUNDLE_ALIGNMENT = 64  # Arrays start at multiples of this many bytes so that mapped views are aligned for SIMD loads
+
+
+def save_array(directory: Union[str, Path], name: str, array: np.ndarray):
+    np.save(Path(directory) / f"{name}.npy", np.ascontiguousarray(array))
+
+
+def load_array(directory: Union[str, Path], name: str, mmap: bool = True) -> np.ndarray:
+    """
+    Loads an array saved with save_array(), memory mapped read-only by default so that processes loading the same file share its pages.
+    """
+    if isinstance(directory, BundleDirectory):
+        return directory.array(name)
+    path = Path(directory) / f"{name}.npy"
+    if not mmap:
+        return np.load(path)
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:  # Empty arrays cannot be mapped
+        return np.load(path)
+
+
+def save_manifest(directory: Union[str, Path], kind: str, **fields: Any):
+    """
+    Writes the JSON manifest describing what kind of index a directory holds, plus its scalar settings.
+    """
+    with open(Path(directory) / f"{kind}.json", "w") as file:
+        json.dump({"format_version": FORMAT_VERSION, "kind": kind, **fields}, file)
+
+
+def load_manifest(directory: Union[str, Path], kind: str) -> Dict[str, Any]:
+    if isinstance(directory, BundleDirectory):
+        manifest = directory.manifest(kind)
+    else:
+        with open(Path(directory) / f"{kind}.json", "r") as file:
+            manifest = json.load(file)
+    if manifest.get("format_version") != FORMAT_VERSION or manifest.get("kind") != kind:
+        raise ValueError(f"{directory} does not hold a version {FORMAT_VERSION} {kind} index")
+    return manifest
+
+
+def save_texts(directory: Union[str, Path], name: str, texts: Iterable[str]):
+    """
+    Saves strings as one UTF-8 buffer plus the offset of every string in it, so single strings can be read without loading the others.
+    """
+    encoded = [text.encode() for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(data) for data in encoded], out=offsets[1:])
+    save_array(directory, f"{name}_data", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+    save_array(directory, f"{name}_offsets", offsets)
+
+
+class MappedTexts(Sequence):
+    """
+    Read-only sequence of the strings saved with save_texts(), decoded from the memory mapped buffer on access.
+    """
+    def __init__(self, directory: Union[str, Path], name: str):
+        self.data = load_array(directory, f"{name}_data")
+        self.offsets = load_array(directory, f"{name}_offsets")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i %= len(self)
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode()
+
+
+class PackedMapping(Mapping):
+    """
+    Read-only mapping over sorted integer keys and memory mapped values, e.g a token id -> posting list map loaded from disk.
+    With offsets, the value of keys[i] is the slice values[offsets[i]:offsets[i + 1]] (a view, nothing is copied), otherwise it is values[i].
+    """
+    def __init__(self, keys: np.ndarray, values: np.ndarray, offsets: Optional[np.ndarray] = None):
+        self.keys_array = keys
+        self.values_array = values
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.keys_array)
+
+    def __iter__(self):
+        return iter(self.keys_array.tolist())
+
+    def __contains__(self, key) -> bool:
+        return self.__find(key) is not None
+
+    def __getitem__(self, key):
+        i = self.__find(key)
+        if i is None:
+            raise KeyError(key)
+        if self.offsets is None:
+            return self.values_array[i].item()
+        return self.values_array[self.offsets[i]:self.offsets[i + 1]]
+
+    def __find(self, key) -> Optional[int]:
+        i = int(np.searchsorted(self.keys_array, key))
+        if i < len(self.keys_array) and self.keys_array[i] == key:
+            return i
+        return None
+
+
+def pack_mapping(directory: Union[str, Path], name: str, mapping: Dict[int, Any], ragged: bool = False):
+    """
+    Saves an integer keyed dict for loading as a PackedMapping. ragged saves array values concatenated with their offsets.
+    """
+    keys = np.asarray(sorted(mapping), dtype=np.int64)
+    save_array(directory, f"{name}_keys", keys)
+    if ragged:
+        values = [np.asarray(mapping[key]) for key in keys.tolist()]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in values], out=offsets[1:])
+        save_array(directory, f"{name}_values", np.concatenate(values) if values else np.empty(0))
+        save_array(directory, f"{name}_offsets", offsets)
+    else:
+        save_array(directory, f"{name}_values", np.asarray([mapping[key] for key in keys.tolist()]))
+
+
+def load_mapping(directory: Union[str, Path], name: str, ragged: bool = False) -> PackedMapping:
+    offsets = load_array(directory, f"{name}_offsets") if ragged else None
+    return PackedMapping(load_array(directory, f"{name}_keys"), load_array(directory, f"{name}_values"), offsets)
+
+
+def _align(offset: int) -> int:
+    return -(-offset // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+
+
+def write_bundle(path: Union[str, Path], directory: Union[str, Path], provenance: Optional[Dict[str, Any]] = None):
+    """
+    Packs an index saved to a directory (every array and manifest under it) into a single file that IndexBundle opens, e.g to ship a prebuilt index to other machines.
+    Layout: magic, header length (little endian uint64), JSON header, then the raw bytes of every array at an aligned offset.
+    The header holds the manifests, the provenance (e.g embedding model, loaders, commit) and the dtype, shape, offset and sha256 of every array. Nothing is pickled.
+    """
+    directory = Path(directory)
+    arrays, manifests = {}, {}
+    for file in sorted(directory.rglob("*")):
+        name = file.relative_to(directory).with_suffix("").as_posix()
+        if file.suffix == ".npy":
+            arrays[name] = load_array(file.parent, file.stem)
+        elif file.suffix == ".json":
+            with open(file, "r") as manifest:
+                manifests[name] = json.load(manifest)
+
+    sections, offset = {}, 0
+    for name, array in arrays.items():
+        sections[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset,
+                          "nbytes": array.nbytes, "sha256": hashlib.sha256(array).hexdigest()}
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({"format_version": FORMAT_VERSION, "provenance": provenance or {},
+                         "manifests": manifests, "sections": sections}).encode()
+
+    data_start = _align(len(BUNDLE_MAGIC) + 8 + len(header))
+    temporary = Path(f"{path}.tmp")
+    with open(temporary, "wb") as file:
+        file.write(BUNDLE_MAGIC + struct.pack("<Q", len(header)) + header)
+        for name, array in arrays.items():
+            file.write(b"\0" * (data_start + sections[name]["offset"] - file.tell()))
+            file.write(memoryview(array).cast("B"))
+    os.replace(temporary, path)  # Readers never see a partially written bundle
+
+
+class IndexBundle:
+    """
+    Single file index written by write_bundle().
+    Opening it maps the file read-only and parses only the JSON header, arrays are views into the mapped file (nothing is copied or deserialized), so opening takes about as long as verifying the checksums.
+    Indexes load from it through root, e.g BM25Index.load(bundle.root / "bm25").
+    """
+    def __init__(self, path: Union[str, Path], verify: bool = True):
+        self.path = Path(path)
+        with open(self.path, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+            raise ValueError(f"{path} is not an index bundle")
+        header_start = len(BUNDLE_MAGIC) + 8
+        header_length, = struct.unpack("<Q", self.buffer[len(BUNDLE_MAGIC):header_start])
+        header = json.loads(self.buffer[header_start:header_start + header_length])
+        if header.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"{path} is a version {header.get('format_version')} bundle, expected version {FORMAT_VERSION}")
+        self.provenance: Dict[str, Any] = header["provenance"]
+        self.manifests: Dict[str, Dict[str, Any]] = header["manifests"]
+        self.sections: Dict[str, Dict[str, Any]] = header["sections"]
+        self.data_start = _align(header_start + header_length)
+        if verify:
+            self.verify()
+
+    @property
+    def root(self) -> "BundleDirectory":
+        return BundleDirectory(self)
+
+    def verify(self):
+        """
+        Raises ValueError if any array does not match its checksum, e.g for a truncated or corrupted copy.
+        """
+        view = memoryview(self.buffer)
+        for name, section in self.sections.items():
+            start = self.data_start + section["offset"]
+            if hashlib.sha256(view[start:start + section["nbytes"]]).hexdigest() != section["sha256"]:
+                raise ValueError(f"{self.path} is corrupted, checksum of {name} does not match")
+
+    def array(self, name: str) -> np.ndarray:
+        section = self.sections.get(name)
+        if section is None:
+            raise FileNotFoundError(f"{self.path} has no array {name}")
+        return np.frombuffer(self.buffer, dtype=np.dtype(section["dtype"]), count=int(np.prod(section["shape"])),
+                             offset=self.data_start + section["offset"]).reshape(section["shape"])
+
+
+class BundleDirectory:
+    """
+    A directory inside an IndexBundle, accepted in place of a directory path by load_array() and load_manifest() (and so by every index's load()).
+    """
+    def __init__(self, bundle: IndexBundle, prefix: str = ""):
+        self.bundle = bundle
+        self.prefix = prefix
+
+    def __truediv__(self, name: str) -> "BundleDirectory":
+        return BundleDirectory(self.bundle, f"{self.prefix}{name}/")
+
+    def array(self, name: str) -> np.ndarray:
+        return self.bundle.array(self.prefix + name)
+
+    def manifest(self, kind: str) -> Dict[str, Any]:
+        manifest = self.bundle.manifests.get(self.prefix + kind)
+        if manifest is None:
+            raise FileNotFoundError(f"{self.bundle.path} has no {self.prefix + kind} manifest")
+        return manifest
@@ -0,0 +1,234 @@
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import math
+import numpy as np
+
+from index_files import load_array, load_manifest, load_mapping, pack_mapping, save_array, save_manifest
+
+LOOKUP_COST = 4  # Cost of binary searching one position relative to scattering one posting
+
+
+class BM25Index:
+    """
+    Inverted BM25 index over token ids with dynamic pruning for top-k queries.
+    Scores are the same as rank_bm25's BM25Okapi (same k1, b, epsilon and IDF formula), so it is a drop in replacement.
+
+    Every posting stores its precomputed BM25 impact (the term's contribution to the document score), and every term its maximum impact.
+    top_k() evaluates query terms from the rarest, highest impact, down (MaxScore, the term at a time sibling of WAND):
+    - while the maximum impacts of the remaining terms add up to at least the k-th best score so far, documents are accumulated from whole posting lists
+    - after that no unseen document can make the top k, so the remaining, usually long and common, posting lists are only probed for the documents seen so far, dropping those that can no longer reach the k-th score
+
+    The top k is exactly that of exhaustive scoring: documents sharing at least one token with the query, sorted by score then by position. Documents matching no query token score 0 and are never returned.
+    """
+    def __init__(self, tokenized_corpus: Iterable[Sequence[int]], k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        postings = defaultdict(list)
+        frequencies = defaultdict(list)
+        doc_len = []
+        for position, document in enumerate(tokenized_corpus):
+            doc_len.append(len(document))
+            for token, frequency in Counter(document).items():
+                postings[token].append(position)
+                frequencies[token].append(frequency)
+
+        self.corpus_size = len(doc_len)
+        self.doc_len = np.asarray(doc_len, dtype=np.float64)
+        self.postings: Dict[int, np.ndarray] = {token: np.asarray(positions, dtype=np.int64) for token, positions in postings.items()}
+        self.frequencies: Dict[int, np.ndarray] = {token: np.asarray(counts, dtype=np.float64) for token, counts in frequencies.items()}
+        self.num_postings = sum(len(positions) for positions in self.postings.values())
+
+        average_doc_length = float(self.doc_len.mean()) if self.corpus_size else 0.0
+        self.set_statistics(BM25Index.compute_idf(self.document_frequencies(), self.corpus_size, epsilon), average_doc_length)
+
+    def __len__(self) -> int:
+        return self.corpus_size
+
+    @staticmethod
+    def compute_idf(document_frequency: Dict[int, int], corpus_size: int, epsilon: float = 0.25) -> Dict[int, float]:
+        """
+        Same IDF as BM25Okapi._calc_idf: negative IDFs of very common tokens are replaced by epsilon times the average IDF.
+        """
+        idf = {}
+        idf_sum = 0.0
+        negative_idfs = []
+        for token, freq in document_frequency.items():
+            token_idf = math.log(corpus_size - freq + 0.5) - math.log(freq + 0.5)
+            idf[token] = token_idf
+            idf_sum += token_idf
+            if token_idf < 0:
+                negative_idfs.append(token)
+        eps = epsilon * idf_sum / len(idf) if idf else 0.0
+        for token in negative_idfs:
+            idf[token] = eps
+        return idf
+
+    def save(self, directory: Union[str, Path]):
+        """
+        Saves the index as flat arrays (posting lists concatenated per token with their offsets) that load() memory maps.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        save_manifest(directory, "bm25", k1=self.k1, b=self.b, epsilon=self.epsilon, avgdl=self.avgdl,
+                      corpus_size=self.corpus_size, num_postings=self.num_postings)
+        save_array(directory, "doc_len", self.doc_len)
+        for name in ("postings", "frequencies", "impacts"):
+            pack_mapping(directory, name, getattr(self, name), ragged=True)
+        for name in ("idf", "max_impact", "min_impact"):
+            pack_mapping(directory, name, getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: Union[str, Path]) -> "BM25Index":
+        """
+        Loads an index saved with save(). Posting lists are read-only views into memory mapped files, so processes loading the same index share its pages and nothing is parsed up front.
+        """
+        manifest = load_manifest(directory, "bm25")
+        index = cls.__new__(cls)
+        for name in ("k1", "b", "epsilon", "avgdl", "corpus_size", "num_postings"):
+            setattr(index, name, manifest[name])
+        index.doc_len = load_array(directory, "doc_len")
+        for name in ("postings", "frequencies", "impacts"):
+            setattr(index, name, load_mapping(directory, name, ragged=True))
+        for name in ("idf", "max_impact", "min_impact"):
+            setattr(index, name, load_mapping(directory, name))
+        return index
+
+    def document_frequencies(self) -> Dict[int, int]:
+        return {token: len(positions) for token, positions in self.postings.items()}
+
+    def set_statistics(self, idf: Dict[int, float], avgdl: float):
+        """
+        Recomputes impacts and range maxima with the given IDF and average document length, e.g corpus-wide statistics shared by shards.
+        """
+        self.idf = idf
+        self.avgdl = avgdl
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_len / avgdl) if avgdl else self.doc_len
+
+        self.impacts: Dict[int, np.ndarray] = {}
+        self.max_impact: Dict[int, float] = {}
+        self.min_impact: Dict[int, float] = {}
+        for token, positions in self.postings.items():
+            tf = self.frequencies[token]
+            impacts = idf.get(token, 0.0) * (tf * (self.k1 + 1) / (tf + length_norm[positions]))
+            self.impacts[token] = impacts
+            self.max_impact[token] = float(impacts.max())
+            self.min_impact[token] = float(impacts.min())
+
+    def get_scores(self, query_tokens: Sequence[int]) -> np.ndarray:
+        """
+        Exhaustive scores of every document, like BM25Okapi.get_scores but only touching the postings of the query tokens.
+        """
+        scores = np.zeros(self.corpus_size)
+        for token, weight in self.__query_terms(query_tokens):
+            scores[self.postings[token]] += weight * self.impacts[token]
+        return scores
+
+    def top_k(self, query_tokens: Sequence[int], k: int, candidates: Optional[np.ndarray] = None, prune: bool = True,
+              fill: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (scores, positions) of the k best documents, best first. candidates restricts scoring to the given positions.
+        prune=False scores every matching document instead, which gives the same result and is only meant for benchmarks.
+        fill pads the result up to k with (candidate) documents matching no query token, score 0 in position order, like sorting the scores of every document does.
+        """
+        if fill:
+            return self.__fill(self.top_k(query_tokens, k, candidates, prune), k, candidates)
+        terms = self.__query_terms(query_tokens)
+        allowed = None
+        if candidates is not None:
+            allowed = np.zeros(self.corpus_size, dtype=bool)
+            allowed[candidates] = True
+        if k <= 0 or not terms:
+            return np.empty(0), np.empty(0, dtype=np.int64)
+        if not prune or any(self.min_impact[token] < 0 for token, _ in terms):
+            # Partial scores are only lower bounds of the final score if no term can lower it
+            return self.__exhaustive_top_k(terms, k, allowed)
+
+        # remaining[j] bounds what terms j onwards can still add to any document
+        remaining = np.cumsum([weight * self.max_impact[token] for token, weight in terms][::-1])[::-1]
+        partial = np.zeros(self.corpus_size)
+        seen = np.zeros(self.corpus_size, dtype=bool)
+        threshold = -np.inf
+        j = 0
+
+        # Any document may still enter the top k while the remaining terms could reach the threshold on their own
+        while j < len(terms) and remaining[j] >= self.__slack(threshold):
+            token, weight = terms[j]
+            positions, impacts = self.postings[token], self.impacts[token]
+            if allowed is not None:
+                keep = allowed[positions]
+                positions, impacts = positions[keep], impacts[keep]
+            partial[positions] += weight * impacts
+            seen[positions] = True
+            j += 1
+            # Partial scores only grow, so the k-th best among the documents just touched is a lower bound of the final threshold
+            if len(positions) >= k:
+                threshold = max(threshold, np.partition(partial[positions], len(positions) - k)[len(positions) - k])
+
+        # From here on only documents already seen can make it, and only those that can still reach the threshold
+        positions = np.flatnonzero(seen)
+        for token, weight in terms[j:]:
+            positions = positions[partial[positions] + remaining[j] >= self.__slack(threshold)]
+            if self.__should_lookup(token, len(positions)):
+                partial[positions] += weight * self.__lookup(token, positions)
+            else:
+                partial[self.postings[token]] += weight * self.impacts[token]
+            j += 1
+        return self.__select(partial[positions], positions, k)
+
+    def __fill(self, result: Tuple[np.ndarray, np.ndarray], k: int, candidates: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        scores, positions = result
+        if len(positions) >= k:
+            return result
+        pool = np.arange(self.corpus_size) if candidates is None else np.unique(np.asarray(candidates, dtype=np.int64))
+        extra = pool[~np.isin(pool, positions)][:k - len(positions)]
+        return np.concatenate((scores, np.zeros(len(extra)))), np.concatenate((positions, extra)).astype(np.int64)
+
+    def __query_terms(self, query_tokens: Sequence[int]) -> List[Tuple[int, int]]:
+        """
+        Returns (token, weight) of the known query tokens, rarest first.
+        Every scorer adds terms in this order, so pruned and exhaustive scores are bit for bit identical, also across indexes sharing statistics.
+        """
+        # A token repeated in the query counts once per occurrence, as in BM25Okapi
+        terms = [(token, count) for token, count in Counter(query_tokens).items() if token in self.postings]
+        return sorted(terms, key=lambda term: (-term[1] * self.idf.get(term[0], 0.0), term[0]))
+
+    def __should_lookup(self, token: int, num_positions: int) -> bool:
+        # Binary searching many positions in a short posting list costs more than scattering the whole list
+        return num_positions * LOOKUP_COST < len(self.postings[token])
+
+    def __lookup(self, token: int, positions: np.ndarray) -> np.ndarray:
+        """
+        Impacts of the token in the given sorted positions, 0 where it does not occur.
+        """
+        postings = self.postings[token]
+        i = np.minimum(np.searchsorted(postings, positions), len(postings) - 1)
+        return np.where(postings[i] == positions, self.impacts[token][i], 0.0)
+
+    @staticmethod
+    def __slack(threshold: float) -> float:
+        # remaining is summed in a different order than the scores, keep documents within rounding error of the threshold
+        return threshold - abs(threshold) * 1e-9
+
+    def __exhaustive_top_k(self, terms: List[Tuple[int, int]], k: int, allowed: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        scores = np.zeros(self.corpus_size)
+        matched = np.zeros(self.corpus_size, dtype=bool)
+        for token, weight in terms:
+            scores[self.postings[token]] += weight * self.impacts[token]
+            matched[self.postings[token]] = True
+        if allowed is not None:
+            matched &= allowed
+        positions = np.flatnonzero(matched)
+        return self.__select(scores[positions], positions, k)
+
+    @staticmethod
+    def __select(scores: np.ndarray, positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        if len(scores) > k:
+            # Only sort what can make the top k, keeping every document tied with the k-th so ties go to the lowest position
+            keep = scores >= np.partition(scores, len(scores) - k)[len(scores) - k]
+            scores, positions = scores[keep], positions[keep]
+        order = np.lexsort((positions, -scores))[:k]
+        return scores[order], positions[order]
@@ -0,0 +1,107 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+
+from code_tokenizer import split_identifier
+from document_store import DocumentStore
+
+# Filter fields, values can be a string or a list of strings (any of which may match)
+FILTER_FIELDS = ("block_type", "parent_type", "path_prefix", "name")
+
+
+def normalize_path(path: str) -> str:
+    return "/" + str(path).replace("\\", "/").strip("/")
+
+
+class MetadataIndex:
+    """
+    Per field bitmap indexes over block metadata, so that retrievers can restrict scoring to the blocks matching a filter before ranking instead of filtering the top-k afterwards.
+
+    Bitmaps are numpy bit-packed arrays (bit i = block i of the store) so that filters combine with vectorized AND/OR, and can be handed directly to a FAISS IDSelectorBitmap.
+
+    Filters are dicts of field -> value or list of values. Values within a field are OR-ed, fields are AND-ed:
+    - block_type: "class", "function", "others"
+    - parent_type: "root", "class"
+    - path_prefix: directory or file path, matched on whole path components anywhere in relative_path, e.g "src/flask/json"
+    - name: identifier whose tokens must all appear in block_name, e.g "get_scores" or "Serializer"
+    """
+    def __init__(self, store: DocumentStore):
+        self.size = len(store)
+        positions: Dict[str, Dict[str, List[int]]] = {field: defaultdict(list) for field in ("block_type", "parent_type", "path", "name")}
+
+        for doc_id in store.ids:
+            metadata = store.metadata(doc_id)
+            positions["block_type"][metadata.get("block_type", "")].append(doc_id)
+            positions["parent_type"][metadata.get("parent_type", "")].append(doc_id)
+            positions["path"][normalize_path(metadata.get("relative_path", ""))].append(doc_id)
+            for token in set(split_identifier(metadata.get("block_name", ""))):
+                positions["name"][token].append(doc_id)
+
+        self._bitmaps = {field: {value: self._to_bitmap(ids) for value, ids in field_positions.items()}
+                         for field, field_positions in positions.items()}
+        self._empty = np.zeros_like(self._to_bitmap([]))
+
+    def bitmap(self, filters: Optional[Dict[str, Union[str, Sequence[str]]]]) -> Optional[np.ndarray]:
+        """
+        Returns the packed bitmap of blocks matching every field of the filter, or None if there is no filter.
+        """
+        if not filters:
+            return None
+
+        result = None
+        for field, values in filters.items():
+            if field not in FILTER_FIELDS:
+                raise ValueError(f"Unsupported filter field: {field}. Supported fields: {', '.join(FILTER_FIELDS)}")
+            if isinstance(values, str):
+                values = [values]
+
+            field_bitmap = self._empty.copy()
+            for value in values:
+                np.bitwise_or(field_bitmap, self._match(field, value), out=field_bitmap)
+            result = field_bitmap if result is None else np.bitwise_and(result, field_bitmap, out=result)
+        return result
+
+    def mask(self, filters: Optional[Dict[str, Union[str, Sequence[str]]]]) -> Optional[np.ndarray]:
+        """
+        Returns a boolean mask over the store of blocks matching the filter, or None if there is no filter.
+        """
+        bitmap = self.bitmap(filters)
+        if bitmap is None:
+            return None
+        return np.unpackbits(bitmap, count=self.size, bitorder="little").astype(bool)
+
+    def _match(self, field: str, value: str) -> np.ndarray:
+        if field == "path_prefix":
+            prefix = normalize_path(value)
+            matched = self._empty.copy()
+            for path, path_bitmap in self._bitmaps["path"].items():
+                # Paths from DirectoryLoader include the repo root, so match whole components anywhere in the path
+                if path.endswith(prefix) or (prefix + "/") in path:
+                    np.bitwise_or(matched, path_bitmap, out=matched)
+            return matched
+
+        if field == "name":
+            matched = None
+            for token in split_identifier(value):
+                token_bitmap = self._bitmaps["name"].get(token, self._empty)
+                matched = token_bitmap.copy() if matched is None else np.bitwise_and(matched, token_bitmap, out=matched)
+            return self._empty if matched is None else matched
+
+        return self._bitmaps[field].get(value, self._empty)
+
+    def _to_bitmap(self, doc_ids: Iterable[int]) -> np.ndarray:
+        mask = np.zeros(self.size, dtype=bool)
+        mask[list(doc_ids)] = True
+        return np.packbits(mask, bitorder="little")
+
+
+def filter_positions(store: DocumentStore, doc_ids: np.ndarray, filters: Optional[Dict[str, Union[str, Sequence[str]]]]) -> Optional[np.ndarray]:
+    """
+    Returns the positions within doc_ids of the blocks matching the filter, or None if there is no filter.
+    The metadata index is built once per store and shared by every retriever on it.
+    """
+    mask = store.derived("metadata_index", MetadataIndex).mask(filters)
+    if mask is None:
+        return None
+    return np.flatnonzero(mask[doc_ids])
@@ -17,15 +17,22 @@ PY_MAPPING = {
     "module": "root"
 }
 
+IDENTIFIER_KINDS = ("reference", "call", "attribute", "import", "definition")  # Kinds of identifier occurrences, see PythonASTDocumentLoader
+IMPORT_TYPES = ("import_statement", "import_from_statement", "future_import_statement")
+
 
 class PythonASTDocumentLoader(BaseLoader):
     """
     A smarter version of PythonLoader that uses Treesitter to parse its abstract syntax trees, 
     and return Document objects that contain blocks (defined by functions, classes, or other structures).
+
+    With identifiers=True, the metadata of every block also lists the identifiers occurring in it as [name, byte offset in the file, kind] (kind is one of IDENTIFIER_KINDS),
+    which UsageIndex turns into a find-usages index.
     """
 
-    def __init__(self, file_path: Union[str, Path]):
+    def __init__(self, file_path: Union[str, Path], identifiers: bool = False):
         self.file_path = file_path
+        self.identifiers = identifiers
 
     def lazy_load(self) -> Iterator[Document]:
         """
@@ -39,6 +46,8 @@ class PythonASTDocumentLoader(BaseLoader):
                 tree.root_node, code_file_bytes, "root", "")
             all_nodes_text, all_nodes_metadata = self.__simplify_metadata(
                 all_nodes_metadata, code_file_bytes)
+            if self.identifiers:
+                self.__add_identifiers(tree.root_node, all_nodes_metadata)
 
             for node_text, node_metadata in zip(all_nodes_text, all_nodes_metadata):
                 yield Document(page_content=node_text, metadata=node_metadata)
@@ -185,6 +194,53 @@ class PythonASTDocumentLoader(BaseLoader):
         """
         return self.source_code[node.start_byte: node.end_byte].decode()
 
+    def __add_identifiers(self, root: Node, nodes_metadata: List[Dict]) -> None:
+        """
+        Adds every identifier of the file to the innermost function or class definition containing it in the syntax tree, or to the global scope block.
+        Block offsets cannot tell, a class block ends where its first method starts while its body may go on after its last method.
+        """
+        for node_metadata in nodes_metadata:
+            node_metadata["identifiers"] = []
+        blocks = {node_metadata["start_offset"]: node_metadata for node_metadata in nodes_metadata if node_metadata["block_type"] in ("function", "class")}
+        global_scope = next((node_metadata for node_metadata in nodes_metadata if node_metadata["block_type"] == "others"), None)
+
+        query = PY_LANGUAGE.query("""
+            (identifier) @identifier
+        """)
+        for node in query.captures(root).get("identifier", []):
+            block, parent = global_scope, node.parent
+            while parent is not None:
+                if parent.type in ("function_definition", "class_definition") and parent.start_byte in blocks:
+                    block = blocks[parent.start_byte]
+                    break
+                parent = parent.parent
+            if block is not None:
+                block["identifiers"].append([self.__get_node_text(node), node.start_byte, self.__identifier_kind(node)])
+
+    @staticmethod
+    def __identifier_kind(node: Node) -> str:
+        """
+        Classifies an identifier occurrence by its parents in the AST (see IDENTIFIER_KINDS).
+        """
+        def is_field(parent: Optional[Node], field: str, child: Node) -> bool:
+            field_node = parent.child_by_field_name(field) if parent is not None else None
+            return field_node is not None and (field_node.start_byte, field_node.end_byte) == (child.start_byte, child.end_byte)
+
+        parent = node.parent
+        if parent is None:
+            return "reference"
+        if parent.type in ("function_definition", "class_definition") and is_field(parent, "name", node):
+            return "definition"
+        if parent.type == "attribute" and is_field(parent, "attribute", node):
+            return "call" if parent.parent is not None and parent.parent.type == "call" and is_field(parent.parent, "function", parent) else "attribute"
+        if parent.type == "call" and is_field(parent, "function", node):
+            return "call"
+        while parent is not None and parent.type in ("dotted_name", "aliased_import"):
+            parent = parent.parent
+        if parent is not None and parent.type in IMPORT_TYPES:
+            return "import"
+        return "reference"
+
     def __extract_function_arguments(self, node: Node) -> List[str]:
         """
         Extract the arguments of a function. Named, unnamed, and typed parameters are supported.
@@ -360,6 +416,8 @@ class PythonASTDocumentLoader(BaseLoader):
                         all_nodes_text.append(b"".join(node_text).decode())
                     else:
                         all_nodes.append(node_data)
+                        all_nodes_text.append(
+                            source_code[node_data["start_offset"]: node_data["end_offset"]].decode())
 
         # Merge all 'others' code blocks into one document
         others_combined_text = b"".join(others).decode()
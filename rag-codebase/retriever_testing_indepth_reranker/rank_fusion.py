@@ -0,0 +1,22 @@
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, TypeVar
+
+RRF_C = 60  # Same constant as Langchain's EnsembleRetriever
+
+T = TypeVar("T")
+
+
+def weighted_reciprocal_rank(ranked_lists: Sequence[Sequence[T]], weights: Sequence[float], c: int = RRF_C,
+                             key: Optional[Callable[[T], Hashable]] = None) -> List[T]:
+    """
+    Weighted reciprocal rank fusion, same as EnsembleRetriever.weighted_reciprocal_rank.
+    Items are block ids, or anything else with a key identifying the same block across lists (e.g block_key for Documents), in which case the first item seen is returned.
+    Ties keep the order in which items were first seen.
+    """
+    scores: Dict[Hashable, float] = {}
+    items: Dict[Hashable, T] = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, item in enumerate(ranked, start=1):
+            item_key = item if key is None else key(item)
+            items.setdefault(item_key, item)
+            scores[item_key] = scores.get(item_key, 0.0) + weight / (rank + c)
+    return [items[item_key] for item_key in sorted(scores, key=lambda item_key: scores[item_key], reverse=True)]
@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.documents import Document
+from typing import Callable, Dict, List, Optional, Tuple
+
+import asyncio
+import logging
+import re
+import threading
+import time
+
+from document_store import DocumentStore, block_key
+from rank_fusion import RRF_C, weighted_reciprocal_rank
+
+logger = logging.getLogger(__name__)
+
+# Suggested deadlines, only applied when passed as timeouts. Without deadlines every backend is waited for
+DEFAULT_TIMEOUTS = {
+    "lexical": 2.0,
+    "dense": 2.0,
+    "graph": 5.0,
+    "usages": 2.0,
+    "trigram": 2.0
+}
+
+
+class RetrievalOrchestrator:
+    """
+    Runs independent retrieval backends (e.g lexical, dense and graph) concurrently, each with an optional deadline, and fuses whatever returned in time by weighted reciprocal rank.
+    End to end latency is the slowest backend that made its deadline rather than the sum of all of them.
+    timeouts are deadlines in seconds by backend name (e.g DEFAULT_TIMEOUTS), backends without one are always waited for.
+
+    Backends are plain blocking callables that take no arguments and return a ranked list of Documents, run on a thread pool.
+    A backend that misses its deadline or raises is left out of the fusion with a logged warning. Python cannot cancel a running thread, so it finishes in the background and its result is discarded.
+
+    Every call returns the fused documents together with the status and latency of each backend for that call, e.g
+    {"lexical": {"status": "ok", "latency": 0.012, "count": 20}, "graph": {"status": "timeout", "latency": 5.0, "count": 0}}
+    so concurrent searches on one orchestrator never see each other's report.
+
+    retrieve() runs the searches on one event loop kept in a background thread for the life of the orchestrator, call close() to stop it.
+    """
+    def __init__(self, timeouts: Optional[Dict[str, float]] = None, max_workers: Optional[int] = None, c: int = RRF_C):
+        self.timeouts = dict(timeouts or {})
+        self.c = c
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name="retrieval-orchestrator", daemon=True)
+        self.loop_thread.start()
+
+    async def aretrieve(self, searches: Dict[str, Callable[[], List[Document]]],
+                        weights: Dict[str, float]) -> Tuple[List[Document], Dict[str, Dict]]:
+        """
+        Launches every search concurrently and returns the fused ranking of those that finished before their deadline, and the report of every backend.
+        """
+        loop = asyncio.get_running_loop()
+        names = list(searches)
+        results = await asyncio.gather(*(self.__run_backend(loop, name, searches[name]) for name in names))
+
+        report = {}
+        ranked_lists = {}
+        for name, (status, latency, docs) in zip(names, results):
+            report[name] = {"status": status, "latency": latency, "count": len(docs)}
+            if status == "ok":
+                ranked_lists[name] = docs
+        return self.weighted_reciprocal_rank(ranked_lists, weights), report
+
+    def retrieve(self, searches: Dict[str, Callable[[], List[Document]]], weights: Dict[str, float]) -> Tuple[List[Document], Dict[str, Dict]]:
+        """
+        Blocking wrapper around aretrieve(), safe to call from any thread, also from inside a running event loop (e.g Jupyter).
+        """
+        return asyncio.run_coroutine_threadsafe(self.aretrieve(searches, weights), self.loop).result()
+
+    def close(self):
+        """
+        Stops the event loop thread and the backend thread pool, backends still running finish in the background.
+        """
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.executor.shutdown(wait=False)
+
+    def weighted_reciprocal_rank(self, ranked_lists: Dict[str, List[Document]], weights: Dict[str, float]) -> List[Document]:
+        """
+        Same fusion as EnsembleRetriever.weighted_reciprocal_rank, keyed by block rather than page content.
+        """
+        return weighted_reciprocal_rank(list(ranked_lists.values()), [weights.get(name, 1.0) for name in ranked_lists], self.c,
+                                        key=lambda doc: block_key(doc.metadata))
+
+    async def __run_backend(self, loop, name: str, search: Callable[[], List[Document]]) -> Tuple[str, float, List[Document]]:
+        start = time.perf_counter()
+        try:
+            docs = await asyncio.wait_for(loop.run_in_executor(self.executor, search), timeout=self.timeouts.get(name))
+            return "ok", time.perf_counter() - start, docs
+        except asyncio.TimeoutError:
+            logger.warning("Retrieval backend '%s' missed its %.2fs deadline and was left out", name, self.timeouts[name])
+            return "timeout", time.perf_counter() - start, []
+        except Exception:
+            logger.exception("Retrieval backend '%s' failed and was left out", name)
+            return "error", time.perf_counter() - start, []
+
+
+class Neo4jGraphSearch:
+    """
+    Graph retrieval backend over the graph built by GraphRetrieve/create_neo4j_graph.py.
+    Finds Function, Method and Class nodes whose name contains words of the query (or calls something that does), and maps them back to the blocks of the DocumentStore by file and start offset.
+
+    graph is anything with a query(cypher, params) method returning a list of dicts, e.g langchain_neo4j.Neo4jGraph.
+    """
+    # Only nodes whose name (or the name of something they call) contains a word are read, from the labels that can match, without collecting every call of the graph
+    GRAPH_QUERY = """
+        UNWIND $words AS word
+        CALL {
+            WITH word
+            MATCH (n:Function) WHERE toLower(n.name) CONTAINS word
+            RETURN n, 2 AS points
+            UNION ALL
+            WITH word
+            MATCH (n:Method) WHERE toLower(n.name) CONTAINS word
+            RETURN n, 2 AS points
+            UNION ALL
+            WITH word
+            MATCH (n:Class) WHERE toLower(n.name) CONTAINS word
+            RETURN n, 2 AS points
+            UNION ALL
+            WITH word
+            MATCH (called:Calls) WHERE toLower(called.name) CONTAINS word
+            MATCH (n)-[:CALLS]->(called)
+            WHERE NOT n:Others
+            RETURN DISTINCT n, 1 AS points
+        }
+        WITH n, sum(points) AS score
+        RETURN n.relative_path AS relative_path, n.start_offset AS start_offset, score
+        ORDER BY score DESC
+        LIMIT $k
+        """
+
+    def __init__(self, graph, store: DocumentStore, view: str = "header"):
+        self.graph = graph
+        self.store = store
+        self.view = view
+
+    def __call__(self, query: str, k: int) -> List[Document]:
+        words = [word for word in re.findall('[a-z0-9_]+', query.lower()) if len(word) > 2]
+        if not words:
+            return []
+        offsets = self.store.derived("block_offsets", lambda store: {
+            (str(store.metadata(doc_id).get("relative_path")), store.metadata(doc_id).get("start_offset")): doc_id
+            for doc_id in store.ids})
+
+        docs = []
+        for record in self.graph.query(Neo4jGraphSearch.GRAPH_QUERY, {"words": words, "k": k}):
+            doc_id = offsets.get((str(record["relative_path"]), record["start_offset"]))
+            if doc_id is not None:
+                docs.append(self.store.document(doc_id, self.view))
+        return docs
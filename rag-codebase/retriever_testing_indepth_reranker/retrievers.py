@@ -1,42 +1,112 @@
-from langchain_core.documents import BaseDocumentCompressor
+from langchain_core.documents import BaseDocumentCompressor, Document
+from langchain_core.embeddings import Embeddings
 import numpy as np
-from rank_bm25 import BM25Okapi
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
-from langchain_community.retrievers import BM25Retriever
-from langchain.retrievers import EnsembleRetriever
-from typing import Optional
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Union
+
+from call_closure import TransitiveCallerSearch
+from call_graph import DEFAULT_TOKEN_BUDGET, CallGraph
+from code_tokenizer import CodeTokenizer
+from context_index import ContextIndex
+from dense_index import DenseIndex, MappedDenseIndex
+from document_store import DocumentStore
+from file_index import FileIndex
+from index_files import load_array, load_manifest, save_array, save_manifest
+from lexical_index import BM25Index
+from metadata_index import filter_positions
+from retrieval_orchestrator import RetrievalOrchestrator
+from symbol_index import SymbolIndex, named_symbols
+from usage_index import UsageIndex
+
+
+def restrict(store: DocumentStore, found: np.ndarray, doc_ids: np.ndarray, candidates: Optional[np.ndarray]) -> np.ndarray:
+    """
+    Keeps the block ids in found that are at the given positions of doc_ids.
+    """
+    if len(found) and (candidates is not None or len(doc_ids) != len(store)):
+        found = found[np.isin(found, doc_ids if candidates is None else doc_ids[candidates])]
+    return found
+
+
+def symbol_documents(store: DocumentStore, doc_ids: np.ndarray, candidates: Optional[np.ndarray], query: str, k: int) -> List[Document]:
+    """
+    Returns copies of the blocks defining the symbols named in the query (see SymbolIndex.find()), restricted to the given positions of doc_ids.
+    """
+    found = restrict(store, np.asarray(store.derived("symbol_index", SymbolIndex.from_store).find(query), dtype=np.int64), doc_ids, candidates)
+    return DocumentStore.detach([store.document(int(doc_id), "header") for doc_id in found[:k]])
+
+
+def symbol_usage_documents(store: DocumentStore, doc_ids: np.ndarray, candidates: Optional[np.ndarray], query: str, k: int) -> List[Document]:
+    """
+    Returns copies of the blocks using the symbols named in the query (see UsageIndex), restricted to the given positions of doc_ids.
+    """
+    index = store.derived("usage_index", UsageIndex)
+    found = np.asarray(list(dict.fromkeys(block_id for symbol in named_symbols(query) for block_id in index.usage_blocks(symbol))), dtype=np.int64)
+    return DocumentStore.detach([store.document(int(doc_id), "header") for doc_id in restrict(store, found, doc_ids, candidates)[:k]])
+
+
+def transitive_caller_documents(store: DocumentStore, doc_ids: np.ndarray, candidates: Optional[np.ndarray], query: str, k: int) -> List[Document]:
+    """
+    Returns copies of the blocks eventually calling the symbols named in the query (see TransitiveCallerSearch), restricted to the given positions of doc_ids.
+    """
+    found = restrict(store, TransitiveCallerSearch(store).caller_ids(query), doc_ids, candidates)
+    return DocumentStore.detach([store.document(int(doc_id), "header") for doc_id in found[:k]])
+
+
+def expand_documents(store: DocumentStore, documents: List[Document], expand_context: bool, call_depth: int, call_token_budget: int) -> List[Document]:
+    """
+    Adds the context of the retrieved documents: the skeleton of their enclosing class (see ContextIndex) and their callers and callees (see CallGraph).
+    """
+    if expand_context:
+        documents = store.derived("context_index", ContextIndex).expand(documents)
+    if call_depth:
+        documents = store.derived("call_graph", CallGraph).expand_documents(documents, call_depth, call_token_budget)
+    return documents
 
-import re
-from copy import deepcopy
 
 class HybridSearch:
-    def __init__(self, documents, token_len=2, overlap=1):
-        self.token_len = token_len
-        self.overlap = overlap
-        self.embeddings = HuggingFaceEmbeddings(
+    def __init__(self, documents: Union[DocumentStore, Iterable[Document]], tokenizer: Optional[CodeTokenizer] = None, doc_ids: Optional[Sequence[int]] = None,
+                 embeddings: Optional[Embeddings] = None):
+        """
+        documents can be a DocumentStore shared with other retrievers, or a list of documents from the AST loader.
+        tokenizer is used for BM25 on both documents and queries, defaulting to a CodeTokenizer.
+        doc_ids restricts the retriever to a subset of the store, defaulting to every block.
+        embeddings default to multi-qa-mpnet-base-cos-v1 on the GPU.
+        """
+        self.tokenizer = tokenizer or CodeTokenizer()
+        self.embeddings = embeddings or HuggingFaceEmbeddings(
             model_name="sentence-transformers/multi-qa-mpnet-base-cos-v1",
             model_kwargs={'device': "cuda"})
-        # BM25 initialization
-        documents = deepcopy(documents)
-        for docs in documents:
-            newContent = f"Block Type: {docs.metadata['block_type']} \n\
-                Relative Path: {docs.metadata['relative_path']},{docs.metadata['start_offset']},{docs.metadata['end_offset']} \n \
-                Block Name: {docs.metadata['block_name']} \n\
-                Arguments: {' '.join(docs.metadata['block_args'])} \n\
-                Code: {' '.join(re.findall('[a-zA-Z0-9]+', docs.page_content))}"
-            docs.page_content = newContent
-        self.documents = documents
-        tokenized_corpus = self.customSplitter(self.documents)
-        self.bm25 = BM25Okapi(tokenized_corpus)
+        # BM25 initialization over the lexical view of the shared store, documents are returned in the header view
+        self.store = DocumentStore.from_documents(documents)
+        self.doc_ids = np.arange(len(self.store)) if doc_ids is None else np.asarray(doc_ids, dtype=np.int64)
+        self.documents = [self.store.document(doc_id, "header") for doc_id in self.doc_ids]
+        tokenized_corpus = self.tokenizer.encode_corpus(self.store.text(doc_id, "lexical") for doc_id in self.doc_ids)
+        self.bm25 = BM25Index(tokenized_corpus)
 
         # Sentence transformer for embeddings
 
-    def search(self, query, bm25_n=25, faiss_n=10, final_k=5, reranker:Optional[BaseDocumentCompressor] = None):
-        # BM25 search
-        bm25score = self.bm25.get_scores(self.customQuerySplitter(query))
-        top_query_bm25_number = min(len(self.documents), bm25_n)
-        top_doc_indices = np.argsort(bm25score)[-top_query_bm25_number:]
+    def search(self, query, bm25_n=25, faiss_n=10, final_k=5, reranker:Optional[BaseDocumentCompressor] = None, filters: Optional[Dict] = None,
+               expand_context: bool = False, call_depth: int = 0, call_token_budget: int = DEFAULT_TOKEN_BUDGET, symbols: bool = False):
+        """
+        filters restricts the search to blocks matching the metadata filter (see MetadataIndex) before any scoring is done.
+        expand_context prepends the skeleton of the enclosing class to every retrieved method (see ContextIndex).
+        call_depth appends the callers and callees of the retrieved blocks up to that many calls away, within call_token_budget tokens (see CallGraph).
+        symbols first looks up the identifiers named in the query (see SymbolIndex), returning the blocks defining them without searching if there are any.
+        """
+        # BM25 search, only scoring the blocks that pass the filters and skipping those that cannot make the top bm25_n
+        candidates = filter_positions(self.store, self.doc_ids, filters)
+        if symbols:
+            symbol_docs = symbol_documents(self.store, self.doc_ids, candidates, query, final_k)
+            if symbol_docs:
+                return expand_documents(self.store, symbol_docs, expand_context, call_depth, call_token_budget)
+        query_tokens = self.tokenizer.encode_query(query)
+        # Like sorting every score did, blocks matching no query token still fill up the bm25_n passed on to FAISS
+        _, top_doc_indices = self.bm25.top_k(query_tokens, bm25_n, candidates, fill=True)
+        if len(top_doc_indices) == 0:
+            return []
         top_docs_list = [self.documents[i] for i in top_doc_indices]
 
         tempFaiss = FAISS.from_documents(top_docs_list, self.embeddings)
@@ -49,75 +119,166 @@ class HybridSearch:
         if reranker:
             ranked_docs = reranker.compress_documents(ranked_docs, query)
 
-        ranked_docs = ranked_docs[:final_k]
+        return expand_documents(self.store, ranked_docs[:final_k], expand_context, call_depth, call_token_budget)
 
-        return ranked_docs
 
-    def customSplitter(self, listOfDocuments):
-        listOfToken = []
-        for document in listOfDocuments:
-            pagecontent = document.page_content.lower()
-            pagecontent = document.page_content.replace("_", " ")
-            listToAdd = []
-            for x in range(self.overlap, len(pagecontent), self.token_len-self.overlap):
-                end_index = min(x+self.token_len, len(pagecontent))
-                listToAdd.append(pagecontent[x-self.overlap:end_index])
-            listOfToken.append(listToAdd)
-        return listOfToken
+class EnsembleSearch:
+    def __init__(self, documents: Union[DocumentStore, Iterable[Document]], tokenizer: Optional[CodeTokenizer] = None, doc_ids: Optional[Sequence[int]] = None,
+                 timeouts: Optional[Dict[str, float]] = None, graph_search: Optional[Callable[[str, int], List[Document]]] = None,
+                 backends: Optional[Dict[str, Callable[[str, int], List[Document]]]] = None, embeddings: Optional[Embeddings] = None):
+        """
+        documents can be a DocumentStore shared with other retrievers, or a list of documents from the AST loader.
+        tokenizer is used for BM25 on both documents and queries, defaulting to a CodeTokenizer.
+        doc_ids restricts the retriever to a subset of the store, defaulting to every block.
+        timeouts are optional per backend deadlines in seconds ("lexical", "dense", "graph", or the name of any other backend), e.g DEFAULT_TIMEOUTS. Backends without one are always waited for.
+        graph_search is an optional third backend taking (query, k), e.g Neo4jGraphSearch.
+        backends are more backends by name taking (query, k), e.g {"trigram": TrigramSearch(store)}, fused alongside the others.
+        embeddings default to multi-qa-mpnet-base-cos-v1 on the GPU.
+        """
+        self.tokenizer = tokenizer or CodeTokenizer()
+        self.embeddings = embeddings or HuggingFaceEmbeddings(
+            model_name="sentence-transformers/multi-qa-mpnet-base-cos-v1",
+            model_kwargs={'device': "cuda"})
+
+        # all-MiniLM-L6-v2
+        # multi-qa-mpnet-base-cos-v1
+        # BM25 initialization over the lexical view of the shared store, documents are returned in the header view
+        self.store = DocumentStore.from_documents(documents)
+        self.doc_ids = np.arange(len(self.store)) if doc_ids is None else np.asarray(doc_ids, dtype=np.int64)
+        self.documents = [self.store.document(doc_id, "header") for doc_id in self.doc_ids]
+        self.bm25 = BM25Index(self.tokenizer.encode_corpus(self.store.text(doc_id, "lexical") for doc_id in self.doc_ids))
 
-    def customQuerySplitter(self, query):
-        listOfToken = []
+        # Dense index keyed by block id, documents are looked up in the store
+        vectors = np.asarray(self.embeddings.embed_documents([doc.page_content for doc in self.documents]), dtype=np.float32)
+        self.dense = DenseIndex(vectors.shape[1])
+        self.dense.add(self.doc_ids, vectors)
+        self._files: Optional[FileIndex] = None
 
-        for x in range(self.overlap, len(query), self.token_len-self.overlap):
-            end_index = min(x+self.token_len, len(query))
-            listOfToken.append(query[x-self.overlap:end_index])
-        return listOfToken
+        self.graph_search = graph_search
+        self.backends = dict(backends or {})
+        self.orchestrator = RetrievalOrchestrator(timeouts)
 
+    def save(self, directory: Union[str, Path]):
+        """
+        Saves the documents, BM25 index with its tokenizer and dense index, so that load() serves the same searches without tokenizing or embedding anything.
+        Pack the directory with write_bundle() to ship it as a single file.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        self.store.save(directory / "documents")
+        self.tokenizer.save(directory / "tokenizer")
+        self.bm25.save(directory / "bm25")
+        self.dense.save(directory / "dense")
+        save_array(directory, "doc_ids", self.doc_ids)
+        save_manifest(directory, "ensemble", embedding=getattr(self.embeddings, "model_name", None))
 
-class EnsembleSearch:
-    def __init__(self, documents, token_len=2, overlap=1):
-        self.token_len = token_len
-        self.overlap = overlap
-        self.embeddings = HuggingFaceEmbeddings(
+    @classmethod
+    def load(cls, directory: Union[str, Path], embeddings: Optional[Embeddings] = None, timeouts: Optional[Dict[str, float]] = None,
+             graph_search: Optional[Callable[[str, int], List[Document]]] = None,
+             backends: Optional[Dict[str, Callable[[str, int], List[Document]]]] = None) -> "EnsembleSearch":
+        """
+        Loads a retriever saved with save(), directory can also be a directory inside an IndexBundle (e.g IndexBundle(path).root).
+        The BM25 and dense indexes are memory mapped. embeddings only embed queries and must be the model the documents were embedded with.
+        """
+        manifest = load_manifest(directory, "ensemble")
+        search = cls.__new__(cls)
+        search.embeddings = embeddings or HuggingFaceEmbeddings(
             model_name="sentence-transformers/multi-qa-mpnet-base-cos-v1",
             model_kwargs={'device': "cuda"})
+        model_name = getattr(search.embeddings, "model_name", None)
+        if manifest["embedding"] is not None and model_name is not None and model_name != manifest["embedding"]:
+            raise ValueError(f"{directory} was embedded with {manifest['embedding']}, not {model_name}")
+        search.store = DocumentStore.load(directory / "documents")
+        search.tokenizer = CodeTokenizer.load(directory / "tokenizer")
+        search.bm25 = BM25Index.load(directory / "bm25")
+        search.dense = MappedDenseIndex(directory / "dense")
+        search.doc_ids = np.asarray(load_array(directory, "doc_ids"))
+        search.documents = [search.store.document(doc_id, "header") for doc_id in search.doc_ids]
+        search._files = None
+        search.graph_search = graph_search
+        search.backends = dict(backends or {})
+        search.orchestrator = RetrievalOrchestrator(timeouts)
+        return search
 
-        # all-MiniLM-L6-v2
-        # multi-qa-mpnet-base-cos-v1
-        # BM25 initialization
-        documents = deepcopy(documents)
-        for docs in documents:
-            newContent = f"Block Type: {docs.metadata['block_type']} \n\
-                Relative Path: {docs.metadata['relative_path']},{docs.metadata['start_offset']},{docs.metadata['end_offset']} \n \
-                Block Name: {docs.metadata['block_name']} \n\
-                Arguments: {' '.join(docs.metadata['block_args'])} \n\
-                Code: {' '.join(re.findall('[a-zA-Z0-9]+', docs.page_content))}"
-            docs.page_content = newContent
-        self.documents = documents
-        self.bm25_retriever = BM25Retriever.from_documents(
-            documents, preprocess_func=self.customSplitter)
-
-        self.db = FAISS.from_documents(documents, self.embeddings)
-
-    def search(self, query, weight, top_n=10, final_k=5, reranker:Optional[BaseDocumentCompressor] = None):
+    @property
+    def files(self) -> FileIndex:
+        """
+        File level index for hierarchical search, built on first use with centroids from the block vectors of the dense index.
+        Retrievers over the whole store share it through the store.
+        """
+        if self._files is None:
+            build = lambda store: FileIndex(store, self.doc_ids, vectors=self.dense.vectors(self.doc_ids))
+            self._files = self.store.derived("file_index", build) if len(self.doc_ids) == len(self.store) else build(self.store)
+        return self._files
+
+    def search(self, query, weight, top_n=10, final_k=5, reranker:Optional[BaseDocumentCompressor] = None, filters: Optional[Dict] = None,
+               top_files: Optional[int] = None, expand_context: bool = False, call_depth: int = 0, call_token_budget: int = DEFAULT_TOKEN_BUDGET,
+               symbols: bool = False, usages: bool = False, callers: bool = False, backend_weights: Optional[Dict[str, float]] = None,
+               report: Optional[Dict] = None):
+        """
+        weight holds the BM25 and FAISS weights, plus optional third and fourth weights for the graph and usages backends (default to the BM25 weight).
+        backend_weights are the weights of the other backends by name, also defaulting to the BM25 weight.
+        filters restricts the search to blocks matching the metadata filter (see MetadataIndex) before any scoring is done.
+        top_files enables hierarchical search: the file index picks the top_files best matching files first, and only their blocks are scored.
+        expand_context prepends the skeleton of the enclosing class to every retrieved method (see ContextIndex).
+        call_depth appends the callers and callees of the retrieved blocks up to that many calls away, within call_token_budget tokens (see CallGraph).
+        symbols first looks up the identifiers named in the query (see SymbolIndex), returning the blocks defining them without searching if there are any.
+        usages adds a backend returning the blocks that use the identifiers named in the query (see UsageIndex), for documents loaded with PythonASTDocumentLoader(..., identifiers=True).
+        callers adds a "callers" backend returning the blocks that eventually call the symbols named in the query (see TransitiveCallerSearch), weighted by backend_weights["callers"].
+        report, if given, is filled with the status and latency of every backend for this search (see RetrievalOrchestrator).
+        """
         # Hybrid extracts twice the final number of retrieved docs, reranks and takes the top few.
+        candidates = filter_positions(self.store, self.doc_ids, filters)
+        if symbols:
+            symbol_docs = symbol_documents(self.store, self.doc_ids, candidates, query, final_k)
+            if symbol_docs:
+                return expand_documents(self.store, symbol_docs, expand_context, call_depth, call_token_budget)
+        query_vector = None
+        if top_files is not None:
+            query_vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+            file_candidates = self.files.file_positions(self.files.top_files(query, top_files, query_vector, weight[:2]))
+            candidates = file_candidates if candidates is None else np.intersect1d(candidates, file_candidates)
 
-        self.bm25_retriever.k = 2*top_n
-        faiss_retriever = self.db.as_retriever(search_kwargs={'k': 2*top_n})
-        retriever = EnsembleRetriever(
-            retrievers=[self.bm25_retriever, faiss_retriever], weights=weight)
-        ranked_docs = retriever.invoke(query)
+        # BM25, FAISS and graph retrieval run concurrently, each with its own deadline
+        searches = {"lexical": lambda: self.bm25_search(query, 2*top_n, candidates),
+                    "dense": lambda: self.faiss_search(query, 2*top_n, candidates, query_vector)}
+        weights = {"lexical": weight[0], "dense": weight[1]}
+        if self.graph_search is not None:
+            searches["graph"] = lambda: self.graph_search(query, 2*top_n)
+            weights["graph"] = weight[2] if len(weight) > 2 else weight[0]
+        if usages:
+            searches["usages"] = lambda: symbol_usage_documents(self.store, self.doc_ids, candidates, query, 2*top_n)
+            weights["usages"] = weight[3] if len(weight) > 3 else weight[0]
+        if callers:
+            searches["callers"] = lambda: transitive_caller_documents(self.store, self.doc_ids, candidates, query, 2*top_n)
+            weights["callers"] = (backend_weights or {}).get("callers", weight[0])
+        for name, backend in self.backends.items():
+            searches[name] = lambda backend=backend: backend(query, 2*top_n)
+            weights[name] = (backend_weights or {}).get(name, weight[0])
+        ranked_docs, backend_report = self.orchestrator.retrieve(searches, weights)
+        ranked_docs = DocumentStore.detach(ranked_docs)
+        if report is not None:
+            report.update(backend_report)
 
         if reranker:
             ranked_docs = reranker.compress_documents(ranked_docs, query)
-        ranked_docs = ranked_docs[:final_k]
-
-        return ranked_docs 
+        return expand_documents(self.store, ranked_docs[:final_k], expand_context, call_depth, call_token_budget)
 
-    def customSplitter(self, strIn):
-        listOfToken = []
+    def bm25_search(self, query, k: int, candidates: Optional[np.ndarray] = None) -> List[Document]:
+        """
+        BM25 search, only scoring the candidate positions if given.
+        Always returns k documents if there are that many candidates, like BM25Retriever did.
+        """
+        _, top_positions = self.bm25.top_k(self.tokenizer.encode_query(query), k, candidates, fill=True)
+        return [self.documents[pos] for pos in top_positions]
 
-        for x in range(self.overlap, len(strIn), self.token_len):
-            end_index = min(x+self.token_len, len(strIn))
-            listOfToken.append(strIn[x-self.overlap:end_index])
-        return listOfToken
+    def faiss_search(self, query, k: int, candidates: Optional[np.ndarray] = None, query_vector: Optional[np.ndarray] = None) -> List[Document]:
+        """
+        FAISS search. With candidates, only the vectors of the candidate positions are compared.
+        query_vector skips embedding the query if it was already embedded.
+        """
+        ids = None if candidates is None else self.doc_ids[candidates]
+        if query_vector is None:
+            query_vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+        _, block_ids = self.dense.search(query_vector, k, ids)
+        return [self.store.document(block_id, "header") for block_id in block_ids[0] if block_id != -1]
@@ -0,0 +1,289 @@
+import argparse
+import json
+import time
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import InMemoryByteStore
+from langchain_community.document_loaders import DirectoryLoader
+from langchain_core.embeddings import Embeddings
+from rank_bm25 import BM25Okapi
+
+from code_tokenizer import WORD_PATTERN, CharWindowTokenizer, CodeTokenizer, split_identifier
+from document_store import DocumentStore, block_key
+from lexical_index import BM25Index
+from metadata_index import normalize_path
+from python_ast import PythonASTDocumentLoader
+from retrievers import EnsembleSearch
+from sharded_search import ShardedSearch
+
+
+class HashedWordEmbeddings(Embeddings):
+    """
+    Model free stand-in for the sentence transformer (--offline-embeddings): log term frequencies of the identifier parts of a text hashed into dim buckets, L2 normalized.
+    Latencies are not those of the real model, and recall only reflects word overlap.
+    """
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for part, count in Counter(part for word in WORD_PATTERN.findall(text) for part in split_identifier(word)).items():
+            vector[zlib.crc32(part.encode()) % self.dim] += 1 + np.log(count)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+
+def benchmark_tokenizers(store: DocumentStore, queries: List[str]) -> pd.DataFrame:
+    """
+    Compares BM25 index size and scoring time of the lexical tokenizers over the header view of the store.
+    Postings are the number of (token, document) pairs in the index, which is what BM25 scoring iterates over.
+    """
+    tokenizers = {
+        "char window (2, 1)": CharWindowTokenizer(token_len=2, overlap=1),
+        "code": CodeTokenizer(),
+        "code + 3-gram fallback": CodeTokenizer(ngram_size=3),
+    }
+    try:
+        tokenizers["code + stemming"] = CodeTokenizer(stem=True)
+    except ImportError:
+        print("snowballstemmer not installed, skipping stemming tokenizer")
+
+    texts = store.texts("lexical")
+    results = []
+    for name, tokenizer in tokenizers.items():
+        start = time.perf_counter()
+        bm25 = BM25Okapi(tokenizer.encode_corpus(texts))
+        build_time = time.perf_counter() - start
+
+        encoded_queries = [tokenizer.encode_query(query) for query in queries]
+        start = time.perf_counter()
+        for query_tokens in encoded_queries:
+            bm25.get_scores(query_tokens)
+        query_time = (time.perf_counter() - start) / max(len(queries), 1)
+
+        results.append({
+            "Tokenizer": name,
+            "Vocabulary": len(tokenizer.vocabulary),
+            "Postings": sum(len(doc_freqs) for doc_freqs in bm25.doc_freqs),
+            "Avg Query Tokens": sum(len(tokens) for tokens in encoded_queries) / max(len(queries), 1),
+            "Build Time (s)": build_time,
+            "Avg BM25 Query Time (ms)": query_time * 1000
+        })
+    return pd.DataFrame(results)
+
+
+def synthetic_corpus(num_docs: int, vocab_size: int, topical: bool, rng: np.random.Generator) -> List[List[int]]:
+    """
+    Random token id documents with Zipf distributed token frequencies, like identifiers and words in code.
+    When topical, half of every document is drawn from a small set of rarer tokens of its topic, the way a module keeps reusing its own names.
+    """
+    zipf = 1 / np.arange(1, vocab_size + 1) ** 1.07
+    zipf /= zipf.sum()
+    topics = rng.choice(np.arange(vocab_size // 20, vocab_size), size=(max(num_docs // 40, 1), 15))
+    corpus = []
+    for _ in range(num_docs):
+        length = int(rng.integers(10, 120))
+        common = length // 2 if topical else length
+        document = rng.choice(vocab_size, size=common, p=zipf).tolist()
+        if topical:
+            document += rng.choice(topics[rng.integers(len(topics))], size=length - common).tolist()
+        corpus.append(document)
+    return corpus
+
+
+def benchmark_bm25_pruning(num_docs: int = 200000, vocab_size: int = 50000, num_queries: int = 50, k: int = 25, seed: int = 0) -> pd.DataFrame:
+    """
+    Compares top-k BM25 query time of rank_bm25 (scores every document), exhaustive BM25Index scoring (every posting of the query tokens) and pruned BM25Index.top_k on synthetic corpora.
+    Queries are 4 tokens of a random document plus 6 common tokens, like a question naming a few identifiers.
+    Pruned results are checked to be identical to exhaustive ones.
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for topical in (False, True):
+        corpus = synthetic_corpus(num_docs, vocab_size, topical, rng)
+        zipf = 1 / np.arange(1, vocab_size + 1) ** 1.07
+        zipf /= zipf.sum()
+        queries = [rng.choice(corpus[rng.integers(num_docs)], size=4).tolist() + rng.choice(vocab_size, size=6, p=zipf).tolist()
+                   for _ in range(num_queries)]
+
+        index = BM25Index(corpus)
+        okapi = BM25Okapi(corpus)
+        timings = {}
+        start = time.perf_counter()
+        for query in queries:
+            np.argsort(okapi.get_scores(query))[::-1][:k]
+        timings["rank_bm25"] = time.perf_counter() - start
+        for name, prune in (("exhaustive", False), ("pruned", True)):
+            start = time.perf_counter()
+            for query in queries:
+                index.top_k(query, k, prune=prune)
+            timings[name] = time.perf_counter() - start
+
+        identical = all(np.array_equal(index.top_k(query, k)[1], index.top_k(query, k, prune=False)[1]) for query in queries)
+        for name, total in timings.items():
+            results.append({
+                "Corpus": "topical" if topical else "uniform",
+                "Documents": num_docs,
+                "Postings": index.num_postings,
+                "Method": name,
+                "Avg Query Time (ms)": total / num_queries * 1000,
+                "Speedup vs rank_bm25": timings["rank_bm25"] / total,
+                "Identical Top-k": identical
+            })
+    return pd.DataFrame(results)
+
+
+def relevance_key(metadata: Dict) -> str:
+    """
+    Block key in the format of the relavant lists of the retriever test cases.
+    """
+    return f"{metadata['relative_path']},{metadata['start_offset']},{metadata['end_offset']}"
+
+
+def benchmark_hierarchical(store: DocumentStore, test_cases: List[Dict], top_files_options: Sequence[Optional[int]] = (None, 3, 5, 10, 20),
+                           weight: Sequence[float] = (0.4, 0.6), top_n: int = 10, final_k: int = 5, embeddings: Optional[Embeddings] = None) -> pd.DataFrame:
+    """
+    Compares flat EnsembleSearch (top_files None) with hierarchical search over the top files on the retriever test payloads.
+    File Recall is the fraction of relevant blocks whose file was selected, an upper bound on the recall of the block level search.
+    The file index is built before timing, its build time is reported separately.
+    """
+    ensemble = EnsembleSearch(store, embeddings=embeddings)
+    start = time.perf_counter()
+    ensemble.files
+    file_index_time = time.perf_counter() - start
+    queries = [case["query"] for case in test_cases]
+    for query in queries:  # Warm up the embedding model
+        ensemble.embeddings.embed_query(query)
+
+    results = []
+    for top_files in top_files_options:
+        hits, relevant, reciprocal_ranks, file_hits, blocks_scored = 0, 0, [], 0, 0
+        start = time.perf_counter()
+        retrieved = [ensemble.search(query, weight, top_n, final_k, top_files=top_files) for query in queries]
+        query_time = (time.perf_counter() - start) / max(len(queries), 1)
+
+        for query, case, docs in zip(queries, test_cases, retrieved):
+            relevant_docs = set(case["relavant"])
+            keys = [relevance_key(doc.metadata) for doc in docs]
+            hits += sum(key in relevant_docs for key in keys)
+            relevant += len(relevant_docs)
+            reciprocal_ranks.append(next((1 / rank for rank, key in enumerate(keys, start=1) if key in relevant_docs), 0))
+            if top_files is None:
+                file_hits += len(relevant_docs)
+                blocks_scored += len(ensemble.doc_ids)
+            else:
+                query_vector = np.asarray([ensemble.embeddings.embed_query(query)], dtype=np.float32)
+                files = ensemble.files.top_files(query, top_files, query_vector, weight[:2])
+                selected = {ensemble.files.paths[i] for i in files}
+                file_hits += sum(normalize_path(key.split(",")[0]) in selected for key in relevant_docs)
+                blocks_scored += len(ensemble.files.file_positions(files))
+
+        results.append({
+            "Mode": "flat" if top_files is None else f"top {top_files} files",
+            "Files": len(ensemble.files),
+            "File Index Build Time (s)": file_index_time,
+            "Avg Blocks Scored": blocks_scored / max(len(queries), 1),
+            "File Recall": file_hits / relevant if relevant else 0,
+            "Recall": hits / relevant if relevant else 0,
+            "MRR": sum(reciprocal_ranks) / max(len(queries), 1),
+            "Avg Query Time (ms)": query_time * 1000
+        })
+    ensemble.orchestrator.close()
+    return pd.DataFrame(results)
+
+
+def benchmark_sharding(store: DocumentStore, queries: List[str], shard_counts: Sequence[int] = (1, 2, 4, 8, 16), weight: Sequence[float] = (0.4, 0.6),
+                       top_n: int = 10, final_k: int = 5, bm25_n: int = 25, faiss_n: int = 10, repeats: int = 5, embeddings: Optional[Embeddings] = None) -> pd.DataFrame:
+    """
+    Compares query latency of ShardedSearch by number of shards, split by directory and by hash, with flat EnsembleSearch.
+    Shards is the number of shards actually built, num_shards is only a cap. Query times include embedding the query.
+    Identical Top-k checks that the sharded search() returns the blocks of the flat EnsembleSearch.search().
+    Document vectors are embedded once and cached for every sharded build.
+    """
+    ensemble = EnsembleSearch(store, embeddings=embeddings)
+    embeddings = CacheBackedEmbeddings.from_bytes_store(ensemble.embeddings, InMemoryByteStore(), namespace="benchmark")
+    expected = [[block_key(doc.metadata) for doc in ensemble.search(query, weight, top_n, final_k)] for query in queries]  # Also warms up
+
+    def query_time(search) -> float:
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for query in queries:
+                search(query)
+        return (time.perf_counter() - start) / max(len(queries) * repeats, 1) * 1000
+
+    results = [{"Shard By": "flat", "Max Shards": 1, "Shards": 1, "Build Time (s)": 0.0,
+                "Avg Query Time (ms)": query_time(lambda query: ensemble.search(query, weight, top_n, final_k)),
+                "Avg Hybrid Query Time (ms)": float("nan"), "Identical Top-k": True}]
+    ensemble.orchestrator.close()
+    embeddings.embed_documents(list(store.texts("header")))
+    for shard_by in ("directory", "hash"):
+        for num_shards in shard_counts:
+            start = time.perf_counter()
+            with ShardedSearch(store, shard_by=shard_by, num_shards=num_shards, embeddings=embeddings) as search:
+                build_time = time.perf_counter() - start
+                identical = all([block_key(doc.metadata) for doc in search.search(query, weight, top_n, final_k)] == keys
+                                for query, keys in zip(queries, expected))
+                results.append({
+                    "Shard By": shard_by,
+                    "Max Shards": num_shards,
+                    "Shards": len(search.shards),
+                    "Build Time (s)": build_time,
+                    "Avg Query Time (ms)": query_time(lambda query: search.search(query, weight, top_n, final_k)),
+                    "Avg Hybrid Query Time (ms)": query_time(lambda query: search.hybrid_search(query, bm25_n, faiss_n, final_k)),
+                    "Identical Top-k": identical
+                })
+    return pd.DataFrame(results)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval components on a repository")
+    parser.add_argument("directory", type=str, help="The directory containing the Python repository to index")
+    parser.add_argument("--test-file", type=str, default="RetrieverTester.json", help="Retriever test payloads, used as benchmark queries")
+    parser.add_argument("--synthetic-docs", type=int, default=200000, help="Documents in the synthetic BM25 pruning corpora, 0 to skip")
+    parser.add_argument("--hierarchical", action="store_true", help="Also compare hierarchical (top files first) with flat EnsembleSearch, this embeds the whole repository")
+    parser.add_argument("--sharding", action="store_true", help="Also compare ShardedSearch latency by number of shards with flat EnsembleSearch, this embeds the whole repository")
+    parser.add_argument("--offline-embeddings", action="store_true", help="Embed with HashedWordEmbeddings instead of the sentence transformer, e.g without a GPU or the model")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    loader = DirectoryLoader(args.directory, glob="*.py", loader_cls=PythonASTDocumentLoader, recursive=True)
+    store = DocumentStore(loader.load())
+    print("Loaded", len(store), "documents")
+
+    with open(args.test_file, 'r') as file:
+        test_cases = json.load(file)["payload"]
+    queries = [case["query"] for case in test_cases]
+
+    tokenizer_results = benchmark_tokenizers(store, queries)
+    print(tokenizer_results.to_string(index=False))
+    tokenizer_results.to_csv("tokenizerResults.csv")
+
+    embeddings = HashedWordEmbeddings() if args.offline_embeddings else None
+    if args.hierarchical:
+        hierarchical_results = benchmark_hierarchical(store, test_cases, embeddings=embeddings)
+        print(hierarchical_results.to_string(index=False))
+        hierarchical_results.to_csv("hierarchicalResults.csv")
+
+    if args.sharding:
+        sharding_results = benchmark_sharding(store, queries, embeddings=embeddings)
+        print(sharding_results.to_string(index=False))
+        sharding_results.to_csv("shardingResults.csv")
+
+    if args.synthetic_docs:
+        pruning_results = benchmark_bm25_pruning(num_docs=args.synthetic_docs)
+        print(pruning_results.to_string(index=False))
+        pruning_results.to_csv("bm25PruningResults.csv")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import json
 from retrievers import HybridSearch, EnsembleSearch
+from document_store import DocumentStore
 from langchain_community.document_loaders import DirectoryLoader
 from python_ast import PythonASTDocumentLoader
 import pandas as pd
@@ -142,8 +143,13 @@ with open('RetrieverTester.json', 'r') as file:
     retrievers = test_vars["retrievers"]
     test_cases = test_vars["payload"]
 
-ensemble = EnsembleSearch(documents)
-hybrid = HybridSearch(documents)
+# Both retrievers share one copy of the corpus
+store = DocumentStore(documents)
+ensemble = EnsembleSearch(store)
+hybrid = HybridSearch(store)
 
-result = evaluate_retrievers(retrievers, test_cases, ensemble, hybrid)
-result.to_csv("finalResults.csv")
+try:
+    result = evaluate_retrievers(retrievers, test_cases, ensemble, hybrid)
+    result.to_csv("finalResults.csv")
+finally:
+    ensemble.orchestrator.close()
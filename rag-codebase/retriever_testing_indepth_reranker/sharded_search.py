@@ -0,0 +1,208 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from langchain_core.documents import BaseDocumentCompressor, Document
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import faiss
+import heapq
+import itertools
+import numpy as np
+import os
+import zlib
+
+from code_tokenizer import CodeTokenizer
+from document_store import DocumentStore
+from lexical_index import BM25Index
+from metadata_index import MetadataIndex, normalize_path
+from rank_fusion import weighted_reciprocal_rank
+
+ROOT_GROUP = ""  # Files at the top level of the repo, sharded together
+
+
+class IndexShard:
+    """
+    BM25 and flat FAISS index over a subset of the blocks in a DocumentStore.
+    Positions in both indexes are positions in doc_ids.
+    """
+    def __init__(self, doc_ids: np.ndarray, tokenized_corpus: List[List[int]], vectors: np.ndarray):
+        self.doc_ids = doc_ids
+        self.bm25 = BM25Index(tokenized_corpus)
+        self.index = faiss.IndexFlatL2(vectors.shape[1])
+        self.index.add(vectors)
+
+    def bm25_top_k(self, query_tokens: List[int], k: int, mask: Optional[np.ndarray] = None) -> List[Tuple[float, int]]:
+        """
+        Returns (score, block id) of the top k blocks in this shard.
+        """
+        candidates = None if mask is None else np.flatnonzero(mask[self.doc_ids])
+        scores, positions = self.bm25.top_k(query_tokens, k, candidates)
+        return [(float(score), int(self.doc_ids[pos])) for score, pos in zip(scores, positions)]
+
+    def faiss_top_k(self, query_vector: np.ndarray, k: int, mask: Optional[np.ndarray] = None) -> List[Tuple[float, int]]:
+        """
+        Returns (L2 distance, block id) of the k nearest blocks in this shard.
+        """
+        params = None
+        if mask is not None:
+            bitmap = np.packbits(mask[self.doc_ids], bitorder="little")
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)))
+        distances, positions = self.index.search(query_vector, min(k, len(self.doc_ids)), params=params)
+        return [(float(dist), int(self.doc_ids[pos])) for dist, pos in zip(distances[0], positions[0]) if pos != -1]
+
+    def vectors(self, doc_ids: Sequence[int]) -> np.ndarray:
+        positions = np.searchsorted(self.doc_ids, doc_ids)
+        return self.index.reconstruct_batch(positions)
+
+
+class ShardedSearch:
+    """
+    Splits the blocks of a DocumentStore into shards, each with its own BM25 and FAISS index, and fans every query out across the shards on a thread pool. FAISS and numpy release the GIL so shards are searched in parallel.
+
+    Shards are split either by top level directory of the repo ("directory") or by a hash of the file path ("hash"), so a file always lives in exactly one shard.
+    There are at most num_shards shards: files at the top level of the repo are grouped together, and directories are packed into the smallest shard, largest first.
+    The thread pool has at most one thread per shard, call close() (or use the search as a context manager) to shut it down.
+    BM25 statistics (IDF, average document length) are computed over the whole corpus and shared by the shards, and FAISS indexes are exact, so merging the per-shard top-k gives exactly the same results as a single flat index.
+
+    Both retrieval pipelines run on top of the shards:
+    - search(): EnsembleSearch style, BM25 and FAISS fused by weighted reciprocal rank
+    - hybrid_search(): HybridSearch style, BM25 candidates re-ranked by embedding distance
+    """
+    def __init__(self,
+                 documents: Union[DocumentStore, Iterable[Document]],
+                 shard_by: str = "directory",
+                 num_shards: int = 8,
+                 max_workers: Optional[int] = None,
+                 tokenizer: Optional[CodeTokenizer] = None,
+                 embeddings: Optional[Embeddings] = None):
+        if shard_by not in ("directory", "hash"):
+            raise ValueError(f"Unsupported shard_by: {shard_by}. Supported: directory, hash")
+        self.store = DocumentStore.from_documents(documents)
+        self.tokenizer = tokenizer or CodeTokenizer()  # One tokenizer, so every shard shares the vocabulary
+        self.embeddings = embeddings or HuggingFaceEmbeddings(
+            model_name="sentence-transformers/multi-qa-mpnet-base-cos-v1",
+            model_kwargs={'device': "cuda"})
+
+        texts = self.store.texts("header")
+        lexical_texts = self.store.texts("lexical")
+        vectors = np.asarray(self.embeddings.embed_documents(list(texts)), dtype=np.float32)
+
+        self.shards: List[IndexShard] = []
+        self.shard_of = np.empty(len(self.store), dtype=np.int32)  # Block id -> shard number
+        for shard_num, doc_ids in enumerate(self.__partition(shard_by, num_shards)):
+            self.shard_of[doc_ids] = shard_num
+            self.shards.append(IndexShard(doc_ids, self.tokenizer.encode_corpus(lexical_texts[i] for i in doc_ids), vectors[doc_ids]))
+        self.__share_bm25_statistics()
+
+        self.executor = ThreadPoolExecutor(max_workers=min(max_workers or len(self.shards), len(self.shards)))
+
+    def __enter__(self) -> "ShardedSearch":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def bm25_search(self, query: str, k: int, filters: Optional[Dict] = None) -> List[Tuple[float, int]]:
+        """
+        Returns (score, block id) of the global top k BM25 blocks, highest first.
+        Like the flat retrievers, blocks matching no query token fill up the k with score 0, lowest block id first.
+        """
+        query_tokens = self.tokenizer.encode_query(query)
+        mask = self.store.derived("metadata_index", MetadataIndex).mask(filters)
+        per_shard = self.executor.map(lambda shard: shard.bm25_top_k(query_tokens, k, mask), self.shards)
+        # Ties go to the lowest block id, as in a single BM25Index
+        hits = heapq.nsmallest(k, (hit for hits in per_shard for hit in hits), key=lambda hit: (-hit[0], hit[1]))
+        if len(hits) < k:
+            found = {doc_id for _, doc_id in hits}
+            pool = self.store.ids if mask is None else np.flatnonzero(mask).tolist()
+            hits += [(0.0, doc_id) for doc_id in itertools.islice((doc_id for doc_id in pool if doc_id not in found), k - len(hits))]
+        return hits
+
+    def faiss_search(self, query: str, k: int, filters: Optional[Dict] = None) -> List[Tuple[float, int]]:
+        """
+        Returns (L2 distance, block id) of the global k nearest blocks, nearest first.
+        """
+        query_vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+        mask = self.store.derived("metadata_index", MetadataIndex).mask(filters)
+        per_shard = self.executor.map(lambda shard: shard.faiss_top_k(query_vector, k, mask), self.shards)
+        return heapq.nsmallest(k, (hit for hits in per_shard for hit in hits))
+
+    def search(self, query, weight, top_n=10, final_k=5, reranker: Optional[BaseDocumentCompressor] = None, filters: Optional[Dict] = None) -> List[Document]:
+        """
+        EnsembleSearch over the shards: twice the final number of docs from BM25 and FAISS each, fused by weighted reciprocal rank.
+        """
+        bm25_hits = self.bm25_search(query, 2*top_n, filters)
+        faiss_hits = self.faiss_search(query, 2*top_n, filters)
+        doc_ids = weighted_reciprocal_rank([[doc_id for _, doc_id in bm25_hits],
+                                            [doc_id for _, doc_id in faiss_hits]], weight)
+        return self.__finalize(query, doc_ids, final_k, reranker)
+
+    def hybrid_search(self, query, bm25_n=25, faiss_n=10, final_k=5, reranker: Optional[BaseDocumentCompressor] = None, filters: Optional[Dict] = None) -> List[Document]:
+        """
+        HybridSearch over the shards: the global top bm25_n BM25 blocks are ranked by distance to the query embedding.
+        The block vectors are taken from the shard indexes instead of re-embedding the candidates for every query, each shard scoring its own candidates on the thread pool.
+        """
+        candidates = [doc_id for _, doc_id in self.bm25_search(query, bm25_n, filters)]
+        if not candidates:
+            return []
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+
+        by_shard = defaultdict(list)
+        for doc_id in sorted(candidates):
+            by_shard[self.shard_of[doc_id]].append(doc_id)
+
+        def shard_distances(item: Tuple[int, List[int]]) -> List[Tuple[float, int]]:
+            shard_num, doc_ids = item
+            return list(zip(np.sum((self.shards[shard_num].vectors(doc_ids) - query_vector) ** 2, axis=1).tolist(), doc_ids))
+
+        per_shard = self.executor.map(shard_distances, by_shard.items())
+        doc_ids = [doc_id for _, doc_id in heapq.nsmallest(faiss_n, (hit for hits in per_shard for hit in hits))]
+        return self.__finalize(query, doc_ids, final_k, reranker)
+
+    def __finalize(self, query, doc_ids: List[int], final_k: int, reranker: Optional[BaseDocumentCompressor]) -> List[Document]:
+        ranked_docs = DocumentStore.detach([self.store.document(doc_id, "header") for doc_id in doc_ids])
+        if reranker:
+            ranked_docs = reranker.compress_documents(ranked_docs, query)
+        return ranked_docs[:final_k]
+
+    def __partition(self, shard_by: str, num_shards: int) -> List[np.ndarray]:
+        """
+        Groups block ids into at most num_shards shards. Empty shards are dropped.
+        """
+        paths = [normalize_path(self.store.metadata(doc_id).get("relative_path", "")) for doc_id in self.store.ids]
+        if shard_by == "hash":
+            shards = [[] for _ in range(num_shards)]
+            for doc_id, path in enumerate(paths):
+                shards[zlib.crc32(path.encode()) % num_shards].append(doc_id)
+            return [np.asarray(doc_ids, dtype=np.int64) for doc_ids in shards if doc_ids]
+
+        # relative_path includes wherever the repo was loaded from, so strip the common root first
+        groups = defaultdict(list)
+        root = os.path.commonpath(paths) if paths else "/"
+        for doc_id, path in enumerate(paths):
+            parts = os.path.relpath(path, root).split("/")  # A repo of a single file is "." relative to itself
+            groups[parts[0] if len(parts) > 1 else ROOT_GROUP].append(doc_id)
+        shards: List[List[int]] = [[] for _ in range(min(num_shards, len(groups)))]
+        for _, doc_ids in sorted(groups.items(), key=lambda item: (-len(item[1]), item[0])):
+            min(shards, key=len).extend(doc_ids)
+        return [np.asarray(sorted(doc_ids), dtype=np.int64) for doc_ids in shards if doc_ids]
+
+    def __share_bm25_statistics(self):
+        """
+        Replaces the per-shard IDF and average document length with corpus-wide values, so BM25 scores are comparable across shards.
+        """
+        document_frequency = defaultdict(int)
+        doc_lengths = []
+        for shard in self.shards:
+            doc_lengths.extend(shard.bm25.doc_len)
+            for token, frequency in shard.bm25.document_frequencies().items():
+                document_frequency[token] += frequency
+
+        idf = BM25Index.compute_idf(document_frequency, len(doc_lengths), self.shards[0].bm25.epsilon)
+        average_doc_length = float(np.mean(doc_lengths))
+        for shard in self.shards:
+            shard.bm25.set_statistics(idf, average_doc_length)
@@ -0,0 +1,114 @@
+from bisect import bisect_left
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import re
+import numpy as np
+
+from document_store import DocumentStore
+from index_files import MappedTexts, load_array, load_manifest, save_array, save_manifest, save_texts
+
+LAST_CHARACTER = "\U0010ffff"  # Sorts after every character, so keys starting with a prefix are in [prefix, prefix + LAST_CHARACTER)
+BACKTICK_PATTERN = re.compile(r"`([^`]+)`")
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][\w.]*\w(?:\(\))?")
+
+
+def qualified_names(metadata: Dict) -> List[str]:
+    """
+    Names a block can be looked up by: its name, with its class (Class.method) and with its module (module.Class.method, module.function).
+    Blocks other than classes and functions have none.
+    """
+    if metadata.get("block_type") not in ("class", "function") or not metadata.get("block_name"):
+        return []
+    names = [metadata["block_name"]]
+    if metadata.get("parent_type") == "class" and metadata.get("parent_name"):
+        names.append(f"{metadata['parent_name']}.{names[0]}")
+    module = Path(str(metadata.get("relative_path", ""))).stem
+    if module and module != "__init__":
+        names.append(f"{module}.{names[-1]}")
+    return names
+
+
+def is_identifier(token: str) -> bool:
+    """
+    Whether a word of a question looks like code rather than English: snake_case, CamelCase, dotted or called.
+    All caps words (HTTP, API) are acronyms unless they have one of the other marks (MAX_ROWS).
+    """
+    return ("_" in token or "." in token or token.endswith("()")
+            or (any(character.isupper() for character in token[1:]) and any(character.islower() for character in token)))
+
+
+def named_symbols(query: str) -> List[str]:
+    """
+    Returns the symbols a question names, without duplicates: `quoted` words, and words that look like identifiers (see is_identifier()).
+    """
+    symbols = [symbol.strip().rstrip("()") for symbol in BACKTICK_PATTERN.findall(query)]
+    symbols += [token.rstrip("()") for token in IDENTIFIER_PATTERN.findall(BACKTICK_PATTERN.sub(" ", query)) if is_identifier(token)]
+    return list(dict.fromkeys(symbol for symbol in symbols if symbol))
+
+
+class SymbolIndex:
+    """
+    Sorted index of the qualified names of every class and function (see qualified_names()), for answering questions that name a symbol without any scoring.
+
+    Keys are kept in two sorted arrays, as written and lowercased, each with the block id of every key.
+    Exact and prefix lookups are binary searches returning a contiguous range of block ids.
+    Saved indexes are memory mapped, so a lookup only decodes the few keys its binary search touches.
+    """
+    def __init__(self, block_ids: Iterable[int], metadatas: Iterable[Dict]):
+        entries = [(name, int(block_id)) for block_id, metadata in zip(block_ids, metadatas) for name in qualified_names(metadata)]
+        entries.sort()
+        self.keys: Sequence[str] = [name for name, _ in entries]
+        self.ids = np.asarray([block_id for _, block_id in entries], dtype=np.int64)
+        lower_entries = sorted((name.lower(), block_id) for name, block_id in entries)
+        self.lower_keys: Sequence[str] = [name for name, _ in lower_entries]
+        self.lower_ids = np.asarray([block_id for _, block_id in lower_entries], dtype=np.int64)
+
+    @classmethod
+    def from_store(cls, store: DocumentStore) -> "SymbolIndex":
+        return cls(store.ids, (store.metadata(doc_id) for doc_id in store.ids))
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def lookup(self, symbol: str, prefix: bool = False, ignore_case: bool = False, limit: Optional[int] = None) -> List[int]:
+        """
+        Returns the ids of the blocks defining a symbol (or every symbol starting with it), without duplicates and in key order.
+        """
+        keys, ids = (self.lower_keys, self.lower_ids) if ignore_case else (self.keys, self.ids)
+        symbol = symbol.lower() if ignore_case else symbol
+        start = bisect_left(keys, symbol)
+        end = bisect_left(keys, symbol + LAST_CHARACTER, start) if prefix else bisect_left(keys, symbol + "\0", start)
+        block_ids = list(dict.fromkeys(ids[start:end].tolist()))
+        return block_ids if limit is None else block_ids[:limit]
+
+    def find(self, query: str, limit: Optional[int] = None) -> List[int]:
+        """
+        Returns the ids of the blocks defining the symbols named in a question (see named_symbols()).
+        Case-sensitive matches win, a symbol is only looked up ignoring case if it has none.
+        """
+        block_ids = {}
+        for symbol in named_symbols(query):
+            for block_id in self.lookup(symbol) or self.lookup(symbol, ignore_case=True):
+                block_ids.setdefault(block_id, None)
+        found = list(block_ids)
+        return found if limit is None else found[:limit]
+
+    def save(self, directory: Union[str, Path]):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        save_texts(directory, "keys", self.keys)
+        save_array(directory, "ids", self.ids)
+        save_texts(directory, "lower_keys", self.lower_keys)
+        save_array(directory, "lower_ids", self.lower_ids)
+        save_manifest(directory, "symbols", size=len(self.keys))
+
+    @classmethod
+    def load(cls, directory: Union[str, Path]) -> "SymbolIndex":
+        load_manifest(directory, "symbols")
+        index = cls.__new__(cls)
+        index.keys = MappedTexts(directory, "keys")
+        index.ids = load_array(directory, "ids")
+        index.lower_keys = MappedTexts(directory, "lower_keys")
+        index.lower_ids = load_array(directory, "lower_ids")
+        return index
@@ -0,0 +1,113 @@
+from collections import deque
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from call_closure import CLOSURE_WRITE_QUERY, TRANSITIVE_CALLERS_QUERY, CallClosure, IntervalLabels, TransitiveCallerSearch, strongly_connected_components
+from call_graph import CallGraph, csr
+from document_store import DocumentStore
+
+
+def random_graph(num_nodes: int, num_edges: int, seed: int):
+    rng = np.random.default_rng(seed)
+    sources, targets = rng.integers(0, num_nodes, num_edges), rng.integers(0, num_nodes, num_edges)
+    offsets, targets = csr(sources, targets, num_nodes)
+    return offsets, targets
+
+
+def reachable(offsets: np.ndarray, targets: np.ndarray, source: int) -> set:
+    """
+    Nodes reached from source by at least one edge (breadth first search).
+    """
+    seen, queue = set(), deque([source])
+    while queue:
+        node = queue.popleft()
+        for target in targets[offsets[node]:offsets[node + 1]].tolist():
+            if target not in seen:
+                seen.add(target)
+                queue.append(target)
+    return seen
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_components_are_mutually_reachable_and_topologically_numbered(seed):
+    offsets, targets = random_graph(40, 60, seed)
+    component = strongly_connected_components(offsets, targets)
+    reach = [reachable(offsets, targets, node) | {node} for node in range(40)]
+    for a in range(40):
+        for b in range(40):
+            assert (component[a] == component[b]) == (b in reach[a] and a in reach[b])
+    sources = np.repeat(np.arange(40), np.diff(offsets))
+    assert (component[sources] >= component[targets]).all()
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_interval_labels_match_breadth_first_search(seed):
+    rng = np.random.default_rng(seed)
+    sources = rng.integers(1, 50, 90)
+    offsets, targets = csr(sources, rng.integers(0, sources), 50)  # Edges to smaller nodes only, a DAG
+    labels = IntervalLabels(offsets, targets)
+    for source in range(50):
+        expected = reachable(offsets, targets, source) | {source}
+        assert set(labels.reachable(source).tolist()) == expected
+        assert [target for target in range(50) if labels.reaches(source, target)] == sorted(expected)
+
+
+def call_store(calls) -> DocumentStore:
+    return DocumentStore([Document(page_content=f"def f{i}(): pass", metadata={
+        "relative_path": "repo/app.py", "block_type": "function", "block_name": f"f{i}", "start_offset": 10 * i, "end_offset": 10 * i + 9,
+        "parent_type": "root", "parent_name": "root", "block_args": [], "functions_called": [f"f{callee}()" for callee in callees]})
+        for i, callees in enumerate(calls)])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_closure_matches_breadth_first_search(seed):
+    rng = np.random.default_rng(seed)
+    store = call_store([rng.choice(30, rng.integers(0, 3), replace=False).tolist() for _ in range(30)])
+    graph = CallGraph(store)
+    closure = CallClosure(store, graph)
+    for doc_id in range(30):
+        callees = reachable(graph.callee_offsets, graph.callee_ids, doc_id) | ({doc_id} if graph.calls_itself[doc_id] else set())
+        callers = {caller for caller in range(30) if doc_id in reachable(graph.callee_offsets, graph.callee_ids, caller)}
+        callers |= {doc_id} if graph.calls_itself[doc_id] else set()
+        assert closure.transitive_callees(doc_id).tolist() == sorted(callees)
+        assert closure.transitive_callers(doc_id).tolist() == sorted(callers)
+        assert [callee for callee in range(30) if closure.calls_eventually(doc_id, callee)] == sorted(callees)
+
+
+def test_directly_recursive_blocks_call_themselves_eventually():
+    store = call_store([[1, 2], [1], [0, 3], []])  # f1 calls itself, f0 and f2 call each other, f3 calls nothing
+    closure = CallClosure(store)
+    assert closure.calls_eventually(1, 1) and closure.calls_eventually(0, 0)
+    assert not closure.calls_eventually(3, 3)
+    assert closure.transitive_callers(1).tolist() == [0, 1, 2]
+    assert closure.transitive_callees(3).tolist() == []
+    assert closure.properties(1)["recursive"] and not closure.properties(3)["recursive"]
+
+
+def test_transitive_callers_of_the_named_symbols_closest_first():
+    store = call_store([[1], [2], [3], [], [3], [4, 5], [5]])  # f0 -> f1 -> f2 -> f3 <- f4 <- f5 <- f6, f5 also calls itself
+    search = TransitiveCallerSearch(store)
+    assert search.caller_ids("what eventually calls `f3`").tolist() == [2, 4, 0, 1, 5, 6]
+    assert [doc.metadata["block_name"] for doc in search("what eventually calls `f3`", 3)] == ["f2", "f4", "f0"]
+    assert search.caller_ids("who calls `f5`").tolist() == [6]  # f5 calling itself is not news
+    assert search.caller_ids("who calls `f0`").tolist() == [] and search("who calls it", 5) == []
+    assert store.derived("call_closure", CallClosure) is store.derived("call_closure", CallClosure)
+
+
+def test_properties_are_written_per_label():
+    queries = []
+
+    class Graph:
+        def query(self, cypher, params=None):
+            queries.append((cypher, params))
+
+    store = call_store([[1], []])
+    assert CallClosure(store).write_properties(Graph(), batch_size=1) == 2
+    writes = [params["rows"] for cypher, params in queries if cypher == CLOSURE_WRITE_QUERY.format(label="Function")]
+    assert [rows[0]["name"] for rows in writes] == ["f0", "f1"]
+    assert writes[0][0]["callee_intervals"] == [0, 1] and writes[1][0]["caller_intervals"] == [0, 1]
+    assert any("ON (n.name)" in cypher for cypher, _ in queries)
+    # Lookups stay within labels instead of scanning every node
+    assert "MATCH (x)" not in TRANSITIVE_CALLERS_QUERY and "MATCH (n)" not in TRANSITIVE_CALLERS_QUERY
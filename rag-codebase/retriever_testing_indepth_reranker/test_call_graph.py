@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from call_graph import CallGraph, callee_name, csr
+from document_store import DocumentStore
+
+
+def block(name: str, calls=(), path: str = "repo/app.py", parent_type: str = "root", parent_name: str = "", block_type: str = "function",
+          start: int = 0) -> Document:
+    return Document(page_content=f"def {name}(): pass", metadata={
+        "relative_path": path, "block_type": block_type, "block_name": name, "start_offset": start, "end_offset": start + 10,
+        "parent_type": parent_type, "parent_name": parent_name, "block_args": [], "functions_called": list(calls)})
+
+
+@pytest.fixture
+def store() -> DocumentStore:
+    return DocumentStore([
+        block("App", block_type="class", start=0),                                                     # 0
+        block("run", ["self.load()", "helper(x)", "Config()"], parent_type="class", parent_name="App", start=10),  # 1
+        block("load", ["Loader.read(path)"], parent_type="class", parent_name="App", start=20),        # 2
+        block("helper", ["helper(x - 1)"], start=30),                                                  # 3
+        block("Config", block_type="class", path="repo/config.py"),                                    # 4
+        block("read", parent_type="class", parent_name="Loader", path="repo/loader.py"),               # 5
+        block("helper", path="repo/other.py"),                                                         # 6
+        block("main", ["helper()", "get()"], path="repo/cli.py"),                                      # 7
+    ] + [block("get", path=f"repo/get{i}.py") for i in range(4)])                                      # 8-11
+
+
+def test_callee_names():
+    assert callee_name("self.app.run(debug=True)") == ("app", "run")
+    assert callee_name("print(x.y)") == (None, "print")
+
+
+def test_csr():
+    offsets, targets = csr(np.asarray([2, 0, 2]), np.asarray([5, 6, 7]), 4)
+    assert offsets.tolist() == [0, 1, 1, 3, 3]
+    assert targets.tolist() == [6, 5, 7]
+
+
+def test_calls_are_resolved_most_specific_first(store):
+    graph = CallGraph(store)
+    assert graph.callees(1).tolist() == [2, 3, 4]  # self method, same file function, class
+    assert graph.callees(2).tolist() == [5]  # Class.method
+    # Ambiguous names across the repo are not linked, unique enough ones are
+    assert graph.callees(7).tolist() == [3, 6]
+    assert graph.callers(3).tolist() == [1, 7]
+    # Recursion is flagged rather than stored as an edge, so expanding never loops on a block
+    assert graph.calls_itself.nonzero()[0].tolist() == [3]
+    assert sorted(graph.neighbors(3).tolist()) == [1, 7]
+    with pytest.raises(ValueError):
+        graph.neighbors(3, "up")
+
+
+def test_expand_is_breadth_first_within_the_budget(store):
+    graph = CallGraph(store)
+    assert graph.expand([2], depth=2, direction="callers") == [(1, 1)]
+    assert graph.expand([1], depth=2, direction="callees") == [(2, 1), (3, 1), (4, 1), (5, 2)]
+    cost = int(graph.token_counts[2])
+    assert [doc_id for doc_id, _ in graph.expand([1], depth=2, token_budget=cost, direction="callees")] == [2]
+
+    documents = graph.expand_documents([store.document(2)], depth=1, direction="callers")
+    assert documents[0] is store.document(2) and documents[1].metadata["call_distance"] == 1
@@ -0,0 +1,67 @@
+import pytest
+
+from code_tokenizer import CodeTokenizer, split_identifier
+from document_store import header_view, lexical_view
+
+
+def test_identifiers_are_split_and_kept_whole():
+    assert split_identifier("TaggedJSONSerializer") == ["tagged", "json", "serializer"]
+    assert CodeTokenizer().tokenize("TaggedJSONSerializer get_scores") == [
+        "taggedjsonserializer", "tagged", "json", "serializer", "get_scores", "get", "scores"]
+
+
+def test_dotted_names_are_emitted_whole_with_their_parts():
+    assert CodeTokenizer().tokenize("os.path.join(a)") == ["os.path.join", "os", "path", "join"]
+    assert CodeTokenizer().tokenize("self.get_scores") == ["self.get_scores", "self", "get_scores", "get", "scores"]
+    assert CodeTokenizer().tokenize("end. Next") == ["end", "next"]
+
+
+def test_short_parts_are_dropped():
+    assert CodeTokenizer().tokenize("a x_y bb") == ["x_y", "bb"]
+    assert CodeTokenizer(min_token_len=3).tokenize("get_id") == ["get_id", "get"]
+
+
+def test_queries_only_look_up_the_vocabulary():
+    tokenizer = CodeTokenizer()
+    corpus = tokenizer.encode_corpus(["import os.path", "def join(path)"])
+    query = tokenizer.encode_query("os.path.join unknown")
+    assert "unknown" not in tokenizer.vocabulary
+    # os.path.join itself never occurred, its parts did
+    assert set(query) == {corpus[0][2], corpus[0][3], corpus[1][1]}
+    assert tokenizer.encode_query("os.path") == [corpus[0][1]] + corpus[0][2:]
+
+
+def test_unknown_query_words_fall_back_to_ngrams():
+    tokenizer = CodeTokenizer(ngram_size=3)
+    tokenizer.encode_corpus(["serializer"])
+    assert tokenizer.encode_query("serialize") == tokenizer.vocabulary.lookup(["#ser", "#eri", "#ria", "#ial", "#ali", "#liz", "#ize"])
+    assert tokenizer.encode_query("serializer") == tokenizer.vocabulary.lookup(["serializer"])
+
+
+@pytest.mark.parametrize("ngram_size", [None, 3])
+def test_saved_tokenizers_encode_queries_the_same(tmp_path, ngram_size):
+    tokenizer = CodeTokenizer(ngram_size=ngram_size, min_token_len=3)
+    tokenizer.encode_corpus(["class TaggedJSONSerializer:", "def dumps(value): return os.path.join(value)"])
+    tokenizer.save(tmp_path)
+    loaded = CodeTokenizer.load(tmp_path)
+    assert (loaded.ngram_size, loaded.min_token_len, len(loaded.vocabulary)) == (ngram_size, 3, len(tokenizer.vocabulary))
+    loaded.save(tmp_path / "again")
+    again = CodeTokenizer.load(tmp_path / "again")
+    for query in ("tagged json serializers", "os.path.join the value", "dump", "nothing"):
+        assert loaded.encode_query(query) == again.encode_query(query) == tokenizer.encode_query(query)
+    with pytest.raises(TypeError):
+        loaded.encode_corpus(["def loads(text)"])
+
+
+def test_stemming():
+    pytest.importorskip("snowballstemmer")
+    tokenizer = CodeTokenizer(stem=True)
+    assert tokenizer.tokenize("running runs") == ["run", "run"]
+
+
+def test_lexical_view_keeps_identifiers():
+    metadata = {"block_type": "function", "relative_path": "repo/a.py", "start_offset": 0, "end_offset": 30,
+                "block_name": "get_scores", "block_args": ["query"]}
+    code = "def get_scores(query): return os.path.join(query)"
+    assert "def get_scores query return os.path.join query" in lexical_view(code, metadata)
+    assert "def get scores query return os path join query" in header_view(code, metadata)
@@ -0,0 +1,52 @@
+from langchain_core.documents import Document
+
+from context_index import ContextIndex, skeleton
+from document_store import DocumentStore
+
+
+def block(name: str, block_type: str, start: int, end: int, content: str, parent_type: str = "root", parent_name: str = "",
+          path: str = "repo/app.py", args=()) -> Document:
+    return Document(page_content=content, metadata={"relative_path": path, "block_type": block_type, "block_name": name, "start_offset": start,
+                                                    "end_offset": end, "parent_type": parent_type, "parent_name": parent_name, "block_args": list(args)})
+
+
+def store() -> DocumentStore:
+    return DocumentStore([
+        block("Flask", "class", 0, 100, "class Flask:\n    # Code for function: Flask.run(self)\n    # Code for function: Flask.stop(self)"),
+        block("run", "function", 20, 50, "def run(self): pass", "class", "Flask", args=["self"]),
+        block("stop", "function", 60, 90, "def stop(self): pass", "class", "Flask", args=["self"]),
+        # A second class with the same name later in the file owns the methods after it
+        block("Flask", "class", 200, 300, "class Flask:\n    # Code for function: Flask.run(self)"),
+        block("run", "function", 220, 250, "def run(self): return 2", "class", "Flask", args=["self"]),
+        block("outer", "function", 400, 500, "def outer():\n    def inner(): pass\n    return inner"),
+        block("inner", "function", 410, 430, "def inner(): pass", "function", "outer"),
+        block("run", "function", 0, 10, "def run(): pass", path="repo/cli.py"),
+    ])
+
+
+def test_parents_children_and_siblings():
+    index = ContextIndex(store())
+    assert index.parent.tolist() == [-1, 0, 0, -1, 3, -1, 5, -1]
+    assert index.children(0).tolist() == [1, 2]
+    assert index.children(3).tolist() == [4]
+    assert index.siblings(1).tolist() == [2]
+    assert index.siblings(7).tolist() == []
+
+
+def test_skeletons():
+    index = ContextIndex(store())
+    assert index.skeletons[0] == store().content(0)
+    assert skeleton("def outer():\n    def inner(): pass", {"block_type": "function", "block_name": "outer"},
+                    [{"block_type": "function", "block_name": "inner", "block_args": ["x"]}]) == "def outer():\n# Code for function: outer.inner(x)"
+
+
+def test_expand_prepends_the_parent_skeleton_once():
+    documents = store().documents("raw")
+    index = ContextIndex(store())
+    expanded = index.expand([documents[1], documents[7]])
+    assert expanded[0].page_content.startswith("class Flask:\n") and expanded[0].page_content.endswith("def run(self): pass")
+    assert expanded[0].metadata["context_parent"] == ("repo/app.py", 0, 100)
+    assert "context_parent" not in documents[1].metadata
+    assert expanded[1] is documents[7]
+    # A parent already retrieved is not repeated
+    assert index.expand([documents[0], documents[1]]) == [documents[0], documents[1]]
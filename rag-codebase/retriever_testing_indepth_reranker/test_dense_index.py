@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from dense_index import DenseIndex, MappedDenseIndex
+
+
+def exact(vectors: np.ndarray, ids: np.ndarray, query: np.ndarray, k: int):
+    distances = np.sum((vectors - query) ** 2, axis=1)
+    order = np.argsort(distances, kind="stable")[:k]
+    return distances[order], ids[order]
+
+
+@pytest.fixture
+def vectors() -> np.ndarray:
+    return np.random.default_rng(0).normal(size=(20, 8)).astype(np.float32)
+
+
+@pytest.fixture
+def index(vectors) -> DenseIndex:
+    index = DenseIndex(8, compact_ratio=0.4)
+    for file in range(4):
+        index.add(np.arange(file * 5, file * 5 + 5), vectors[file * 5:file * 5 + 5], f"f{file}.py")
+    return index
+
+
+def test_search_is_exact_and_skips_deleted_vectors(index, vectors):
+    query = vectors[3] + 0.01
+    distances, ids = index.search(query, 3)
+    assert ids[0].tolist() == exact(vectors, np.arange(20), query, 3)[1].tolist()
+    assert np.allclose(distances[0], exact(vectors, np.arange(20), query, 3)[0], atol=1e-4)
+
+    assert index.remove_file("f0.py") == [0, 1, 2, 3, 4]
+    assert len(index) == 15 and index.ntotal == 20
+    assert 3 not in index.search(query, 20)[1][0]
+    assert index.search(query, 20)[1][0].tolist().count(-1) == 5
+
+
+def test_upsert_keeps_other_block_ids_and_compacts(index, vectors):
+    removed, added = index.upsert_file("f1.py", vectors[:2])
+    assert removed == [5, 6, 7, 8, 9] and added.tolist() == [20, 21]
+    index.remove_file("f2.py")
+    # 10 of 22 slots deleted is over the compact ratio, 5 of 20 was not
+    assert index.ntotal == len(index) == 12
+    assert np.array_equal(index.vectors([15, 20]), np.stack([vectors[15], vectors[0]]))
+    assert index.search(vectors[0], 1)[1][0].tolist() in ([0], [20])
+
+
+def test_search_within_ids(index, vectors):
+    _, ids = index.search(vectors[0], 3, ids=[7, 12, 99])
+    assert sorted(ids[0].tolist()) == [-1, 7, 12]
+
+
+def test_copy_is_independent(index):
+    clone = index.copy()
+    clone.remove_file("f3.py")
+    assert len(index) == 20 and len(clone) == 15
+
+
+def test_mapped_index_matches_the_saved_index(tmp_path, index, vectors):
+    index.remove_file("f1.py")
+    index.save(tmp_path)
+    mapped = MappedDenseIndex(tmp_path)
+    assert len(mapped) == mapped.ntotal == 15 and mapped.ids == index.ids
+    for query in vectors[:4]:
+        expected_distances, expected_ids = index.search(query, 4)
+        distances, ids = mapped.search(query, 4)
+        assert ids.tolist() == expected_ids.tolist()
+        assert np.allclose(distances, expected_distances, atol=1e-4)
+    assert mapped.search(vectors[0], 20, ids=[0, 12])[1][0].tolist()[2:] == [-1] * 18
+
+
+
+def test_mapped_updates_match_an_in_memory_index(tmp_path, index, vectors):
+    index.save(tmp_path / "v0")
+    mapped = MappedDenseIndex(tmp_path / "v0")
+    updated = mapped.copy()
+    new_vectors = np.random.default_rng(1).normal(size=(3, 8)).astype(np.float32)
+    for dense in (index, updated):
+        assert dense.upsert_file("f1.py", new_vectors)[1].tolist() == [20, 21, 22]
+        dense.remove_file("f2.py")
+    # The copy shares the mapped matrix and left the original untouched
+    assert updated.matrix is mapped.matrix and len(mapped) == 20 and 5 in mapped
+    assert len(updated) == len(index) == 13 and sorted(updated.ids) == sorted(index.ids)
+    assert np.array_equal(updated.vectors([0, 21]), index.vectors([0, 21]))
+    for query in np.concatenate((vectors[::4], new_vectors)):
+        for ids in (None, [1, 7, 12, 16, 22]):
+            expected_distances, expected_ids = index.search(query, 6, ids)
+            distances, found = updated.search(query, 6, ids)
+            assert found.tolist() == expected_ids.tolist()
+            assert np.allclose(distances[found != -1], expected_distances[expected_ids != -1], atol=1e-4)
+
+    updated.save(tmp_path / "v1")
+    saved = MappedDenseIndex(tmp_path / "v1")
+    assert saved.ids == updated.ids and saved.next_id == 23
+    assert saved.file_ids == {path: ids for path, ids in index.file_ids.items()}
+    assert np.array_equal(saved.vectors(saved.ids), updated.vectors(saved.ids))
@@ -0,0 +1,61 @@
+from langchain_core.documents import Document
+
+from document_store import DocumentStore
+
+
+def block(name: str, code: str, start: int = 0) -> Document:
+    return Document(page_content=code, metadata={"block_type": "function", "relative_path": "pkg/mod.py", "start_offset": start,
+                                                 "end_offset": start + len(code), "block_name": name, "block_args": ["x"]})
+
+
+def test_views_are_computed_once_and_shared():
+    calls = []
+
+    def upper_view(content, metadata):
+        calls.append(content)
+        return content.upper()
+
+    store = DocumentStore([block("f", "def f(x): pass"), block("g", "def g(x): pass", 20)], views={"upper": upper_view})
+    assert store.texts("upper") == ("DEF F(X): PASS", "DEF G(X): PASS")
+    assert store.texts("upper") is store.texts("upper")
+    assert store.document(1, "upper") is store.documents("upper")[1]
+    assert len(calls) == 2
+
+
+def test_header_view_strips_punctuation_and_adds_metadata():
+    store = DocumentStore([block("f", "def f(x): return x+1")])
+    header = store.text(0, "header")
+    assert "Block Name: f" in header
+    assert "pkg/mod.py,0,20" in header
+    assert header.endswith("Code: def f x return x 1")
+    assert store.text(0, "raw") == "def f(x): return x+1"
+
+
+def test_from_documents_shares_an_existing_store():
+    store = DocumentStore([block("f", "def f(x): pass")])
+    assert DocumentStore.from_documents(store) is store
+    assert len(DocumentStore.from_documents([block("f", "def f(x): pass")])) == 1
+
+
+def test_derived_structures_are_built_once():
+    store = DocumentStore([block("f", "def f(x): pass")])
+    built = []
+    first = store.derived("names", lambda s: built.append(1) or [s.metadata(i)["block_name"] for i in s.ids])
+    assert store.derived("names", lambda s: built.append(1)) is first
+    assert first == ["f"] and built == [1]
+
+
+def test_detach_does_not_modify_the_store():
+    store = DocumentStore([block("f", "def f(x): pass")])
+    detached = DocumentStore.detach(store.documents("raw"))
+    detached[0].metadata["relevance_score"] = 1.0
+    assert "relevance_score" not in store.metadata(0)
+    assert "relevance_score" not in store.document(0, "raw").metadata
+
+
+def test_save_and_load_round_trip(tmp_path):
+    store = DocumentStore([block("f", "def f(x): return x"), block("g", "def g(x): return f(x)", 30)])
+    store.save(tmp_path)
+    loaded = DocumentStore.load(tmp_path)
+    assert loaded.documents("raw") == store.documents("raw")
+    assert loaded.texts("lexical") == store.texts("lexical")
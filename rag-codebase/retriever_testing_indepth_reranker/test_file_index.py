@@ -0,0 +1,48 @@
+import numpy as np
+from langchain_core.documents import Document
+
+from document_store import DocumentStore
+from file_index import FileIndex, file_summary
+
+
+def block(path: str, block_type: str, name: str, content: str, parent_type: str = "root") -> Document:
+    return Document(page_content=content, metadata={"relative_path": path, "block_type": block_type, "block_name": name, "parent_type": parent_type})
+
+
+def store() -> DocumentStore:
+    return DocumentStore([
+        block("repo/src/json_provider.py", "function", "dumps", "def dumps(obj): return json.dumps(obj)"),
+        block("repo/src/app.py", "class", "Flask", "class Flask:"),
+        block("repo/src/app.py", "others", "Global Scope", "import os\nDEFAULT_PORT = 5000"),
+        block("repo/src/json_provider.py", "function", "loads", "def loads(text): return json.loads(text)"),
+        block("repo/tests/test_cli.py", "function", "test_run", "def test_run(): runner.invoke()"),
+    ])
+
+
+def test_files_are_grouped_by_path():
+    index = FileIndex(store(), [0, 1, 2, 3, 4])
+    assert index.paths == ["/repo/src/app.py", "/repo/src/json_provider.py", "/repo/tests/test_cli.py"]
+    assert index.file_positions([1]).tolist() == [0, 3]
+    assert index.file_positions([2, 0]).tolist() == [1, 2, 4]
+    assert index.file_positions([]).tolist() == []
+
+
+def test_positions_are_relative_to_the_retriever_subset():
+    index = FileIndex(store(), [3, 4, 1])
+    assert index.paths == ["/repo/src/app.py", "/repo/src/json_provider.py", "/repo/tests/test_cli.py"]
+    assert index.file_positions([0, 1]).tolist() == [0, 2]
+
+
+def test_summaries_hold_names_and_module_code():
+    summary = file_summary("repo/src/app.py", [{"block_type": "class", "block_name": "Flask", "docstrings": ["The app object"]},
+                                               {"block_type": "others", "parent_type": "root"}],
+                           ["class Flask:", "import os\nDEFAULT_PORT = 5000"], max_module_chars=9)
+    assert summary.split("\n") == ["repo src app py", "Flask", "The app object", "import os"]
+
+
+def test_top_files_by_bm25_and_centroids():
+    index = FileIndex(store(), [0, 1, 2, 3, 4], vectors=np.eye(5, dtype=np.float32))
+    assert index.top_files("json loads", 1) == [1]
+    assert index.top_files("default port", 5)[0] == 0
+    # The centroid of app.py is halfway between blocks 1 and 2
+    assert index.top_files("nothing matches", 1, query_vector=np.asarray([0, 0.5, 0.5, 0, 0]), weights=(0.1, 0.9)) == [0]
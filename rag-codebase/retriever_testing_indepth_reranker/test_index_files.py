@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from dense_index import DenseIndex, MappedDenseIndex
+from index_files import (BUNDLE_ALIGNMENT, IndexBundle, MappedTexts, load_array, load_manifest, load_mapping, pack_mapping, save_array,
+                         save_manifest, save_texts, write_bundle)
+from lexical_index import BM25Index
+
+
+def test_mappings_and_texts_round_trip(tmp_path):
+    pack_mapping(tmp_path, "ragged", {7: [1, 2, 3], 2: [], 5: [4]}, ragged=True)
+    pack_mapping(tmp_path, "scalar", {3: 0.5, 1: 1.5})
+    ragged, scalar = load_mapping(tmp_path, "ragged", ragged=True), load_mapping(tmp_path, "scalar")
+    assert list(ragged) == [2, 5, 7] and ragged[7].tolist() == [1, 2, 3] and ragged[2].tolist() == []
+    assert dict(scalar) == {1: 1.5, 3: 0.5} and 2 not in scalar
+    with pytest.raises(KeyError):
+        scalar[2]
+
+    save_texts(tmp_path, "texts", ["naïve", "", "def f(): pass"])
+    texts = MappedTexts(tmp_path, "texts")
+    assert list(texts) == ["naïve", "", "def f(): pass"] and texts[-1] == "def f(): pass"
+
+
+def test_manifests_are_versioned(tmp_path):
+    save_manifest(tmp_path, "bm25", k1=1.5)
+    assert load_manifest(tmp_path, "bm25")["k1"] == 1.5
+    (tmp_path / "dense.json").write_text('{"format_version": 0, "kind": "dense"}')
+    with pytest.raises(ValueError):
+        load_manifest(tmp_path, "dense")
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    directory = tmp_path / "index"
+    BM25Index([[1, 2, 2], [2, 3], [4]]).save(directory / "bm25")
+    dense = DenseIndex(3)
+    dense.add([0, 1, 2], np.arange(9, dtype=np.float32).reshape(3, 3), "a.py")
+    dense.save(directory / "dense")
+    save_array(directory, "empty", np.empty(0, dtype=np.int64))
+    return directory
+
+
+def test_bundle_round_trip(tmp_path, index_dir):
+    write_bundle(tmp_path / "index.bundle", index_dir, {"commit": "abc"})
+    bundle = IndexBundle(tmp_path / "index.bundle")
+    assert bundle.provenance == {"commit": "abc"}
+    assert all(section["offset"] % BUNDLE_ALIGNMENT == 0 for section in bundle.sections.values())
+    assert (bundle.data_start % BUNDLE_ALIGNMENT) == 0
+
+    for name in ("bm25/postings_values", "dense/vectors", "empty"):
+        directory, _, array = name.rpartition("/")
+        expected = load_array(index_dir / directory, array, mmap=False)
+        loaded = load_array(bundle.root / directory if directory else bundle.root, array)
+        assert loaded.dtype == expected.dtype and np.array_equal(loaded, expected)
+
+    bm25, saved = BM25Index.load(bundle.root / "bm25"), BM25Index.load(index_dir / "bm25")
+    assert np.array_equal(bm25.get_scores([2, 3]), saved.get_scores([2, 3]))
+    dense = MappedDenseIndex(bundle.root / "dense")
+    assert dense.file_ids == {"a.py": {0, 1, 2}}
+    assert dense.search(np.asarray([6, 7, 8], dtype=np.float32), 1)[1].tolist() == [[2]]
+
+
+def test_corrupted_and_foreign_files_are_rejected(tmp_path, index_dir):
+    path = tmp_path / "index.bundle"
+    write_bundle(path, index_dir)
+    bundle = IndexBundle(path)
+    data = bytearray(path.read_bytes())
+    data[bundle.data_start + bundle.sections["dense/vectors"]["offset"]] ^= 0xFF
+    del bundle
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError, match="checksum"):
+        IndexBundle(path)
+    IndexBundle(path, verify=False)  # Only checked on request
+
+    (tmp_path / "other.bin").write_bytes(b"not a bundle at all")
+    with pytest.raises(ValueError, match="not an index bundle"):
+        IndexBundle(tmp_path / "other.bin")
+    with pytest.raises(FileNotFoundError):
+        IndexBundle(path, verify=False).root.array("missing")
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from rank_bm25 import BM25Okapi
+
+from lexical_index import BM25Index
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    # Zipf distributed tokens give a few long posting lists and many short ones, as in code
+    rng = np.random.default_rng(0)
+    return [(rng.zipf(1.3, size=rng.integers(1, 60)) % 500).tolist() for _ in range(400)]
+
+
+@pytest.fixture(scope="module")
+def queries(corpus):
+    rng = np.random.default_rng(1)
+    return [rng.choice(corpus[rng.integers(len(corpus))], size=rng.integers(1, 6)).tolist() for _ in range(50)] + [[0, 0, 1], [499, 1000]]
+
+
+def exhaustive(scores: np.ndarray, matched: np.ndarray, k: int):
+    positions = np.flatnonzero(matched)
+    order = np.lexsort((positions, -scores[positions]))[:k]
+    return scores[positions][order], positions[order]
+
+
+def test_scores_match_bm25okapi(corpus, queries):
+    index = BM25Index(corpus)
+    okapi = BM25Okapi(corpus)
+    for query in queries:
+        assert np.allclose(index.get_scores(query), okapi.get_scores(query))
+
+
+@pytest.mark.parametrize("k", [1, 5, 20])
+def test_pruned_top_k_equals_exhaustive_scoring(corpus, queries, k):
+    index = BM25Index(corpus)
+    for query in queries:
+        matched = np.isin(np.arange(len(corpus)), [i for i, document in enumerate(corpus) if set(document) & set(query)])
+        expected_scores, expected_positions = exhaustive(index.get_scores(query), matched, k)
+        for prune in (True, False):
+            scores, positions = index.top_k(query, k, prune=prune)
+            assert positions.tolist() == expected_positions.tolist()
+            assert np.array_equal(scores, expected_scores)
+
+
+def test_candidates_restrict_the_top_k(corpus, queries):
+    index = BM25Index(corpus)
+    candidates = np.arange(0, len(corpus), 3)
+    for query in queries:
+        scores, positions = index.top_k(query, 10, candidates)
+        assert set(positions.tolist()) <= set(candidates.tolist())
+        all_scores = index.get_scores(query)
+        matched = np.zeros(len(corpus), dtype=bool)
+        matched[[i for i in candidates if set(corpus[i]) & set(query)]] = True
+        assert positions.tolist() == exhaustive(all_scores, matched, 10)[1].tolist()
+
+
+def test_unknown_tokens_and_empty_queries():
+    index = BM25Index([[1, 2], [2, 3]])
+    assert index.top_k([7], 3)[1].tolist() == []
+    assert index.top_k([], 3)[1].tolist() == []
+    assert index.top_k([1], 0)[1].tolist() == []
+
+
+def test_save_and_load_give_the_same_results(tmp_path, corpus, queries):
+    index = BM25Index(corpus)
+    index.save(tmp_path)
+    loaded = BM25Index.load(tmp_path)
+    assert len(loaded) == len(index) and loaded.num_postings == index.num_postings
+    for query in queries:
+        assert np.array_equal(loaded.get_scores(query), index.get_scores(query))
+        for a, b in zip(loaded.top_k(query, 10), index.top_k(query, 10)):
+            assert np.array_equal(a, b)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+from document_store import DocumentStore
+from lexical_index import BM25Index
+from metadata_index import MetadataIndex, filter_positions
+
+
+def block(path: str, block_type: str, name: str, parent_type: str = "root") -> Document:
+    return Document(page_content=name, metadata={"relative_path": path, "block_type": block_type, "block_name": name, "parent_type": parent_type})
+
+
+@pytest.fixture
+def store() -> DocumentStore:
+    return DocumentStore([
+        block("repo/src/flask/app.py", "class", "Flask"),
+        block("repo/src/flask/app.py", "function", "run", "class"),
+        block("repo/src/flask/json/provider.py", "function", "get_serializer"),
+        block("repo/tests/test_app.py", "function", "test_run"),
+        block("repo/src/flask/app.py", "others", "Global Scope"),
+    ])
+
+
+def test_fields_are_anded_and_values_ored(store):
+    index = MetadataIndex(store)
+    assert index.mask(None) is None
+    assert np.flatnonzero(index.mask({"block_type": ["class", "function"]})).tolist() == [0, 1, 2, 3]
+    assert np.flatnonzero(index.mask({"block_type": "function", "parent_type": "root"})).tolist() == [2, 3]
+
+
+def test_path_prefix_matches_whole_components(store):
+    index = MetadataIndex(store)
+    assert np.flatnonzero(index.mask({"path_prefix": "src/flask"})).tolist() == [0, 1, 2, 4]
+    assert np.flatnonzero(index.mask({"path_prefix": "src/flask/json"})).tolist() == [2]
+    assert np.flatnonzero(index.mask({"path_prefix": "src/fla"})).tolist() == []
+
+
+def test_name_needs_every_identifier_token(store):
+    index = MetadataIndex(store)
+    assert np.flatnonzero(index.mask({"name": "serializer"})).tolist() == [2]
+    assert np.flatnonzero(index.mask({"name": "get_serializer"})).tolist() == [2]
+    assert np.flatnonzero(index.mask({"name": "get_run"})).tolist() == []
+
+
+def test_unknown_fields_are_rejected(store):
+    with pytest.raises(ValueError):
+        MetadataIndex(store).mask({"language": "python"})
+
+
+def test_positions_are_relative_to_the_retriever_subset(store):
+    assert filter_positions(store, np.arange(len(store)), None) is None
+    assert filter_positions(store, np.asarray([3, 2, 1]), {"block_type": "function", "parent_type": "root"}).tolist() == [0, 1]
+
+
+def test_filtered_bm25_still_returns_k_documents():
+    # Token 1 only occurs in position 0, which the filter excludes
+    index = BM25Index([[1, 2], [3], [4], [5], [6]])
+    candidates = np.asarray([1, 3, 4])
+    assert index.top_k([1], 2, candidates)[1].tolist() == []
+    scores, positions = index.top_k([1], 2, candidates, fill=True)
+    assert positions.tolist() == [1, 3] and scores.tolist() == [0.0, 0.0]
+
+    scores, positions = index.top_k([3, 1], 3, candidates, fill=True)
+    assert positions.tolist() == [1, 3, 4] and scores[0] > 0
+    assert index.top_k([3], 10, candidates, fill=True)[1].tolist() == [1, 3, 4]
@@ -0,0 +1,66 @@
+import pytest
+
+from python_ast import IDENTIFIER_KINDS, PythonASTDocumentLoader
+
+SOURCE = '''import os
+
+
+class Config:
+    DEBUG = False
+
+    def load(self, path):
+        return os.path.exists(path)
+
+    TIMEOUT = compute_timeout()
+
+
+def compute_timeout():
+    return Config.DEBUG
+'''
+
+
+@pytest.fixture
+def documents(tmp_path):
+    path = tmp_path / "config.py"
+    path.write_text(SOURCE)
+    return {document.metadata["block_name"]: document for document in PythonASTDocumentLoader(path, identifiers=True).load()}
+
+
+def identifiers(document):
+    return sorted((name, kind) for name, _, kind in document.metadata["identifiers"])
+
+
+def test_identifiers_go_to_the_innermost_definition(documents):
+    assert identifiers(documents["Global Scope"]) == [("os", "import")]
+    assert identifiers(documents["load"]) == [("exists", "call"), ("load", "definition"), ("os", "reference"), ("path", "attribute"),
+                                              ("path", "reference"), ("path", "reference"), ("self", "reference")]
+    # The class body goes on after its last method
+    assert identifiers(documents["Config"]) == [("Config", "definition"), ("DEBUG", "reference"), ("TIMEOUT", "reference"),
+                                                ("compute_timeout", "call")]
+    assert identifiers(documents["compute_timeout"]) == [("Config", "reference"), ("DEBUG", "attribute"), ("compute_timeout", "definition")]
+
+
+def test_identifier_offsets_point_into_the_file(documents):
+    for document in documents.values():
+        for name, offset, kind in document.metadata["identifiers"]:
+            assert SOURCE.encode()[offset:offset + len(name)].decode() == name and kind in IDENTIFIER_KINDS
+
+
+def test_identifiers_are_opt_in(tmp_path):
+    path = tmp_path / "config.py"
+    path.write_text(SOURCE)
+    assert all("identifiers" not in document.metadata for document in PythonASTDocumentLoader(path).load())
+
+
+def test_every_block_keeps_its_own_text(tmp_path):
+    path = tmp_path / "config.py"
+    path.write_text(SOURCE)
+    documents = PythonASTDocumentLoader(path).load()
+    assert sorted(document.metadata["block_name"] for document in documents) == ["Config", "Global Scope", "compute_timeout", "load"]
+    for document in documents:
+        metadata = document.metadata
+        if metadata["block_type"] == "function":
+            # Top level functions too, whose text used to be dropped and shifted every later text onto the wrong metadata
+            assert document.page_content == SOURCE[metadata["start_offset"]:metadata["end_offset"]]
+    global_scope = next(document for document in documents if document.metadata["block_name"] == "Global Scope")
+    assert global_scope.page_content.startswith("// Code for Global Scope\nimport os\n") and "# Code for function: compute_timeout()" in global_scope.page_content
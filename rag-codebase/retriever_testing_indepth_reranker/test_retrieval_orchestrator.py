@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import threading
+import time
+
+import pytest
+from langchain_core.documents import Document
+
+from document_store import DocumentStore
+from retrieval_orchestrator import Neo4jGraphSearch, RetrievalOrchestrator
+
+
+def doc(path: str, start: int, text: str = "") -> Document:
+    return Document(page_content=text or path, metadata={"relative_path": path, "start_offset": start, "end_offset": start + 10,
+                                                         "block_type": "function", "block_name": path, "block_args": []})
+
+
+@pytest.fixture
+def orchestrator():
+    orchestrator = RetrievalOrchestrator(timeouts={"lexical": 1.0, "dense": 1.0, "slow": 0.05})
+    yield orchestrator
+    orchestrator.close()
+
+
+def test_results_are_fused_by_block(orchestrator):
+    a, b, c = doc("a.py", 0), doc("b.py", 0), doc("c.py", 0)
+    docs, report = orchestrator.retrieve({"lexical": lambda: [a, b], "dense": lambda: [doc("c.py", 0, "other text"), a]},
+                                         {"lexical": 0.5, "dense": 0.5})
+    assert [d.metadata["relative_path"] for d in docs] == ["a.py", "c.py", "b.py"]
+    assert report["lexical"]["status"] == report["dense"]["status"] == "ok"
+    assert report["lexical"]["count"] == 2
+
+
+def test_slow_and_failing_backends_are_left_out(orchestrator, caplog):
+    def slow():
+        time.sleep(0.5)
+        return [doc("slow.py", 0)]
+
+    def failing():
+        raise RuntimeError("graph down")
+
+    with caplog.at_level(logging.WARNING, logger="retrieval_orchestrator"):
+        docs, report = orchestrator.retrieve({"lexical": lambda: [doc("a.py", 0)], "slow": slow, "graph": failing},
+                                             {"lexical": 1.0, "slow": 1.0, "graph": 1.0})
+    assert [d.metadata["relative_path"] for d in docs] == ["a.py"]
+    assert report["slow"]["status"] == "timeout" and report["slow"]["latency"] < 0.5
+    assert report["graph"]["status"] == "error"
+    assert "graph down" in caplog.text
+    assert "'slow' missed its 0.05s deadline" in caplog.text
+
+
+def test_backends_are_waited_for_without_deadlines(caplog):
+    def slow():
+        time.sleep(0.2)
+        return [doc("slow.py", 0)]
+
+    orchestrator = RetrievalOrchestrator()
+    try:
+        with caplog.at_level(logging.WARNING, logger="retrieval_orchestrator"):
+            docs, report = orchestrator.retrieve({"lexical": slow, "dense": lambda: [doc("a.py", 0)]}, {"lexical": 1.0, "dense": 0.5})
+    finally:
+        orchestrator.close()
+    assert [d.metadata["relative_path"] for d in docs] == ["slow.py", "a.py"]
+    assert report["lexical"]["status"] == "ok" and report["lexical"]["latency"] >= 0.2
+    assert caplog.text == ""
+
+
+def test_reports_of_concurrent_calls_are_separate(orchestrator):
+    reports = {}
+
+    def search(name: str, count: int):
+        _, reports[name] = orchestrator.retrieve({"lexical": lambda: [doc(f"{name}{i}.py", i) for i in range(count)]}, {"lexical": 1.0})
+
+    threads = [threading.Thread(target=search, args=(f"t{count}", count)) for count in range(1, 6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert {name: report["lexical"]["count"] for name, report in reports.items()} == {f"t{count}": count for count in range(1, 6)}
+
+
+def test_retrieve_works_inside_a_running_loop_and_reuses_its_loop(orchestrator):
+    loop = orchestrator.loop
+
+    async def notebook_cell():
+        return orchestrator.retrieve({"lexical": lambda: [doc("a.py", 0)]}, {"lexical": 1.0})
+
+    docs, _ = asyncio.run(notebook_cell())
+    assert len(docs) == 1
+    orchestrator.retrieve({"lexical": lambda: []}, {"lexical": 1.0})
+    assert orchestrator.loop is loop and orchestrator.loop_thread.is_alive()
+
+
+class FakeGraph:
+    def __init__(self, records):
+        self.records = records
+        self.calls = []
+
+    def query(self, cypher, params):
+        self.calls.append((cypher, params))
+        return self.records
+
+
+def test_graph_search_maps_records_to_blocks():
+    store = DocumentStore([doc("src/app.py", 0), doc("src/app.py", 40), doc("src/cli.py", 0)])
+    graph = FakeGraph([{"relative_path": "src/app.py", "start_offset": 40, "score": 3},
+                       {"relative_path": "src/gone.py", "start_offset": 0, "score": 2},
+                       {"relative_path": "src/cli.py", "start_offset": 0, "score": 1}])
+    docs = Neo4jGraphSearch(graph, store)("Where is the App runner?", 5)
+    assert [(d.metadata["relative_path"], d.metadata["start_offset"]) for d in docs] == [("src/app.py", 40), ("src/cli.py", 0)]
+    assert graph.calls[0][1] == {"words": ["where", "the", "app", "runner"], "k": 5}
+    assert "MATCH (n)\n" not in Neo4jGraphSearch.GRAPH_QUERY
+    assert Neo4jGraphSearch(FakeGraph([]), store)("a b", 5) == []
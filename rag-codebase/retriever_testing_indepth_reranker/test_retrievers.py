@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from document_store import DocumentStore
+from index_files import IndexBundle, write_bundle
+from retrievers import EnsembleSearch, HybridSearch, symbol_documents, symbol_usage_documents
+
+
+def block(name, start, content, identifiers=(), path="repo/app.py"):
+    return Document(page_content=content, metadata={
+        "relative_path": path, "block_type": "function", "block_name": name, "start_offset": start, "end_offset": start + len(content),
+        "parent_type": "root", "parent_name": "root", "block_args": [], "functions_called": [], "identifiers": list(identifiers)})
+
+
+@pytest.fixture
+def store():
+    return DocumentStore([
+        block("load_config", 0, "def load_config(path): return read(path)", [["load_config", 4, "definition"]]),
+        block("main", 100, "def main(): load_config('app.toml')", [["main", 104, "definition"], ["load_config", 112, "call"]]),
+        block("serve", 0, "def serve(): cfg = load_config(None)", [["serve", 4, "definition"], ["load_config", 19, "call"]], "repo/server.py"),
+        block("unrelated", 200, "def unrelated(): pass", [["unrelated", 204, "definition"]]),
+    ])
+
+
+def test_symbols_and_their_usages_within_the_candidates(store):
+    doc_ids = store.ids
+    assert [doc.metadata["block_name"] for doc in symbol_documents(store, doc_ids, None, "what does load_config do", 5)] == ["load_config"]
+    assert [doc.metadata["block_name"] for doc in symbol_usage_documents(store, doc_ids, None, "who calls load_config", 5)] == ["main", "serve"]
+    assert [doc.metadata["block_name"] for doc in symbol_usage_documents(store, np.arange(3), None, "who calls load_config", 1)] == ["main"]
+    assert [doc.metadata["block_name"] for doc in symbol_usage_documents(store, np.arange(4), np.asarray([2]), "who calls load_config", 5)] == ["serve"]
+    assert symbol_usage_documents(store, doc_ids, None, "who calls it", 5) == []
+
+
+def test_ensemble_search_fuses_the_usages_backend(store):
+    search = EnsembleSearch(store, embeddings=DeterministicFakeEmbedding(size=16))
+    report = {}
+    names = [doc.metadata["block_name"] for doc in search.search("who calls load_config", [0.5, 0.5], final_k=4, usages=True, report=report)]
+    assert report["usages"]["status"] == "ok" and report["usages"]["count"] == 2
+    assert set(names[:2]) == {"main", "serve"}
+
+    report = {}
+    search.search("who calls load_config", [0.5, 0.5], report=report)
+    assert "usages" not in report
+    search.orchestrator.close()
+
+
+def test_ensemble_search_fuses_the_transitive_callers_backend():
+    documents = [block("load_config", 0, "def load_config(path): return read(path)"),
+                 block("read_settings", 100, "def read_settings(): return load_config('app.toml')"),
+                 block("main", 200, "def main(): read_settings()"),
+                 block("unrelated", 300, "def unrelated(): pass", path="repo/other.py")]
+    documents[1].metadata["functions_called"], documents[2].metadata["functions_called"] = ["load_config()"], ["read_settings()"]
+    search = EnsembleSearch(DocumentStore(documents), embeddings=DeterministicFakeEmbedding(size=16))
+    report = {}
+    names = [doc.metadata["block_name"] for doc in search.search("what eventually calls `load_config`", [0.5, 0.5], final_k=4, callers=True,
+                                                                  backend_weights={"callers": 1.0}, report=report)]
+    assert report["callers"]["status"] == "ok" and report["callers"]["count"] == 2
+    assert names[:2] == ["read_settings", "main"]
+
+    report = {}
+    search.search("what eventually calls `load_config`", [0.5, 0.5], callers=True, filters={"path_prefix": "repo/other"}, report=report)
+    assert report["callers"]["count"] == 0
+    search.orchestrator.close()
+
+
+def test_retrievers_embed_with_the_given_embeddings(store):
+    embeddings = DeterministicFakeEmbedding(size=16)
+    hybrid = HybridSearch(store, embeddings=embeddings)
+    assert hybrid.embeddings is embeddings
+    assert len(hybrid.search("read the config", bm25_n=3, faiss_n=2, final_k=2)) == 2
+
+    ensemble = EnsembleSearch(store, embeddings=embeddings)
+    assert ensemble.embeddings is embeddings and len(ensemble.dense) == len(store)
+    assert len(ensemble.search("read the config", [0.5, 0.5], final_k=3)) == 3
+    ensemble.orchestrator.close()
+
+
+def test_symbol_results_are_detached_from_the_store(store):
+    search = EnsembleSearch(store, embeddings=DeterministicFakeEmbedding(size=16))
+    for docs in (symbol_documents(store, store.ids, None, "what does load_config do", 5),
+                 symbol_usage_documents(store, store.ids, None, "who calls load_config", 5),
+                 search.search("what does load_config do", [0.5, 0.5], symbols=True)):
+        for doc in docs:
+            doc.metadata["relevance_score"] = 1.0
+    search.orchestrator.close()
+    assert all("relevance_score" not in store.metadata(doc_id) and "relevance_score" not in store.document(doc_id, "header").metadata
+               for doc_id in store.ids)
+
+
+def test_file_index_is_built_on_first_hierarchical_search(store):
+    search = EnsembleSearch(store, embeddings=DeterministicFakeEmbedding(size=16))
+    search.search("read the config", [0.5, 0.5])
+    assert search._files is None and "file_index" not in store._derived
+
+    docs = search.search("read the config", [0.5, 0.5], top_files=1)
+    assert search.files is store.derived("file_index", None) and len(search.files) == 2
+    assert len({doc.metadata["relative_path"] for doc in docs}) == 1
+    assert np.allclose(search.files.centroids[search.files.paths.index("/repo/server.py")], search.dense.vectors([2])[0])
+    other = EnsembleSearch(store, embeddings=DeterministicFakeEmbedding(size=16))
+    assert other.files is search.files
+    # A subset of the store gets its own
+    subset = EnsembleSearch(store, doc_ids=[2, 3], embeddings=DeterministicFakeEmbedding(size=16))
+    assert subset.files is not search.files and subset.files.file_positions([0, 1]).tolist() == [0, 1]
+    for retriever in (search, other, subset):
+        retriever.orchestrator.close()
+
+
+def test_a_bundle_alone_serves_the_ensemble(store, tmp_path):
+    embeddings = DeterministicFakeEmbedding(size=16)
+    built = EnsembleSearch(store, doc_ids=[0, 1, 2], embeddings=embeddings)
+    built.save(tmp_path / "ensemble")
+    write_bundle(tmp_path / "ensemble.bundle", tmp_path / "ensemble")
+    loaded = EnsembleSearch.load(IndexBundle(tmp_path / "ensemble.bundle").root, embeddings=embeddings)
+
+    assert [doc.metadata for doc in loaded.store.documents()] == [doc.metadata for doc in store.documents()]
+    assert loaded.doc_ids.tolist() == [0, 1, 2] and len(loaded.bm25) == 3 and len(loaded.dense) == 3
+    for query in ("read the config", "serve", "def unrelated"):
+        assert loaded.bm25_search(query, 3) == built.bm25_search(query, 3)
+        assert loaded.faiss_search(query, 2) == built.faiss_search(query, 2)
+        assert loaded.search(query, [0.5, 0.5], final_k=2, filters={"path_prefix": "repo/app"}) == \
+            built.search(query, [0.5, 0.5], final_k=2, filters={"path_prefix": "repo/app"})
+    built.orchestrator.close()
+    loaded.orchestrator.close()
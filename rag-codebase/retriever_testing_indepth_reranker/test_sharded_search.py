@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from code_tokenizer import CodeTokenizer
+from document_store import DocumentStore
+from lexical_index import BM25Index
+from rank_fusion import weighted_reciprocal_rank
+from retrievers import EnsembleSearch
+from sharded_search import ShardedSearch
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic bag of words vectors, so the tests need no model.
+    """
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = np.zeros(16, dtype=np.float32)
+        for word in text.lower().split():
+            vector[sum(map(ord, word)) % 16] += 1.0
+        return vector.tolist()
+
+
+def block(path: str, name: str, code: str) -> Document:
+    return Document(page_content=code, metadata={"relative_path": path, "start_offset": 0, "end_offset": len(code), "block_type": "function",
+                                                 "block_name": name, "block_args": [], "parent_type": "root"})
+
+
+@pytest.fixture
+def store() -> DocumentStore:
+    documents = [block("repo/setup.py", "setup", "def setup(): install package"),
+                 block("repo/conftest.py", "fixture", "def fixture(): return client"),
+                 block("repo/noxfile.py", "tests", "def tests(session): session install")]
+    for package in range(6):
+        for i in range(package + 1):
+            documents.append(block(f"repo/pkg{package}/mod{i}.py", f"load_{package}_{i}", f"def load_{package}_{i}(path): read config file {i}"))
+    return DocumentStore(documents)
+
+
+def test_root_files_share_a_shard_and_num_shards_is_a_cap(store):
+    with ShardedSearch(store, num_shards=3, embeddings=HashingEmbeddings()) as search:
+        assert len(search.shards) == 3
+        assert search.executor._max_workers == 3
+        assert len({search.shard_of[doc_id] for doc_id in (0, 1, 2)}) == 1
+        assert sorted(np.concatenate([shard.doc_ids for shard in search.shards]).tolist()) == list(store.ids)
+        for package in range(6):
+            package_ids = [doc_id for doc_id in store.ids if f"/pkg{package}/" in store.metadata(doc_id)["relative_path"]]
+            assert len({search.shard_of[doc_id] for doc_id in package_ids}) == 1
+    assert search.executor._shutdown
+
+
+def test_hash_sharding_keeps_files_whole(store):
+    with ShardedSearch(store, shard_by="hash", num_shards=4, embeddings=HashingEmbeddings()) as search:
+        assert 1 <= len(search.shards) <= 4
+        by_path = {}
+        for doc_id in store.ids:
+            assert by_path.setdefault(store.metadata(doc_id)["relative_path"], search.shard_of[doc_id]) == search.shard_of[doc_id]
+
+
+def test_unknown_sharding_is_rejected(store):
+    with pytest.raises(ValueError):
+        ShardedSearch(store, shard_by="size", embeddings=HashingEmbeddings())
+
+
+@pytest.mark.parametrize("num_shards", [1, 2, 8])
+def test_sharded_bm25_matches_a_single_index(store, num_shards):
+    tokenizer = CodeTokenizer()
+    single = BM25Index(tokenizer.encode_corpus(store.texts("lexical")))
+    with ShardedSearch(store, num_shards=num_shards, embeddings=HashingEmbeddings()) as search:
+        for query in ("read config", "install package session", "load_3_2 path", "nothing matches"):
+            scores, positions = single.top_k(tokenizer.encode_query(query), 5, fill=True)
+            hits = search.bm25_search(query, 5)
+            assert [doc_id for _, doc_id in hits] == positions.tolist()
+            assert np.allclose([score for score, _ in hits], scores)
+        # Filling only takes blocks passing the filters
+        assert [doc_id for _, doc_id in search.bm25_search("nothing matches", 30, {"path_prefix": "pkg1"})] == [4, 5]
+
+
+@pytest.mark.parametrize("num_shards", [1, 3, 8])
+def test_sharded_search_matches_the_flat_ensemble(store, num_shards):
+    flat = EnsembleSearch(store, embeddings=HashingEmbeddings())
+    with ShardedSearch(store, num_shards=num_shards, embeddings=HashingEmbeddings()) as search:
+        for query in ("read config file", "install package", "nothing matches"):
+            expected = [doc.metadata["block_name"] for doc in flat.search(query, [0.4, 0.6], top_n=10, final_k=8)]
+            assert [doc.metadata["block_name"] for doc in search.search(query, [0.4, 0.6], top_n=10, final_k=8)] == expected
+    flat.orchestrator.close()
+
+
+def test_sharded_hybrid_search_ranks_the_bm25_candidates_by_distance(store):
+    embeddings = HashingEmbeddings()
+    vectors = np.asarray(embeddings.embed_documents(list(store.texts("header"))), dtype=np.float32)
+    query = np.asarray(embeddings.embed_query("read config file"), dtype=np.float32)
+    with ShardedSearch(store, num_shards=4, embeddings=embeddings) as search:
+        candidates = [doc_id for _, doc_id in search.bm25_search("read config file", 12)]
+        expected = sorted(candidates, key=lambda doc_id: (float(np.sum((vectors[doc_id] - query) ** 2)), doc_id))[:4]
+        docs = search.hybrid_search("read config file", bm25_n=12, faiss_n=4, final_k=4)
+        assert [doc.metadata["block_name"] for doc in docs] == [store.metadata(doc_id)["block_name"] for doc_id in expected]
+
+
+def test_sharded_dense_search_is_exact(store):
+    embeddings = HashingEmbeddings()
+    with ShardedSearch(store, num_shards=3, embeddings=embeddings) as search:
+        vectors = np.asarray(embeddings.embed_documents(list(store.texts("header"))), dtype=np.float32)
+        query = np.asarray(embeddings.embed_query("read config file"), dtype=np.float32)
+        distances = np.sum((vectors - query) ** 2, axis=1)
+        hits = search.faiss_search("read config file", 4)
+        assert np.allclose([distance for distance, _ in hits], np.sort(distances)[:4], atol=1e-4)
+
+
+def test_weighted_reciprocal_rank():
+    assert weighted_reciprocal_rank([[1, 2, 3], [3, 1]], [0.5, 0.5]) == [1, 3, 2]
+    assert weighted_reciprocal_rank([[1, 2], [2, 1]], [0.9, 0.1]) == [1, 2]
+    documents = [Document(page_content="a", metadata={"id": 1}), Document(page_content="b", metadata={"id": 1})]
+    fused = weighted_reciprocal_rank([documents[:1], documents[1:]], [1, 1], key=lambda doc: doc.metadata["id"])
+    assert fused == documents[:1]
+
@@ -0,0 +1,49 @@
+import pytest
+
+from symbol_index import SymbolIndex, is_identifier, qualified_names
+
+
+def metadata(name, block_type="function", parent_type="root", parent_name="root", path="repo/flask/json.py"):
+    return {"block_type": block_type, "block_name": name, "parent_type": parent_type, "parent_name": parent_name, "relative_path": path}
+
+
+@pytest.fixture
+def index():
+    return SymbolIndex(range(5), [metadata("TaggedJSONSerializer", "class"),
+                                  metadata("dumps", "function", "class", "TaggedJSONSerializer"),
+                                  metadata("dumps"),
+                                  metadata("get_scores", path="repo/bm25.py"),
+                                  metadata("Global Scope", "others")])
+
+
+def test_words_that_look_like_code():
+    assert all(map(is_identifier, ["get_scores", "TaggedJSONSerializer", "json.dumps", "run()", "MAX_ROWS", "getUser"]))
+    assert not any(map(is_identifier, ["HTTP", "API", "What", "scores"]))
+
+
+def test_qualified_names():
+    assert qualified_names(metadata("dumps", "function", "class", "TaggedJSONSerializer")) == \
+        ["dumps", "TaggedJSONSerializer.dumps", "json.TaggedJSONSerializer.dumps"]
+    assert qualified_names(metadata("helper", path="repo/pkg/__init__.py")) == ["helper"]
+    assert qualified_names(metadata("Global Scope", "others")) == []
+
+
+def test_lookups(index):
+    assert index.lookup("dumps") == [1, 2]
+    assert index.lookup("TaggedJSONSerializer.dumps") == [1]
+    assert index.lookup("json.") == [] and index.lookup("json.", prefix=True) == [0, 1, 2]
+    assert index.lookup("GET_SCORES") == [] and index.lookup("GET_SCORES", ignore_case=True) == [3]
+
+
+def test_questions_find_the_symbols_they_name(index):
+    assert index.find("What does get_scores() return?") == [3]
+    assert index.find("How is `dumps` used by TaggedJSONSerializer?") == [1, 2, 0]
+    # Acronyms and plain words are not looked up, even when a block has that name
+    assert SymbolIndex([0], [metadata("HTTP", "class")]).find("How does HTTP caching work?") == []
+
+
+def test_save_and_load(index, tmp_path):
+    index.save(tmp_path)
+    loaded = SymbolIndex.load(tmp_path)
+    assert len(loaded) == len(index) and loaded.lookup("json.", prefix=True) == [0, 1, 2]
+    assert loaded.find("json.dumps", limit=1) == [2]
@@ -0,0 +1,105 @@
+import re
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from document_store import DocumentStore
+from retrievers import EnsembleSearch
+from trigram_index import TrigramIndex, TrigramSearch, required_literals, trigrams
+
+FILES = {
+    "app.py": 'import os\n\n\ndef load(path):\n    raise ValueError("Config file not found")\n\n\nTIMEOUT = 30\n',
+    "server.py": 'class Server:\n    def start(self):\n        return "listening on port"\n',
+    "cli.py": 'def main():\n    print("config FILE not found")\n',
+    "empty.py": "",
+}
+
+
+@pytest.fixture
+def store(tmp_path):
+    documents = []
+    for name, source in FILES.items():
+        path = tmp_path / name
+        path.write_text(source)
+        for match in re.finditer(r"^( *)(def|class) (\w+)[^\n]*\n(?:\1 +[^\n]*\n)*", source, re.MULTILINE):
+            documents.append(Document(page_content=match.group(0), metadata={
+                "relative_path": str(path), "block_type": "function" if match.group(2) == "def" else "class", "block_name": match.group(3),
+                "start_offset": match.start(), "end_offset": match.end(), "parent_type": "root", "parent_name": "root", "block_args": []}))
+        documents.append(Document(page_content=source, metadata={"relative_path": str(path), "block_type": "others", "block_name": "Global Scope",
+                                                                 "start_offset": 0, "end_offset": len(source), "parent_type": "root", "parent_name": "root",
+                                                                 "block_args": []}))
+    return DocumentStore(documents)
+
+
+def grep(store, pattern, flags=0):
+    """
+    Every match in every file of the store, mapped to blocks like the index does.
+    """
+    index = store.derived("trigram_index", TrigramIndex)
+    matches = []
+    for file_number, path in enumerate(index.paths):
+        with open(path, "rb") as file:
+            matches += [(index.block_id(file_number, match.start()), match.start(), match.end())
+                        for match in re.finditer(pattern, file.read(), re.MULTILINE | flags) if match.end() > match.start()]
+    return matches
+
+
+def test_trigrams_are_packed_and_distinct():
+    assert trigrams(b"abcabc").tolist() == sorted({0x616263, 0x626361, 0x636162})
+    assert trigrams(b"ab").tolist() == []
+
+
+def test_required_literals_of_regexes():
+    assert required_literals(rb"raise ValueError\(") == [[b"raise ValueError("]]
+    assert required_literals(rb"def \w+\(self") == [[b"def ", b"(self"]]
+    assert required_literals(rb"(?:foo|bar)baz") == [[b"baz"]]
+    assert required_literals(rb"timeout|port\b") == [[b"timeout"], [b"port"]]
+    assert required_literals(rb"(abc)+x") == [[b"abc"]]
+    assert required_literals(rb"a.*b") is None and required_literals(rb"port|x\d") is None
+
+
+def test_candidates_are_only_the_files_with_every_trigram(store):
+    index = TrigramIndex(store)
+    file_numbers = {path.rsplit("/", 1)[-1]: number for number, path in enumerate(index.paths)}
+    assert index.candidates([[b"not found"]]).tolist() == sorted([file_numbers["app.py"], file_numbers["cli.py"]])
+    assert index.candidates([[b"listening"], [b"TIMEOUT"]]).tolist() == sorted([file_numbers["server.py"], file_numbers["app.py"]])
+    assert index.candidates([[b"zzz"]]).tolist() == []
+    assert index.candidates(None).tolist() == list(range(len(FILES)))
+
+
+@pytest.mark.parametrize("pattern, regex, ignore_case", [
+    ("not found", False, False), ("Config file", False, True), ("self", False, False), ("os", False, False),
+    (r"def \w+\(", True, False), (r"^TIMEOUT = \d+$", True, False), (r"found|port", True, False), (r"[a-z]+\(", True, True),
+])
+def test_search_finds_what_grep_finds(store, pattern, regex, ignore_case):
+    index = TrigramIndex(store)
+    expected = grep(store, pattern.encode() if regex else re.escape(pattern.encode()), re.IGNORECASE if ignore_case else 0)
+    assert index.search(pattern, regex, ignore_case) == expected
+
+
+def test_matches_map_to_their_block(store):
+    index = TrigramIndex(store)
+    (block_id, start, end), = index.search("Config file not found")
+    assert store.metadata(block_id)["block_name"] == "load" and end - start == len("Config file not found")
+    (block_id, _, _), = index.search("TIMEOUT")
+    assert store.metadata(block_id)["block_name"] == "Global Scope"
+    assert len(index.search("o", regex=True, max_matches=3)) == 3
+
+
+def test_save_and_load(store, tmp_path):
+    index = TrigramIndex(store)
+    index.save(tmp_path / "trigrams")
+    loaded = TrigramIndex.load(tmp_path / "trigrams")
+    assert list(loaded.paths) == list(index.paths) and np.array_equal(loaded.files, index.files)
+    assert loaded.search(r"def \w+\(", regex=True) == index.search(r"def \w+\(", regex=True)
+
+
+def test_trigram_backend_of_the_ensemble(store):
+    search = EnsembleSearch(store, backends={"trigram": TrigramSearch(store)}, embeddings=DeterministicFakeEmbedding(size=16))
+    report = {}
+    docs = search.search('ValueError("Config file not found")', [0.0, 0.0], backend_weights={"trigram": 1.0}, report=report)
+    assert report["trigram"]["status"] == "ok" and report["trigram"]["count"] == 1
+    assert docs[0].metadata["block_name"] == "load"
+    search.orchestrator.close()
@@ -0,0 +1,48 @@
+import pytest
+from langchain_core.documents import Document
+
+from document_store import DocumentStore
+from usage_index import UsageIndex, usage_documents
+
+
+def block(name, start, identifiers, block_type="function"):
+    return Document(page_content=f"def {name}(): pass", metadata={
+        "relative_path": "repo/app.py", "block_type": block_type, "block_name": name, "start_offset": start, "end_offset": start + 90,
+        "parent_type": "root", "parent_name": "root", "identifiers": identifiers})
+
+
+@pytest.fixture
+def store():
+    return DocumentStore([
+        block("Global Scope", 0, [["os", 7, "import"]], "others"),
+        block("load", 100, [["load", 104, "definition"], ["os", 130, "reference"], ["exists", 140, "call"], ["read", 150, "call"]]),
+        block("main", 200, [["main", 204, "definition"], ["load", 220, "call"], ["load", 260, "reference"], ["exists", 280, "attribute"]]),
+    ])
+
+
+def test_usages_are_occurrences_in_block_and_offset_order(store):
+    index = UsageIndex(store)
+    assert len(index) == 9
+    assert index.usages("load") == [(2, 220, "call"), (2, 260, "reference")]
+    assert index.usages("App.load()", kinds=("definition",)) == [(1, 104, "definition")]
+    assert index.usages("os") == [(0, 7, "import"), (1, 130, "reference")]
+    assert index.usages("missing") == []
+    assert index.usage_blocks("exists") == [1, 2] and index.usage_blocks("exists", limit=1) == [1]
+
+
+def test_columns_use_the_narrowest_types(store):
+    index = UsageIndex(store)
+    assert index.block_ids.itemsize == 1 and index.positions.itemsize == 1 and index.kinds.itemsize == 1
+
+
+def test_save_and_load(store, tmp_path):
+    UsageIndex(store).save(tmp_path)
+    loaded = UsageIndex.load(tmp_path)
+    assert loaded.usages("exists") == UsageIndex(store).usages("exists")
+
+
+def test_usage_documents_list_their_occurrences(store):
+    documents = usage_documents(store, "load")
+    assert [document.metadata["block_name"] for document in documents] == ["main"]
+    assert documents[0].metadata["usages"] == [[220, "call"], [260, "reference"]]
+    assert "usages" not in store.metadata(2)
@@ -0,0 +1,218 @@
+from collections import defaultdict
+from langchain_core.documents import Document
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import mmap
+import re
+import numpy as np
+
+from document_store import DocumentStore
+from index_files import MappedTexts, load_array, load_manifest, save_array, save_manifest, save_texts
+
+try:
+    from re import _parser as regex_parser  # Python 3.11+
+except ImportError:
+    import sre_parse as regex_parser
+
+DEFAULT_MAX_MATCHES = 1000
+
+
+def trigrams(data: bytes) -> np.ndarray:
+    """
+    Sorted distinct trigrams of a byte string, each packed into an integer as b0 << 16 | b1 << 8 | b2.
+    """
+    values = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+    if len(values) < 3:
+        return np.empty(0, dtype=np.uint32)
+    return np.unique((values[:-2] << 16) | (values[1:-1] << 8) | values[2:])
+
+
+def required_literals(pattern: bytes) -> Optional[List[List[bytes]]]:
+    """
+    Literal strings a regex cannot match without, as alternatives (one per branch of a top-level |) of runs that must all occur.
+    Returns None if some alternative needs no literal of 3 bytes or more, as no file can then be ruled out by its trigrams.
+    Only plain literals, groups and repeats of at least once are looked into, anything else ends the current run.
+    """
+    def runs(items) -> List[bytes]:
+        found, run = [], bytearray()
+
+        def flush():
+            if len(run) >= 3:
+                found.append(bytes(run))
+            run.clear()
+
+        def walk(items):
+            for op, av in items:
+                if op is regex_parser.LITERAL:
+                    run.append(av)
+                elif op is regex_parser.AT:  # Zero width (^, $, \b), the literals around it are still adjacent
+                    continue
+                elif op is regex_parser.SUBPATTERN:
+                    walk(av[-1])
+                elif op in (regex_parser.MAX_REPEAT, regex_parser.MIN_REPEAT) and av[0] >= 1:
+                    flush()
+                    walk(av[2])
+                    flush()
+                else:
+                    flush()
+        walk(items)
+        flush()
+        return found
+
+    parsed = list(regex_parser.parse(pattern))
+    if len(parsed) == 1 and parsed[0][0] is regex_parser.BRANCH:
+        alternatives = [runs(branch) for branch in parsed[0][1][1]]
+    else:
+        alternatives = [runs(parsed)]
+    return None if any(not alternative for alternative in alternatives) else alternatives
+
+
+class TrigramIndex:
+    """
+    Trigram index over the raw contents of the files of a DocumentStore, for exact literal and regex search (like grep, but only reading the files that can match).
+
+    Every file is indexed by the distinct trigrams of its ASCII lowercased bytes, so one index serves case sensitive and insensitive queries alike.
+    The posting lists are in CSR layout: the numbers of the files containing the i-th trigram of keys are files[offsets[i]:offsets[i + 1]].
+    A query intersects the posting lists of the trigrams of the literals it requires (see required_literals()), then runs the regex over the
+    memory mapped candidates. Matches are mapped back to the innermost function or class block around them, or to the global scope block of their file.
+
+    Files are read from the relative_path of their blocks, so build (and search) the index from where the documents were loaded.
+    Patterns are matched against UTF-8 bytes with re.MULTILINE, so ^ and $ match at line boundaries.
+    """
+    def __init__(self, store: DocumentStore):
+        blocks_by_path: Dict[str, List[Tuple[int, int, int]]] = defaultdict(list)
+        global_by_path: Dict[str, int] = {}
+        for doc_id in store.ids:
+            metadata = store.metadata(doc_id)
+            path = str(metadata.get("relative_path", ""))
+            if metadata.get("block_type") in ("class", "function"):
+                blocks_by_path[path].append((metadata["start_offset"], metadata["end_offset"], doc_id))
+            else:
+                global_by_path.setdefault(path, doc_id)
+        self.paths: Sequence[str] = sorted(set(blocks_by_path) | set(global_by_path))
+
+        # CSR layout: the blocks of file i, sorted by start offset, are rows block_offsets[i]:block_offsets[i + 1]
+        file_blocks = [sorted(blocks_by_path.get(path, [])) for path in self.paths]
+        self.block_offsets = np.zeros(len(self.paths) + 1, dtype=np.int64)
+        np.cumsum([len(blocks) for blocks in file_blocks], out=self.block_offsets[1:])
+        self.block_starts = np.asarray([start for blocks in file_blocks for start, _, _ in blocks], dtype=np.int64)
+        self.block_ends = np.asarray([end for blocks in file_blocks for _, end, _ in blocks], dtype=np.int64)
+        self.block_ids = np.asarray([doc_id for blocks in file_blocks for _, _, doc_id in blocks], dtype=np.int64)
+        self.global_ids = np.asarray([global_by_path.get(path, -1) for path in self.paths], dtype=np.int64)
+
+        file_trigrams = []
+        for path in self.paths:
+            try:
+                with open(path, "rb") as file:
+                    file_trigrams.append(trigrams(file.read().lower()))
+            except OSError:
+                file_trigrams.append(np.empty(0, dtype=np.uint32))
+        keys = np.concatenate(file_trigrams) if file_trigrams else np.empty(0, dtype=np.uint32)
+        files = np.repeat(np.arange(len(self.paths), dtype=np.int64), [len(values) for values in file_trigrams])
+        order = np.argsort(keys, kind="stable")  # Stable, so the files of every posting list stay sorted
+        self.keys, counts = np.unique(keys[order], return_counts=True)
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.files = files[order].astype(np.min_scalar_type(max(len(self.paths) - 1, 0)))
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def candidates(self, alternatives: Optional[List[List[bytes]]]) -> np.ndarray:
+        """
+        Returns the sorted numbers of the files containing every trigram of every literal of at least one alternative.
+        """
+        if alternatives is None:
+            return np.arange(len(self.paths), dtype=np.int64)
+        found = [np.empty(0, dtype=np.int64)]
+        for literals in alternatives:
+            needed = np.unique(np.concatenate([trigrams(literal.lower()) for literal in literals]))
+            positions = np.searchsorted(self.keys, needed)
+            if np.any(positions == len(self.keys)) or np.any(self.keys[np.minimum(positions, len(self.keys) - 1)] != needed):
+                continue
+            postings = sorted((self.files[self.offsets[i]:self.offsets[i + 1]] for i in positions.tolist()), key=len)
+            files = postings[0].astype(np.int64)
+            for posting in postings[1:]:
+                if len(files) == 0:
+                    break
+                files = np.intersect1d(files, posting, assume_unique=True)
+            found.append(files)
+        return np.unique(np.concatenate(found))
+
+    def search(self, pattern: str, regex: bool = False, ignore_case: bool = False,
+               max_matches: int = DEFAULT_MAX_MATCHES) -> List[Tuple[int, int, int]]:
+        """
+        Returns up to max_matches non-empty matches of a literal (or regex) as (block id, start byte, end byte in the file), in file and offset order.
+        """
+        expression = pattern.encode() if regex else re.escape(pattern.encode())
+        compiled = re.compile(expression, re.MULTILINE | (re.IGNORECASE if ignore_case else 0))
+        alternatives = required_literals(expression) if regex else ([[pattern.encode()]] if len(pattern.encode()) >= 3 else None)
+
+        matches = []
+        for file_number in self.candidates(alternatives).tolist():
+            try:
+                with open(self.paths[file_number], "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+                    for match in compiled.finditer(source):
+                        if match.end() == match.start():
+                            continue
+                        block_id = self.block_id(file_number, match.start())
+                        if block_id >= 0:
+                            matches.append((block_id, match.start(), match.end()))
+                        if len(matches) >= max_matches:
+                            return matches
+            except (OSError, ValueError):  # Missing files, empty files cannot be mapped
+                continue
+        return matches
+
+    def block_id(self, file_number: int, offset: int) -> int:
+        """
+        Returns the id of the function or class block of a file containing a byte offset, otherwise of its global scope block (-1 if it has none).
+        """
+        start, end = self.block_offsets[file_number], self.block_offsets[file_number + 1]
+        index = start + int(np.searchsorted(self.block_starts[start:end], offset, side="right")) - 1
+        if index >= start and offset < self.block_ends[index]:
+            return int(self.block_ids[index])
+        return int(self.global_ids[file_number])
+
+    def save(self, directory: Union[str, Path]):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        save_texts(directory, "paths", self.paths)
+        for name in ("keys", "offsets", "files", "block_offsets", "block_starts", "block_ends", "block_ids", "global_ids"):
+            save_array(directory, name, getattr(self, name))
+        save_manifest(directory, "trigrams", size=len(self.paths))
+
+    @classmethod
+    def load(cls, directory: Union[str, Path]) -> "TrigramIndex":
+        load_manifest(directory, "trigrams")
+        index = cls.__new__(cls)
+        index.paths = MappedTexts(directory, "paths")
+        for name in ("keys", "offsets", "files", "block_offsets", "block_starts", "block_ends", "block_ids", "global_ids"):
+            setattr(index, name, load_array(directory, name))
+        return index
+
+
+class TrigramSearch:
+    """
+    Exact search retrieval backend: the blocks containing a literal (or matching a regex), most matches first, each with its [start, end] byte offsets added to its metadata as matches.
+    Meant for queries such as pasted error messages and string literals, which BM25 and embeddings handle poorly, e.g as the "trigram" backend of EnsembleSearch.
+    """
+    def __init__(self, store: DocumentStore, view: str = "raw", regex: bool = False, ignore_case: bool = False):
+        self.store = store
+        self.view = view
+        self.regex = regex
+        self.ignore_case = ignore_case
+
+    def __call__(self, query: str, k: int) -> List[Document]:
+        index = self.store.derived("trigram_index", TrigramIndex)
+        by_block: Dict[int, List[List[int]]] = {}
+        for block_id, start, end in index.search(query.strip(), self.regex, self.ignore_case):
+            by_block.setdefault(block_id, []).append([start, end])
+
+        docs = []
+        for block_id in sorted(by_block, key=lambda block_id: -len(by_block[block_id]))[:k]:
+            doc = DocumentStore.detach([self.store.document(block_id, self.view)])[0]
+            doc.metadata["matches"] = by_block[block_id]
+            docs.append(doc)
+        return docs
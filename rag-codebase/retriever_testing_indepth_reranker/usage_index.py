@@ -0,0 +1,107 @@
+from bisect import bisect_left
+from langchain_core.documents import Document
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from document_store import DocumentStore
+from index_files import MappedTexts, load_array, load_manifest, save_array, save_manifest, save_texts
+from python_ast import IDENTIFIER_KINDS
+
+USAGE_KINDS = ("reference", "call", "attribute", "import")  # Every kind but the definition itself
+
+
+class UsageIndex:
+    """
+    Inverted index from every identifier to its occurrences in the blocks of a DocumentStore, built from the identifiers metadata of the AST loader
+    (load with PythonASTDocumentLoader(..., identifiers=True), otherwise the index is empty).
+
+    Occurrences are stored in CSR layout sorted by identifier, block and offset: occurrences of the i-th name of names are rows offsets[i]:offsets[i + 1]
+    of block_ids, positions (byte offsets relative to the start of the block) and kinds (indexes into IDENTIFIER_KINDS).
+    Each column uses the narrowest integer type its values fit in, so the whole index is a few bytes per occurrence.
+
+    Identifiers are matched by name only: usages("Ranker.rank") are the occurrences of rank, whatever object they are read from.
+    """
+    def __init__(self, store: DocumentStore):
+        names, block_ids, positions, kinds = [], [], [], []
+        for doc_id in store.ids:
+            metadata = store.metadata(doc_id)
+            for name, offset, kind in metadata.get("identifiers", []):
+                names.append(name)
+                block_ids.append(doc_id)
+                positions.append(offset - metadata["start_offset"])
+                kinds.append(IDENTIFIER_KINDS.index(kind))
+
+        unique_names, codes = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+        order = np.lexsort((positions, block_ids, codes))
+        self.names: Sequence[str] = unique_names.tolist()
+        self.offsets = np.zeros(len(self.names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes, minlength=len(self.names)), out=self.offsets[1:])
+        self.block_ids = self.__narrow(np.asarray(block_ids, dtype=np.int64)[order])
+        self.positions = self.__narrow(np.asarray(positions, dtype=np.int64)[order])
+        self.kinds = np.asarray(kinds, dtype=np.uint8)[order]
+        self.start_offsets = self.__narrow(np.asarray([store.metadata(doc_id)["start_offset"] for doc_id in store.ids], dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.block_ids)
+
+    def usages(self, symbol: str, kinds: Iterable[str] = USAGE_KINDS) -> List[Tuple[int, int, str]]:
+        """
+        Returns the occurrences of a symbol as (block id, byte offset in the file, kind), in block and offset order.
+        By default these are all its call sites and references, but not its definitions.
+        """
+        name = symbol.strip().rstrip("()").rsplit(".", 1)[-1]
+        index = bisect_left(self.names, name)
+        if index == len(self.names) or self.names[index] != name:
+            return []
+        start, end = self.offsets[index], self.offsets[index + 1]
+        wanted = np.isin(self.kinds[start:end], [IDENTIFIER_KINDS.index(kind) for kind in kinds])
+        block_ids = self.block_ids[start:end][wanted].astype(np.int64)
+        offsets = self.start_offsets[block_ids].astype(np.int64) + self.positions[start:end][wanted]
+        return [(block_id, offset, IDENTIFIER_KINDS[kind])
+                for block_id, offset, kind in zip(block_ids.tolist(), offsets.tolist(), self.kinds[start:end][wanted].tolist())]
+
+    def usage_blocks(self, symbol: str, kinds: Iterable[str] = USAGE_KINDS, limit: Optional[int] = None) -> List[int]:
+        """
+        Returns the ids of the blocks using a symbol, without duplicates and in block order.
+        """
+        block_ids = list(dict.fromkeys(block_id for block_id, _, _ in self.usages(symbol, kinds)))
+        return block_ids if limit is None else block_ids[:limit]
+
+    def save(self, directory: Union[str, Path]):
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        save_texts(directory, "names", self.names)
+        for name in ("offsets", "block_ids", "positions", "kinds", "start_offsets"):
+            save_array(directory, name, getattr(self, name))
+        save_manifest(directory, "usages", size=len(self.block_ids))
+
+    @classmethod
+    def load(cls, directory: Union[str, Path]) -> "UsageIndex":
+        load_manifest(directory, "usages")
+        index = cls.__new__(cls)
+        index.names = MappedTexts(directory, "names")
+        for name in ("offsets", "block_ids", "positions", "kinds", "start_offsets"):
+            setattr(index, name, load_array(directory, name))
+        return index
+
+    @staticmethod
+    def __narrow(values: np.ndarray) -> np.ndarray:
+        return values.astype(np.min_scalar_type(int(values.max()))) if len(values) else values.astype(np.uint8)
+
+
+def usage_documents(store: DocumentStore, symbol: str, kinds: Iterable[str] = USAGE_KINDS, k: Optional[int] = None) -> List[Document]:
+    """
+    Returns the blocks using a symbol, each with the byte offsets and kinds of its occurrences added to its metadata as usages.
+    """
+    index = store.derived("usage_index", UsageIndex)
+    by_block = {}
+    for block_id, offset, kind in index.usages(symbol, kinds):
+        by_block.setdefault(block_id, []).append([offset, kind])
+    documents = []
+    for block_id, usages in list(by_block.items())[:k]:
+        document = DocumentStore.detach([store.document(block_id, "raw")])[0]
+        document.metadata["usages"] = usages
+        documents.append(document)
+    return documents